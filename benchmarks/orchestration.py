@@ -0,0 +1,248 @@
+"""
+    Measure pytranscoder's own overhead per job - probing, queueing, progress monitoring, transfers and
+    bookkeeping - by running thousands of small files through the stub ffmpeg in benchmarks/stub, which does
+    no real work. Each scenario runs in a fresh process so memory and CPU figures are not mixed up.
+
+    Scenarios:
+      local     LocalHost with one queue of <slots> threads (plain pytranscoder run)
+      cluster   Cluster with a single host of type local and <slots> slots
+      agent     Cluster with an agent on this machine reached over loopback, <slots> slots on both sides
+                (needs port 9567 free)
+
+    Reported per scenario: jobs/s, CPU ms per job in pytranscoder (and the agent), CPU ms per job in the stub,
+    peak RSS and its growth over the run. Results can be saved and later compared against to catch regressions.
+
+    usage: python benchmarks/orchestration.py [--files N] [--slots N] [--size KB] [--scenarios local,cluster,agent]
+                                              [--save <results.json>] [--compare <baseline.json>] [--tolerance PCT]
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STUB_FFMPEG = os.path.join(ROOT, 'benchmarks', 'stub', 'ffmpeg')
+SCENARIOS = ['local', 'cluster', 'agent']
+AGENT_PORT = 9567
+
+#
+# compared against a baseline: name, higher is better
+#
+COMPARED = [('jobs_per_sec', True), ('cpu_ms_per_job', False), ('peak_rss_mb', False)]
+
+
+def rss_mb() -> float:
+    """Peak RSS of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_sources(workdir: str, count: int, size_kb: int) -> list:
+    srcdir = os.path.join(workdir, 'src')
+    os.makedirs(srcdir, exist_ok=True)
+    blk = os.urandom(size_kb * 1024)
+    paths = []
+    for i in range(count):
+        path = os.path.join(srcdir, f'media{i:05}.mkv')
+        with open(path, 'wb') as f:
+            f.write(blk)
+        paths.append(path)
+    return paths
+
+
+def profiles(queue: str) -> dict:
+    return {'bench': {'output_options': ['-c:v libx265', '-crf 20', '-c:a copy', '-c:s copy', '-f matroska'],
+                      'extension': '.mkv', 'queue': queue, 'threshold': 0}}
+
+
+def run_local(paths: list, slots: int) -> int:
+    from pytranscoder.config import ConfigFile
+    from pytranscoder.transcode import LocalHost
+
+    config = ConfigFile({'config': {'ffmpeg': STUB_FFMPEG, 'queues': {'bench': slots}},
+                         'profiles': profiles('bench')})
+    host = LocalHost(config)
+    host.enqueue_files([(path, 'bench', None) for path in paths])
+    host.start()
+    return len(host.complete)
+
+
+def run_cluster(host_config: dict, paths: list) -> int:
+    from pytranscoder.cluster import Cluster
+    from pytranscoder.config import ConfigFile
+    from pytranscoder.console import console
+    from pytranscoder.status import StatusAggregator
+
+    config = ConfigFile({'config': {'ffmpeg': STUB_FFMPEG, 'clusters': {'bench': {'benchhost': host_config}}},
+                         'profiles': profiles('_default')})
+    cluster = Cluster('bench', config.settings['clusters']['bench'], config, '/usr/bin/ssh')
+    for path in paths:
+        cluster.enqueue(path, 'bench')
+
+    aggregator = StatusAggregator()
+    cluster.aggregator = aggregator
+    aggregator.worker_started()
+    cluster.start()
+    aggregator.run()
+    cluster.join()
+    console.flush()
+    return len(cluster.completed)
+
+
+def wait_for_port(port: int, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def run_scenario(scenario: str, count: int, slots: int, size_kb: int) -> dict:
+    """Run one scenario in this process and return its measurements"""
+    import pytranscoder
+    from pytranscoder.console import console
+    from pytranscoder.timing import timings
+    from pytranscoder.usage import AccountedPopen
+
+    pytranscoder.keep_source = True
+    with tempfile.TemporaryDirectory(prefix='pytranscoder-bench-') as workdir:
+        paths = make_sources(workdir, count, size_kb)
+        rss_start = rss_mb()
+        agent = None
+        if scenario == 'agent':
+            if wait_for_port(AGENT_PORT, timeout=0.5):
+                raise RuntimeError(f'port {AGENT_PORT} already in use, stop the running agent first')
+            agent_dir = os.path.join(workdir, 'agent')
+            os.makedirs(agent_dir)
+            agent = AccountedPopen([sys.executable, '-c',
+                                    f'import sys; sys.path.insert(0, {ROOT!r}); '
+                                    f'from pytranscoder.agent import Agent; Agent(0, {slots}).run()'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if not wait_for_port(AGENT_PORT):
+                agent.kill()
+                raise RuntimeError('agent did not start')
+
+        try:
+            cpu_start = time.process_time()
+            children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+            wall_start = time.perf_counter()
+
+            if scenario == 'local':
+                jobs = run_local(paths, slots)
+            elif scenario == 'cluster':
+                jobs = run_cluster({'type': 'local', 'ffmpeg': STUB_FFMPEG, 'status': 'enabled',
+                                    'queues': {'_default': slots}}, paths)
+            else:
+                jobs = run_cluster({'type': 'agent', 'ip': '127.0.0.1', 'os': 'linux', 'user': 'bench',
+                                    'ffmpeg': STUB_FFMPEG, 'working_dir': os.path.join(workdir, 'agent'),
+                                    'status': 'enabled', 'min_scratch_mb': 1, 'queues': {'_default': slots}},
+                                   paths)
+
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            console.flush()
+        finally:
+            if agent is not None:
+                agent.terminate()
+                agent.wait()
+
+        if agent is None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            stub_cpu = (children.ru_utime - children_start.ru_utime) + (children.ru_stime - children_start.ru_stime)
+            agent_cpu = 0.0
+        else:
+            # the agent reports the stub's usage per job, the rest of its total is the agent itself
+            stub_cpu = sum([rec['cpu_user'] + rec['cpu_sys'] for rec in timings.records
+                            if rec['cpu_user'] is not None])
+            agent_cpu = agent.usage.cpu_user + agent.usage.cpu_sys - stub_cpu if agent.usage is not None else 0.0
+
+    per_job = 1000 / jobs if jobs > 0 else 0.0
+    return {'scenario': scenario, 'files': count, 'slots': slots, 'size_kb': size_kb, 'jobs': jobs,
+            'wall_sec': round(wall, 3), 'jobs_per_sec': round(jobs / wall, 2) if wall > 0 else 0.0,
+            'cpu_ms_per_job': round((cpu + agent_cpu) * per_job, 3),
+            'agent_cpu_ms_per_job': round(agent_cpu * per_job, 3),
+            'stub_cpu_ms_per_job': round(stub_cpu * per_job, 3),
+            'peak_rss_mb': round(rss_mb(), 1), 'rss_growth_mb': round(rss_mb() - rss_start, 1)}
+
+
+def spawn(scenario: str, args) -> dict:
+    """Run a scenario in a fresh interpreter, its console output discarded"""
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as result:
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-scenario', scenario, '--result', result.name,
+               '--files', str(args.files), '--slots', str(args.slots), '--size', str(args.size)]
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f'{scenario} scenario failed:\n{proc.stderr}')
+        return json.load(result)
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> bool:
+    """Print changes against a saved baseline, returning False if any metric regressed beyond tolerance (percent)"""
+    with open(baseline_path, 'r') as f:
+        baseline = {rec['scenario']: rec for rec in json.load(f)}
+    ok = True
+    for rec in results:
+        base = baseline.get(rec['scenario'])
+        if base is None:
+            continue
+        for name, higher_is_better in COMPARED:
+            if not base[name]:
+                continue
+            change = (rec[name] - base[name]) * 100 / base[name]
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            flag = '  REGRESSION' if regressed else ''
+            print(f'{rec["scenario"]:8} {name:16} {base[name]:10} -> {rec[name]:10} ({change:+6.1f}%){flag}')
+            ok = ok and not regressed
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pytranscoder orchestration overhead benchmark')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--slots', type=int, default=24)
+    parser.add_argument('--size', type=int, default=64, help='size of each source file in KB')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--compare', help='compare against results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=15.0, help='percent change counted as a regression')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        rec = run_scenario(args.run_scenario, args.files, args.slots, args.size)
+        with open(args.result, 'w') as f:
+            json.dump(rec, f)
+        return
+
+    os.environ.setdefault('STUB_INTERVAL', '0')
+    print(f'{args.files} files of {args.size} KB, {args.slots} slots')
+    print(f'{"SCENARIO":8} {"JOBS":>6} {"WALL":>8} {"JOBS/S":>8} {"CPU/JOB":>10} {"AGENT/JOB":>10} '
+          f'{"STUB/JOB":>10} {"PEAK RSS":>9} {"GROWTH":>8}')
+    results = []
+    for scenario in args.scenarios.split(','):
+        rec = spawn(scenario, args)
+        results.append(rec)
+        print(f'{scenario:8} {rec["jobs"]:6} {rec["wall_sec"]:7.1f}s {rec["jobs_per_sec"]:8.1f} '
+              f'{rec["cpu_ms_per_job"]:8.2f}ms {rec["agent_cpu_ms_per_job"]:8.2f}ms {rec["stub_cpu_ms_per_job"]:8.2f}ms '
+              f'{rec["peak_rss_mb"]:6.1f} MB {rec["rss_growth_mb"]:5.1f} MB')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+    Compare the per-line CPU cost of the two ffmpeg progress monitors:
+    scraping status lines with status_re versus parsing -progress key=value blocks.
+
+    usage: python benchmarks/progress_parsing.py [lines]
+"""
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from pytranscoder.ffmpeg import parse_status, parse_progress, progress_blocks
+
+STATUS_LINE = 'frame= 2000 fps= 86 q=-0.0 size=   20480kB time=00:01:23.45 bitrate=2010.9kbits/s speed=3.67x\n'
+PROGRESS_BLOCK = ['frame=2000\n', 'fps=86.00\n', 'stream_0_0_q=28.0\n', 'bitrate=2010.9kbits/s\n',
+                  'total_size=20971520\n', 'out_time_us=83450000\n', 'out_time_ms=83450000\n',
+                  'out_time=00:01:23.450000\n', 'dup_frames=0\n', 'drop_frames=0\n', 'speed=3.67x\n',
+                  'progress=continue\n']
+
+
+def scrape_status(lines):
+    for line in lines:
+        parse_status(line)
+
+
+def parse_blocks(lines):
+    for block in progress_blocks(lines):
+        parse_progress(block)
+
+
+def measure(func, lines) -> float:
+    start = time.process_time()
+    func(lines)
+    return time.process_time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_200_000
+    status_lines = [STATUS_LINE] * count
+    progress_lines = PROGRESS_BLOCK * (count // len(PROGRESS_BLOCK))
+
+    for name, func, lines in [('status_re', scrape_status, status_lines),
+                              ('-progress', parse_blocks, progress_lines)]:
+        elapsed = measure(func, lines)
+        updates = len(lines) if func is scrape_status else len(lines) // len(PROGRESS_BLOCK)
+        print(f'{name:10}: {elapsed * 1e9 / len(lines):8.0f} ns/line, {elapsed * 1e6 / updates:6.2f} us/update')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-__version__ = '2.2.7'
+__version__ = '2.3.0'
 __author__ = 'Marshall L Smith Jr <marshallsmithjr@gmail.com>'
 __license__ = 'GPLv3'
 
@@ -11,5 +11,7 @@ from queue import Queue
 verbose = False
 keep_source = False
 dry_run = False
+full_log = False
+log_buffer_kb = 64              # tail of ffmpeg output kept in memory for the log of a failed run (config log_buffer_kb)
 
 status_queue = Queue()
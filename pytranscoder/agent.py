@@ -1,126 +1,394 @@
+import json
+import shutil
 import socket
 import os
 import subprocess
 import time
+from contextlib import contextmanager
+from threading import Lock, Semaphore, Thread
+from typing import Dict, Optional
+
+from pytranscoder.session import Session, Channel
+from pytranscoder.transfer import TransferManifest, TransferError, receive_file, send_file, file_digest, \
+    send_msg, recv_msg
+from pytranscoder.usage import AccountedPopen
+
+
+class InputCache:
+    """LRU-bounded, content-addressed store of recently received source media, kept in the agent working folder.
+
+    Entries are named by their sampled fingerprint. Last use is tracked via the file modification time
+    so the cache survives agent restarts without a separate index.
+    """
+
+    def __init__(self, max_size_mb: int):
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = Lock()
+        self.pinned = dict()
+        self.filling = dict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def hit_rate(self) -> int:
+        lookups = self.hits + self.misses
+        return int(self.hits * 100 / lookups) if lookups > 0 else 0
+
+    @staticmethod
+    def cache_dir(tempdir: str) -> str:
+        return os.path.join(tempdir, '.pytranscoder-cache')
+
+    def entry_path(self, tempdir: str, fingerprint: str, filename: str) -> str:
+        _, ext = os.path.splitext(filename)
+        return os.path.join(self.cache_dir(tempdir), fingerprint + ext)
+
+    @contextmanager
+    def fill_lock(self, fingerprint: str):
+        """Serialize jobs on the same source so the first one to miss receives it and the others reuse its entry"""
+        with self.lock:
+            lock, users = self.filling.get(fingerprint, (None, 0))
+            lock = lock or Lock()
+            self.filling[fingerprint] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.filling[fingerprint]
+                if users > 1:
+                    self.filling[fingerprint] = (lock, users - 1)
+                else:
+                    del self.filling[fingerprint]
+
+    def lookup(self, tempdir: str, fingerprint: str, filename: str, filesize: int) -> Optional[str]:
+        """Find and pin a cached copy of the source, if any"""
+        if not self.enabled:
+            return None
+        path = self.entry_path(tempdir, fingerprint, filename)
+        with self.lock:
+            if os.path.exists(path) and os.path.getsize(path) == filesize:
+                os.utime(path)
+                self.hits += 1
+                self.bytes_saved += filesize
+                self.pinned[path] = self.pinned.get(path, 0) + 1
+                return path
+            self.misses += 1
+        return None
+
+    def store(self, tempdir: str, fingerprint: str, filename: str, received_path: str) -> str:
+        """Move a newly received source into the cache and pin it"""
+        path = self.entry_path(tempdir, fingerprint, filename)
+        os.makedirs(self.cache_dir(tempdir), exist_ok=True)
+        with self.lock:
+            os.replace(received_path, path)
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+            self.evict(tempdir)
+        return path
+
+    def release(self, tempdir: str, path: str):
+        """Unpin an entry after the transcode and evict least recently used entries over the size limit"""
+        with self.lock:
+            count = self.pinned.get(path, 1) - 1
+            if count > 0:
+                self.pinned[path] = count
+            else:
+                self.pinned.pop(path, None)
+            self.evict(tempdir)
+
+    def evict(self, tempdir: str):
+        """Remove least recently used unpinned entries until the cache fits its size limit. Caller holds the lock."""
+        cache_dir = self.cache_dir(tempdir)
+        entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        entries = sorted([(os.path.getmtime(e), os.path.getsize(e), e) for e in entries if os.path.isfile(e)])
+        total = sum([size for _, size, _ in entries])
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            if entry in self.pinned:
+                continue
+            os.remove(entry)
+            total -= size
+
+    def __str__(self):
+        return f"cache hits {self.hits}/{self.hits + self.misses} ({self.hit_rate}%), " \
+               f"{int(self.bytes_saved / (1024 * 1024))} MB of transfers saved"
+
+
+class ManagerSession(Session):
+    """Agent end of a session with a cluster manager. Each new channel opened by the manager is a job."""
+
+    def __init__(self, agent, sock):
+        # until the handshake says otherwise, give the manager 30 seconds to speak up
+        super().__init__(sock, 30)
+        self.agent = agent
+        self.tempdir = None
+        self.ffmpeg_path = None
+
+    def on_control(self, msg: str):
+        parts = msg.split("|")
+        if parts[0] == "SESSION" and len(parts) >= 4:
+            self.tempdir = parts[1]
+            self.ffmpeg_path = parts[2]
+            # the manager heartbeats well within its own timeout, use the same to detect a dead manager
+            self.timeout = float(parts[3])
+        self.send_control("PONG|" + json.dumps(self.agent.report(self.tempdir, self.ffmpeg_path)))
+
+    def on_new_channel(self, channel_id: int, payload: bytes):
+        hello = payload.decode(errors='replace')
+        if not hello.startswith("HELLO|"):
+            # late frame of a job that already ended
+            return
+        channel = self.add_channel(channel_id)
+        Thread(target=self.agent.handle_job, args=(channel, hello), daemon=True).start()
 
 
 class Agent:
 
+    def __init__(self, cache_size_mb: int = 0, slots: int = 1):
+        """
+        :param cache_size_mb:   Size limit of the source media cache, 0 to disable caching
+        :param slots:           Number of concurrent transcodes allowed
+        """
+        self.cache = InputCache(cache_size_mb)
+        self.slots = slots
+        self.slot_semaphore = Semaphore(slots)
+        self.lock = Lock()
+        self.active = 0
+        self.reserved = 0                   # scratch space claimed by jobs in progress
+        self.ffmpeg_versions = dict()
+
     def run(self):
         s = socket.socket()
         port = 9567
 
+        # allow a restarted agent to rebind immediately, so interrupted transfers can resume
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(("", port))
 
-        s.listen(1)
+        s.listen(5)
 
+        print(f"listening on port {port} with {self.slots} slot(s)...")
         while True:
-            print(f"listening on port {port}...")
             c, addr = s.accept()
+            Thread(target=self.handle, args=(c, addr), daemon=True).start()
+
+    def handle(self, c, addr):
+        """Serve one cluster manager session until it closes or stops sending heartbeats"""
+        print('session started from addr', addr)
+        session = ManagerSession(self, c)
+        session.read_loop()
+        print('session closed from addr', addr)
+
+    def handle_job(self, channel: Channel, hello: str):
+        print(hello)
+        parts = hello.split("|", 5)
+        if len(parts) < 6:
+            print("No enough values in HELLO packet: " + hello)
+            channel.close()
+            return
+
+        scratch = int(parts[1]) * 2
+        with self.lock:
+            self.reserved += scratch
+        try:
+            self.transcode(channel, parts)
+        except Exception as ex:
+            print(str(ex))
+        finally:
+            with self.lock:
+                self.reserved -= scratch
+            channel.close()
+
+    def report(self, tempdir: Optional[str], ffmpeg_path: Optional[str]) -> Dict:
+        """Capability and load report returned to the cluster manager in PONG"""
+        with self.lock:
+            active = self.active
+            reserved = self.reserved
+        scratch_mb = None
+        if tempdir and os.path.isdir(tempdir):
+            scratch_mb = int((shutil.disk_usage(tempdir).free - reserved) / (1024 * 1024))
+        try:
+            load = list(os.getloadavg())
+        except (AttributeError, OSError):
+            load = None             # not available on Windows
+        return {
+            'slots': self.slots,
+            'active': active,
+            'free_slots': max(self.slots - active, 0),
+            'cpus': os.cpu_count(),
+            'load': load,
+            'ffmpeg': self.ffmpeg_version(ffmpeg_path),
+            'scratch_mb': scratch_mb,
+            'cache': {'hits': self.cache.hits, 'misses': self.cache.misses, 'hit_rate': self.cache.hit_rate,
+                      'bytes_saved': self.cache.bytes_saved},
+        }
+
+    def ffmpeg_version(self, ffmpeg_path: Optional[str]) -> Optional[str]:
+        """Version of the ffmpeg binary, probed once in the background so a PONG never waits on it"""
+        if not ffmpeg_path:
+            return None
+        with self.lock:
+            if ffmpeg_path in self.ffmpeg_versions:
+                return self.ffmpeg_versions[ffmpeg_path]
+            # not known yet, reported as None until the probe finishes
+            self.ffmpeg_versions[ffmpeg_path] = None
+        Thread(target=self.probe_ffmpeg, args=(ffmpeg_path,), daemon=True).start()
+        return None
+
+    def probe_ffmpeg(self, ffmpeg_path: str):
+        try:
+            p = subprocess.run([ffmpeg_path, '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               universal_newlines=True, timeout=10)
+            first_line = p.stdout.split('\n')[0]
+            version = first_line.split(' ')[2] if first_line.startswith('ffmpeg version') else None
+        except (OSError, subprocess.TimeoutExpired, IndexError):
+            version = None
+        with self.lock:
+            self.ffmpeg_versions[ffmpeg_path] = version
+
+    def transcode(self, channel: Channel, parts):
+        """Receive (or find in cache) the source media, run ffmpeg and return the result"""
+        filesize = int(parts[1])
+        tempdir = parts[2]
+        filename = parts[3]
+        fingerprint = parts[4]
+        cli = parts[5]
+
+        output_filename = os.path.join(tempdir, filename)
+        tmp_filename = os.path.join(tempdir, filename + ".tmp")
+
+        if self.cache.enabled:
+            # a job arriving while the same source is still being received waits for it, then hits the cache
+            with self.cache.fill_lock(fingerprint):
+                cached_filename = self.cache.lookup(tempdir, fingerprint, filename, filesize)
+                if cached_filename is not None:
+                    print(f"{filename} found in cache, {self.cache}")
+                    send_msg(channel, "CACHED")
+                    output_filename = cached_filename
+                else:
+                    if not self.receive_input(channel, output_filename, filesize, fingerprint):
+                        return
+                    output_filename = self.cache.store(tempdir, fingerprint, filename, output_filename)
+        elif not self.receive_input(channel, output_filename, filesize, fingerprint):
+            return
+
+        try:
+            # transfers don't need a slot, so a queued job's upload overlaps with running transcodes
+            self.slot_semaphore.acquire()
+            with self.lock:
+                self.active += 1
             try:
-                print('got connection from addr', addr)
-                hello = c.recv(2048).decode()
-                print(hello)
-                if hello.startswith("PING"):
-                    c.send(bytes("PONG".encode()))
-                    c.close()
-                    continue
-
-                if hello.startswith("HELLO|"):
-
-                    parts = hello.split("|")
-                    if len(parts) < 5:
-                        print("No enough values in HELLO packet: " + hello)
-                        c.close()
+                self.run_ffmpeg(channel, cli.replace(r"{FILENAME}", output_filename), tmp_filename)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                self.slot_semaphore.release()
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            if self.cache.enabled:
+                self.cache.release(tempdir, output_filename)
+            else:
+                os.remove(output_filename)
+
+    @staticmethod
+    def run_ffmpeg(channel: Channel, cli: str, tmp_filename: str):
+        cli_parts = cli.split(r"$")
+        print("receive complete - executing " + " ".join(cli_parts))
+        cli_parts.append(tmp_filename)
+
+        vetoed = False
+        with AccountedPopen(cli_parts,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True,
+                            shell=False) as proc:
+            try:
+                while proc.poll() is None:
+                    line = proc.stdout.readline()
+                    if line.startswith("video:"):
+                        # transcode complete
+                        break
+
+                    send_msg(channel, line)
+
+                    # progress is streamed without waiting, check for any instructions from the manager
+                    control = channel.poll()
+                    if control is None:
                         continue
+                    confirmation = control.decode()
+                    print(confirmation)
+                    if confirmation == "STOP":
+                        proc.kill()
+                        print("Client stopped the transcode, cleaning up")
+                        vetoed = True
+                        break
+                    if confirmation == "VETO":
+                        proc.kill()
+                        print("Client vetoed the transcode, cleaning up")
+                        vetoed = True
+                        break
+            except ConnectionError:
+                proc.kill()
+                print("Lost session with client, transcode abandoned")
+                raise
+
+            while proc.poll() is None:
+                time.sleep(1)
+
+            if not vetoed:
+                if proc.returncode != 0:
+                    print("> ERR")
+                    send_msg(channel, f"ERR|{proc.returncode}")
+                    print("Cleaning up")
+                else:
+                    print("> DONE")
+                    filesize = os.path.getsize(tmp_filename)
+                    usage = proc.usage.to_field() if proc.usage is not None else ''
+                    send_msg(channel, f"DONE|{proc.returncode}|{filesize}|{usage}")
+                    # wait for response, then send file
+                    response = recv_msg(channel)
+                    if response == "ACK!":
+                        # send the file back
+                        print("sending transcoded file")
+                        digests = send_file(channel, tmp_filename)
+                        send_msg(channel, f"DIGEST|{file_digest(digests)}")
+                        print("done")
+
+    @staticmethod
+    def receive_input(channel: Channel, output_filename: str, filesize: int, ident: str) -> bool:
+        """Receive the source media, resuming a previously interrupted transfer of the same file if possible"""
+
+        manifest = TransferManifest(output_filename + ".part", filesize, ident).load()
+        offset = manifest.offset
+        if offset > 0:
+            print(f"resuming transfer of {output_filename} at {offset} of {filesize} bytes")
+        send_msg(channel, f"RESUME|{offset}")
+
+        print(f"receiving {filesize - offset} bytes to {output_filename}...")
+        try:
+            digests = receive_file(channel, manifest)
+        except TransferError as ex:
+            # verified chunks are kept, the client will retry and resume after them
+            print(str(ex))
+            send_msg(channel, f"ERR|{ex}")
+            return False
+
+        response = recv_msg(channel)
+        if not response.startswith("DIGEST|"):
+            print(f"Protocol error - expected DIGEST from client, got {response}")
+            return False
+        if response.split("|")[1] != file_digest(digests):
+            print(f"Digest mismatch on {output_filename}, discarding")
+            manifest.remove()
+            send_msg(channel, "ERR|digest mismatch")
+            return False
 
-                    filesize = int(parts[1])
-                    tempdir = parts[2]
-                    filename = parts[3]
-                    cli = parts[4]
-
-                    print(" echoing back hello")
-                    c.send(bytes(hello.encode()))
-
-                    print(f"receiving {filesize} bytes to {filename}...")
-                    output_filename = os.path.join(tempdir, filename)
-                    tmp_filename = os.path.join(tempdir, filename + ".tmp")
-
-                    with open(output_filename, "wb") as f:
-                        while filesize > 0:
-                            chunk = c.recv(min(1_000_000, filesize))
-                            filesize -= len(chunk)
-                            f.write(chunk)
-
-                    cli = cli.replace(r"{FILENAME}", output_filename)
-                    cli_parts = cli.split(r"$")
-                    print("receive complete - executing " + " ".join(cli_parts))
-                    cli_parts.append(tmp_filename)
-
-                    vetoed = False
-                    with subprocess.Popen(cli_parts,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.STDOUT,
-                                          universal_newlines=True,
-                                          shell=False) as proc:
-                        while proc.poll() is None:
-                            line = proc.stdout.readline()
-                            if line.startswith("video:"):
-                                # transcode complete
-                                break
-
-                            c.send(bytes(line.encode()))
-
-                            response = c.recv(4)
-                            confirmation = response.decode()
-                            print(confirmation)
-                            if confirmation == "PING":
-                                # ping received out of context, ignore
-                                continue
-                            if confirmation == "STOP":
-                                proc.kill()
-                                print("Client stopped the transcode, cleaning up")
-                                vetoed = True
-                                break
-                            if confirmation == "VETO":
-                                proc.kill()
-                                print("Client vetoed the transcode, cleaning up")
-                                vetoed = True
-                                break
-                            elif confirmation != "ACK!":
-                                proc.kill()
-                                print(f"Protocol error - expected ACK from client, got {confirmation}")
-                                print("Cleaning up")
-                                vetoed = True
-                                break
-
-                        while proc.poll() is None:
-                            time.sleep(1)
-
-                        if not vetoed:
-                            if proc.returncode != 0:
-                                print("> ERR")
-                                c.send(bytes(f"ERR|{proc.returncode}".encode()))
-                                print("Cleaning up")
-                            else:
-                                print("> DONE")
-                                filesize = os.path.getsize(tmp_filename)
-                                c.send(bytes(f"DONE|{proc.returncode}|{filesize}".encode()))
-                                # wait for response, then send file
-                                response = c.recv(4).decode()
-                                if response == "ACK!":
-                                    # send the file back
-                                    print("sending transcoded file")
-                                    with open(tmp_filename, "rb") as input_file:
-                                        blk = input_file.read(1_000_000)
-                                        while len(blk) > 0:
-                                            c.send(blk)
-                                            blk = input_file.read(1_000_000)
-                                    print("done")
-                        os.remove(tmp_filename)
-                        os.remove(output_filename)
-
-            except Exception as ex:
-                print(str(ex))
-
-            c.close()
+        manifest.finish(output_filename)
+        send_msg(channel, "VERIFIED")
+        return True
@@ -2,17 +2,19 @@
     Cluster support
 """
 import datetime
+import json
 import os
 import shutil
 import signal
 import subprocess
 import sys
+import time
 from pathlib import PureWindowsPath, PosixPath
 from queue import Queue, Empty
 import socket
 from tempfile import gettempdir
-from threading import Thread, Lock
-from typing import Dict, List, Optional
+from threading import Thread, Lock, Event
+from typing import Dict, List, Optional, Tuple
 
 import crayons
 
@@ -20,10 +22,26 @@ import pytranscoder
 
 from pytranscoder import verbose
 from pytranscoder.config import ConfigFile
-from pytranscoder.ffmpeg import FFmpeg
+from pytranscoder.console import console
+from pytranscoder.crop import apply_crop
+from pytranscoder.ffmpeg import FFmpeg, PROGRESS_OPTIONS
+from pytranscoder.history import history, history_vetoed, order_queue, predicted_note
+from pytranscoder.journal import journal, completed_fields
 from pytranscoder.media import MediaInfo
-from pytranscoder.profile import Directives
-from pytranscoder.utils import filter_threshold, get_local_os_type, calculate_progress, run
+from pytranscoder.metrics import metrics
+from pytranscoder.multi import is_multi
+from pytranscoder.profile import Directives, stream_options
+from pytranscoder.remux import RemuxDirective, select_directive
+from pytranscoder.rule import Rule
+from pytranscoder.sample import predict_vetoed, log_prediction
+from pytranscoder.segment import SegmentedEncode, SegmentDirective, use_segments
+from pytranscoder.session import Session, Channel
+from pytranscoder.status import StatusAggregator
+from pytranscoder.timing import JobTiming, timings
+from pytranscoder.transfer import TransferManifest, send_file, receive_file, file_digest, send_msg, recv_msg, \
+    sampled_fingerprint
+from pytranscoder.usage import ResourceUsage
+from pytranscoder.utils import filter_threshold, get_local_os_type, calculate_progress, calculate_eta, run
 
 
 class RemoteHostProperties:
@@ -62,6 +80,34 @@ class RemoteHostProperties:
     def ffmpeg_path(self):
         return self.props.get('ffmpeg', None)
 
+    @property
+    def min_scratch_mb(self) -> int:
+        return self.props.get('min_scratch_mb', 1024)
+
+    @property
+    def batch_size(self) -> int:
+        return self.props.get('batch_size', 8)
+
+    @property
+    def batch_max_mb(self) -> int:
+        return self.props.get('batch_max_mb', 0)
+
+    @property
+    def batch_max_runtime(self) -> int:
+        return self.props.get('batch_max_runtime', 0)
+
+    @property
+    def heartbeat_interval(self) -> float:
+        return self.props.get('heartbeat_interval', 2)
+
+    @property
+    def heartbeat_timeout(self) -> float:
+        return self.props.get('heartbeat_timeout', 10)
+
+    @property
+    def transfer_retries(self) -> int:
+        return self.props.get('transfer_retries', 3)
+
     @property
     def is_enabled(self):
         return self.props.get('status', 'enabled') == 'enabled'
@@ -135,11 +181,28 @@ class EncodeJob:
     media_info: MediaInfo
     directive_name: str
 
-    def __init__(self, inpath: str, info: MediaInfo, directive: Directives, mixins: Optional[List[str]]):
+    def __init__(self, inpath: str, info: MediaInfo, directive: Directives, mixins: Optional[List[str]],
+                 timing: Optional[JobTiming] = None):
         self.inpath = os.path.abspath(inpath)
         self.media_info = info
         self.directive = directive
         self.mixins = mixins
+        self.timing = timing or JobTiming()
+        if directive is not None:
+            self.timing.directive = directive.name()
+        self.chunk: Optional[ChunkedJob] = None         # set for a segment of a chunked job
+        self.encoded = False
+        self.attempts = 0
+
+    def set_encoded(self):
+        self.encoded = True
+        if self.chunk is not None:
+            self.chunk.encoder.segment_done(self.inpath)
+
+    @property
+    def keep_source(self) -> bool:
+        """Segments of a chunked job are always replaced by their encoded result, for the merge to find"""
+        return pytranscoder.keep_source and self.chunk is None
 
     def should_abort(self, pct_comp) -> bool:
         if self.directive.threshold_check() < 100:
@@ -147,6 +210,47 @@ class EncodeJob:
         return False
 
 
+SEGMENT_ATTEMPTS = 3        # times a segment of a chunked job is tried before the job is given up
+SEGMENT_ROUNDS = 5          # rounds of host threads run for the segments of chunked jobs at most
+
+
+class ChunkedJob:
+    """A large job split into keyframe-aligned video segments, each encoded as a separate job by whichever host
+       takes it, then joined on the cluster manager along with the audio and subtitles, encoded there once.
+    """
+
+    def __init__(self, job: EncodeJob, encoder: SegmentedEncode):
+        self.job = job
+        self.encoder = encoder
+        self.segments: List[EncodeJob] = list()
+        self.others_code: Optional[int] = None
+        self.others_thread: Optional[Thread] = None
+
+    def start_other_streams(self):
+        def encode():
+            self.others_code = self.encoder.encode_other_streams()
+        self.others_thread = Thread(target=encode, name=f'{os.path.basename(self.job.inpath)}-audio', daemon=True)
+        self.others_thread.start()
+
+    def retries(self) -> List[EncodeJob]:
+        """Segments that failed and may be tried again"""
+        return [segment for segment in self.segments
+                if not segment.encoded and segment.attempts < SEGMENT_ATTEMPTS]
+
+    def merge(self) -> Optional[int]:
+        """Join the encoded segments into the .tmp output
+
+        :return: 0 on success, None if some segments could not be encoded, otherwise an ffmpeg error code
+        """
+        if self.others_thread is not None:
+            self.others_thread.join()
+        if not all([segment.encoded for segment in self.segments]):
+            return None
+        if self.others_code != 0:
+            return self.others_code
+        return self.encoder.join([segment.inpath for segment in self.segments])
+
+
 class ManagedHost(Thread):
     """
         Base thread class for all remote host types.
@@ -170,29 +274,37 @@ class ManagedHost(Thread):
     def validate_settings(self):
         return self.props.validate_settings()
 
-    @property
-    def lock(self):
-        return self._manager.lock
-
     @property
     def configfile(self) -> ConfigFile:
         return self._manager.config
 
-    def complete(self, source, elapsed=0):
+    def complete(self, source, elapsed=0, timing: Optional[JobTiming] = None):
         self._complete.append((source, elapsed))
+        if timing is not None:
+            timings.record(source, self.hostname, timing)
+        pytranscoder.status_queue.put({'host': self.hostname, 'file': os.path.basename(source), 'finished': True})
 
     @property
     def completed(self) -> List:
         return self._complete
 
     def log(self, *args):
-        self.lock.acquire()
-        try:
-            msg = crayons.blue(f'({self.hostname}): ')
-            print(msg, *args)
-            sys.stdout.flush()
-        finally:
-            self.lock.release()
+        console.print(crayons.blue(f'({self.hostname}): '), *args)
+
+    def sample_vetoed(self, job: EncodeJob) -> bool:
+        """Encode samples of the job on the cluster manager, if its directive asks for it, and skip the job
+           if they predict the threshold will not be met
+        """
+        if pytranscoder.dry_run:
+            return False
+        vetoed = predict_vetoed(self.configfile.ffmpeg_path, self.configfile, job.inpath, job.media_info,
+                                job.directive, job.mixins, job.timing, self.log)
+        if vetoed:
+            metrics.job_vetoed(self.hostname)
+            journal.job('vetoed', self.hostname, job.inpath, job.timing, reason='predicted',
+                        predicted_comp=job.timing.predicted_comp)
+            self.complete(job.inpath, 0, job.timing)
+        return vetoed
 
     def testrun(self):
         pass
@@ -258,159 +370,401 @@ class ManagedHost(Thread):
         pass
 
 
+class AgentSession(Session):
+    """Persistent, multiplexed connection from the cluster manager to one agent, shared by all its slot threads.
+       Heartbeats keep the agent report current and detect a dead agent within heartbeat_timeout seconds.
+    """
+
+    def __init__(self, props: RemoteHostProperties, sock):
+        super().__init__(sock, props.heartbeat_timeout)
+        self.props = props
+        self.report: Optional[Dict] = None
+        self.reported = Event()
+        self.channel_lock = Lock()
+        self.next_channel = 1
+
+    @staticmethod
+    def open(props: RemoteHostProperties):
+        """Connect and handshake, returning the new session or None if the agent is not available"""
+        try:
+            sock = socket.create_connection((props.ip, 9567), timeout=5)
+        except OSError:
+            return None
+        session = AgentSession(props, sock)
+        session.start_reader()
+        try:
+            session.send_control(f"SESSION|{props.working_dir}|{props.ffmpeg_path}|{props.heartbeat_timeout}")
+        except OSError:
+            return None
+        if not session.reported.wait(5):
+            session.close()
+            return None
+        Thread(target=session.heartbeat, name=f'{props.name}-heartbeat', daemon=True).start()
+        return session
+
+    def heartbeat(self):
+        while not self.closed.wait(self.props.heartbeat_interval):
+            try:
+                self.send_control("HBEAT")
+            except OSError:
+                break
+
+    def on_control(self, msg: str):
+        if msg.startswith("PONG|"):
+            self.report = json.loads(msg[5:])
+            self.reported.set()
+
+    def open_channel(self) -> Channel:
+        with self.channel_lock:
+            channel_id = self.next_channel
+            self.next_channel += 1
+        return self.add_channel(channel_id)
+
+
 class AgentManagedHost(ManagedHost):
     """Implementation of a agent host worker thread"""
 
     def __init__(self, hostname, props: RemoteHostProperties, queue: Queue, cluster):
         super().__init__(hostname, props, queue, cluster)
+        self.testing = False
 
     #
     # initiate tests through here to avoid a new thread
     #
     def testrun(self):
+        self.testing = True
         self.go()
 
     #
-    # normal threaded entry point
+    # normal threaded entry point, availability already checked by Cluster.plan_agent_capacity()
     #
     def run(self):
-        if self.host_ok():
-            self.go()
-        else:
-            self.log(f"{self.props.name} not available")
+        self.go()
 
     def go(self):
 
         while not self.queue.empty():
+            batch: List[EncodeJob] = []
             try:
                 job: EncodeJob = self.queue.get()
-                inpath = job.inpath
+                job.timing.dequeued()
+                batch.append(job)
+                if self.sample_vetoed(job):
+                    continue
 
-                #
-                # build command line
-                #
+                if not pytranscoder.dry_run and not self.testing:
+                    if self.is_small(job):
+                        batch.extend(self.collect_batch())
+                    report = self.fetch_report()
+                    needed_mb = sum([j.media_info.filesize_mb * 2 for j in batch])
+                    if report is None or not self.scratch_ok(report, needed_mb):
+                        # leave the jobs to other hosts and stop taking work
+                        self.log(crayons.yellow(f'Agent unavailable or low on scratch space, '
+                                                f'returning {len(batch)} file(s) to queue'))
+                        for j in batch:
+                            j.timing.queued()
+                            self.queue.put(j)
+                        return
+
+                if len(batch) > 1:
+                    if not self.process_batch(batch):
+                        return
+                elif not self.process(job):
+                    return
 
-                remote_inpath = inpath
+            except Exception as ex:
+                self.log(ex)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
 
-                stream_map = []
-                if job.media_info.is_multistream() and self._manager.config.automap:
-                    stream_map = job.directive.stream_map(job.media_info.stream, job.media_info.audio,
-                                                          job.media_info.subtitle)
+    def is_small(self, job: EncodeJob) -> bool:
+        """Check if a job is small enough to be batched with others, per batch_max_mb and batch_max_runtime"""
+        if self.props.batch_size < 2:
+            return False
+        if self.props.batch_max_mb and job.media_info.filesize_mb <= self.props.batch_max_mb:
+            return True
+        if self.props.batch_max_runtime and 0 < job.media_info.runtime <= self.props.batch_max_runtime:
+            return True
+        return False
 
-                cmd = [self.props.ffmpeg_path, '-y', *job.directive.input_options_list(), '-i', '{FILENAME}',
-                       *job.directive.output_options_list(self._manager.config, job.mixins), *stream_map]
+    def collect_batch(self) -> List[EncodeJob]:
+        """Take more small jobs from the queue, up to batch_size in total, stopping at the first large one"""
+        jobs = []
+        while len(jobs) < self.props.batch_size - 1:
+            try:
+                job = self.queue.get_nowait()
+            except Empty:
+                break
+            if not self.is_small(job):
+                self.queue.put(job)
+                self.queue.task_done()
+                break
+            job.timing.dequeued()
+            jobs.append(job)
+        return jobs
 
-                #
-                # display useful information
-                #
-                self.lock.acquire()
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (agent)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Directive: {job.directive.name()}')
-                    print('Command  : ' + ' '.join(cmd) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
-                    continue
+    def build_command(self, job: EncodeJob) -> List[str]:
+        stream_map = stream_options(job.directive, job.media_info, self._manager.config.automap)
 
-                basename = os.path.basename(job.inpath)
+        cmd = [self.props.ffmpeg_path, '-y', *PROGRESS_OPTIONS, *job.directive.input_options_list(),
+               '-i', '{FILENAME}', *job.directive.output_options_list(self._manager.config, job.mixins), *stream_map]
 
-                def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.media_info, stats)
-                    pytranscoder.status_queue.put({'host': self.hostname,
-                                                   'file': basename,
-                                                   'speed': stats['speed'],
-                                                   'comp': pct_comp,
-                                                   'done': pct_done})
+        #
+        # display useful information
+        #
+        console.print('-' * 40,
+                      f'Host     : {self.hostname} (agent)',
+                      'Filename : ' + crayons.green(os.path.basename(job.inpath)),
+                      f'Directive: {job.directive.name()}{predicted_note(job.timing)}',
+                      'Command  : ' + ' '.join(cmd) + '\n', sep='\n')
+        return cmd
 
-                    if job.should_abort(pct_done):
-                        # compression goal (threshold) not met, kill the job and waste no more time...
-                        self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
-                        return True
-                    return False
+    def process(self, job: EncodeJob) -> bool:
+        """Upload, transcode and retrieve a single file.
 
-                #
-                # Send to agent
-                #
-                s = socket.socket()
+        :return: False if the agent session was lost and the job returned to the queue
+        """
+        cmd = self.build_command(job)
+        if pytranscoder.dry_run:
+            return True
 
-                if self._manager.verbose:
-                    self.log(f"connect to '{self.props.ip}'")
+        journal.job('started', self.hostname, job.inpath, job.timing)
+        try:
+            with job.timing.phase('upload'):
+                channel = self.upload(job.inpath, os.path.basename(job.inpath), cmd)
+        except ConnectionError:
+            self.requeue(job)
+            return False
+        if channel is None:
+            self.log(crayons.red(f'Unable to transfer {job.inpath} to agent - media skipped'))
+            return True
+        return self.finish(job, channel)
 
-                s.connect((self.props.ip, 9567))
-                inputsize = os.path.getsize(inpath)
-                tmpdir = self.props.working_dir
-                cmd_str = "$".join(cmd)
-                hello = f"HELLO|{inputsize}|{tmpdir}|{basename}|{cmd_str}"
-                if self._manager.verbose:
-                    self.log("handshaking")
-                s.send(bytes(hello.encode()))
-                rsp = s.recv(1024).decode()
-                if rsp != hello:
-                    self.log("Received unexpected response from agent: " + rsp)
-                    continue
-                # send the file
-                self.log(f"sending {inpath}")
-                with open(inpath, "rb") as f:
-                    while True:
-                        buf = f.read(1_000_000)
-                        s.send(buf)
-                        if len(buf) < 1_000_000:
-                            break
+    def requeue(self, job: EncodeJob):
+        """Agent session lost, let another host have the job"""
+        self.log(crayons.yellow(f'Lost session with agent, returning {job.inpath} to queue'))
+        job.timing.queued()
+        self.queue.put(job)
 
-                job_start = datetime.datetime.now()
-                finished, stats = self.ffmpeg.monitor_agent_ffmpeg(s, log_callback, self.ffmpeg.monitor_agent)
-                job_stop = datetime.datetime.now()
+    def process_batch(self, batch: List[EncodeJob]) -> bool:
+        """Upload a batch of small files back-to-back, without waiting for each to be transcoded.
 
-                try:
-                    if finished:
-                        parts = stats.split(r"|")
-                        if parts[0] == "DONE":
-                            s.send(bytes("ACK!".encode()))
-                            tag, exitcode, sfilesize = parts
-                            filesize = int(sfilesize)
-                            tmpfile = inpath + ".tmp"
-                            if self._manager.verbose:
-                                self.log(f"receiving results ({filesize} bytes)")
-
-                            with open(tmpfile, "wb") as out:
-                                while filesize > 0:
-                                    blk = s.recv(1_000_000)
-                                    out.write(blk)
-                                    filesize -= len(blk)
-
-                            if not pytranscoder.keep_source:
-                                os.unlink(inpath)
-                                os.rename(tmpfile, inpath)
-                            self.log(crayons.green(f'Finished {inpath}'))
-                        elif parts[0] == "ERR":
-                            self.log(f"Agent returned process error code '{parts[1]}'")
-                        else:
-                            self.log(f"Unknown process code from agent: '{parts[0]}'")
-                        self.complete(inpath, (job_stop - job_start).seconds)
+        The agent encodes them in turn as they arrive, and the results of each are retrieved as soon as it is done.
 
-                except KeyboardInterrupt:
-                    s.send(bytes("STOP".encode()))
+        :return: False if the agent session was lost and the jobs returned to the queue
+        """
+        self.log(f'batching {len(batch)} small files')
+        finishers = []
+        outcomes = []
 
+        def finisher(j: EncodeJob, c: Channel):
+            try:
+                outcomes.append(self.finish(j, c))
             except Exception as ex:
                 self.log(ex)
-            finally:
-                self.queue.task_done()
 
-    def host_ok(self):
-        s = socket.socket()
-        s.connect((self.props.ip, 9567))
-        s.send(bytes("PING".encode()))
-        s.settimeout(5)
+        lost = False
+        for job in batch:
+            if lost:
+                self.requeue(job)
+                continue
+            cmd = self.build_command(job)
+            journal.job('started', self.hostname, job.inpath, job.timing)
+            try:
+                with job.timing.phase('upload'):
+                    channel = self.upload(job.inpath, os.path.basename(job.inpath), cmd)
+            except ConnectionError:
+                # this job and the rest of the batch go back to the queue
+                lost = True
+                self.requeue(job)
+                continue
+            if channel is None:
+                self.log(crayons.red(f'Unable to transfer {job.inpath} to agent - media skipped'))
+                continue
+            t = Thread(target=finisher, args=(job, channel), name=f'{self.hostname}-batch', daemon=True)
+            t.start()
+            finishers.append(t)
+        for t in finishers:
+            t.join()
+        return all(outcomes) and not lost
+
+    def finish(self, job: EncodeJob, channel: Channel) -> bool:
+        """Monitor the transcode of an uploaded file and retrieve the result.
+
+        :return: False if the agent session was lost and the job returned to the queue
+        """
+        inpath = job.inpath
+        basename = os.path.basename(inpath)
+
+        def log_callback(stats):
+            pct_done, pct_comp = calculate_progress(job.media_info, stats)
+            pytranscoder.status_queue.put({'host': self.hostname,
+                                           'file': basename,
+                                           'speed': stats['speed'],
+                                           'fps': stats.get('fps', 0),
+                                           'eta': calculate_eta(job.media_info, stats),
+                                           'comp': pct_comp,
+                                           'done': pct_done})
+            journal.job('progress', self.hostname, inpath, job.timing, speed=stats['speed'],
+                        fps=stats.get('fps', 0), comp=pct_comp, done=pct_done)
+
+            if job.should_abort(pct_done):
+                # compression goal (threshold) not met, kill the job and waste no more time...
+                self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
+                return True
+            return False
+
         try:
-            results = s.recv(4)
-            return results == "PONG"
-        except Exception:
+            job_start = datetime.datetime.now()
+            with job.timing.phase('encode'):
+                finished, stats = self.ffmpeg.monitor_agent_ffmpeg(channel, log_callback,
+                                                                   self.ffmpeg.monitor_agent)
+            job_stop = datetime.datetime.now()
+        except ConnectionError:
+            # agent stopped answering heartbeats
+            self.requeue(job)
             return False
 
+        try:
+            if finished:
+                parts = stats.split(r"|")
+                failed = True
+                if parts[0] == "DONE":
+                    send_msg(channel, "ACK!")
+                    tag, exitcode, sfilesize = parts[0:3]
+                    filesize = int(sfilesize)
+                    if len(parts) > 3:
+                        # resource usage of ffmpeg as measured by the agent
+                        job.timing.account(ResourceUsage.from_field(parts[3]))
+                    tmpfile = inpath + ".tmp"
+                    if self._manager.verbose:
+                        self.log(f"receiving results ({filesize} bytes)")
+
+                    manifest = TransferManifest(tmpfile, filesize, '')
+                    with job.timing.phase('download'):
+                        digests = receive_file(channel, manifest, persist=False)
+                        rsp = recv_msg(channel)
+                    if rsp != f"DIGEST|{file_digest(digests)}":
+                        self.log(crayons.red(f'Checksum mismatch receiving results for {inpath} - discarded'))
+                        metrics.job_failed(self.hostname)
+                        journal.job('failed', self.hostname, inpath, job.timing, reason='checksum mismatch')
+                        timings.record(inpath, self.hostname, job.timing, failed=True)
+                        manifest.remove()
+                    else:
+                        failed = False
+                        metrics.job_completed(self.hostname, os.path.getsize(inpath), filesize)
+                        job.set_encoded()
+                        log_prediction(self.log, job.timing, os.path.getsize(inpath), filesize)
+                        journal.job('completed', self.hostname, inpath, job.timing,
+                                    **completed_fields(job.timing, os.path.getsize(inpath), filesize))
+                        if not job.keep_source:
+                            with job.timing.phase('finalize'):
+                                os.unlink(inpath)
+                                os.rename(tmpfile, inpath)
+                        self.log(crayons.green(f'Finished {inpath}'))
+                elif parts[0] == "ERR":
+                    metrics.job_failed(self.hostname)
+                    journal.job('failed', self.hostname, inpath, job.timing, reason=f'error code {parts[1]}')
+                    timings.record(inpath, self.hostname, job.timing, failed=True)
+                    self.log(f"Agent returned process error code '{parts[1]}'")
+                else:
+                    metrics.job_failed(self.hostname)
+                    journal.job('failed', self.hostname, inpath, job.timing, reason=f'unknown code {parts[0]}')
+                    timings.record(inpath, self.hostname, job.timing, failed=True)
+                    self.log(f"Unknown process code from agent: '{parts[0]}'")
+                # failures are already in the timing log
+                self.complete(inpath, (job_stop - job_start).seconds, None if failed else job.timing)
+            else:
+                metrics.job_vetoed(self.hostname)
+                journal.job('vetoed', self.hostname, inpath, job.timing)
+
+        except KeyboardInterrupt:
+            send_msg(channel, "STOP")
+        finally:
+            channel.close()
+        return True
+
+    def upload(self, inpath: str, basename: str, cmd: List[str]) -> Optional[Channel]:
+        """Send the source media to the agent as checksummed chunks, on a new channel of the agent session.
+
+        The upload is skipped entirely if the agent already has the same content cached.
+        If the connection drops the transfer is retried, resuming from the last offset the agent confirmed.
+        The agent verifies the whole-file digest before it will run ffmpeg.
+
+        :return: Channel ready for monitoring the transcode, or None if the agent would not take the file
+        :raises ConnectionError: if the session could not be kept up for any of the attempts
+        """
+        inputsize = os.path.getsize(inpath)
+        fingerprint = sampled_fingerprint(inpath)
+        cmd_str = "$".join(cmd)
+        hello = f"HELLO|{inputsize}|{self.props.working_dir}|{basename}|{fingerprint}|{cmd_str}"
+        digests = None
+        lost = False
+        for attempt in range(1, self.props.transfer_retries + 1):
+            session = self._manager.agent_session(self.hostname, self.props)
+            if session is None:
+                self.log(crayons.yellow(f"Unable to reach agent (attempt {attempt})"))
+                lost = True
+                time.sleep(self.props.heartbeat_interval)
+                continue
+            channel = session.open_channel()
+            try:
+                if self._manager.verbose:
+                    self.log("handshaking")
+                send_msg(channel, hello)
+                rsp = recv_msg(channel)
+                if rsp == "CACHED":
+                    self.log(f"{basename} already cached on agent, upload skipped")
+                    self._manager.record_cache_lookup(self.hostname, True, inputsize)
+                    return channel
+                if not rsp.startswith("RESUME|"):
+                    self.log("Received unexpected response from agent: " + rsp)
+                    channel.close()
+                    return None
+                offset = int(rsp.split("|")[1])
+                if attempt == 1:
+                    self._manager.record_cache_lookup(self.hostname, False, inputsize)
+                if offset > 0:
+                    self.log(f"resuming transfer of {inpath} at {offset} of {inputsize} bytes")
+                else:
+                    self.log(f"sending {inpath}")
+                digests = send_file(channel, inpath, offset, digests)
+                if channel.inbox.empty():
+                    send_msg(channel, f"DIGEST|{file_digest(digests)}")
+                rsp = recv_msg(channel)
+                if rsp == "VERIFIED":
+                    return channel
+                self.log(crayons.yellow(f"Agent rejected transfer of {inpath}: {rsp}"))
+                lost = False
+            except OSError as ex:
+                self.log(crayons.yellow(f"Transfer of {inpath} interrupted (attempt {attempt}): {ex}"))
+                lost = True
+            channel.close()
+        if lost:
+            raise ConnectionError(f'transfer of {inpath} to {self.hostname} failed')
+        return None
+
+    def fetch_report(self) -> Optional[Dict]:
+        """Latest capability and load report of the agent (slots, cpus, load, ffmpeg version, scratch space),
+           kept current by session heartbeats
+        """
+        session = self._manager.agent_session(self.hostname, self.props)
+        if session is None:
+            return None
+        return session.report
+
+    def scratch_ok(self, report: Dict, needed_mb: float = 0) -> bool:
+        scratch_mb = report.get('scratch_mb', None)
+        if scratch_mb is None:
+            # agent could not check working_dir, let the transfer find out
+            return True
+        return scratch_mb - needed_mb >= self.props.min_scratch_mb
+
+    def host_ok(self):
+        report = self.fetch_report()
+        return report is not None and self.scratch_ok(report)
+
 
 class StreamingManagedHost(ManagedHost):
     """Implementation of a streaming host worker thread"""
@@ -442,6 +796,7 @@ class StreamingManagedHost(ManagedHost):
         while not self.queue.empty():
             try:
                 job: EncodeJob = self.queue.get()
+                job.timing.dequeued()
                 inpath = job.inpath
 
                 #
@@ -460,10 +815,7 @@ class StreamingManagedHost(ManagedHost):
                 #
                 # build remote commandline
                 #
-                stream_map = []
-                if job.media_info.is_multistream() and self._manager.config.automap:
-                    stream_map = job.directive.stream_map(job.media_info.stream, job.media_info.audio,
-                                                          job.media_info.subtitle)
+                stream_map = stream_options(job.directive, job.media_info, self._manager.config.automap)
 
                 cmd = ['-y', *job.directive.input_options_list(), '-i', self.converted_path(remote_inpath),
                        *job.directive.output_options_list(self._manager.config, job.mixins), *stream_map,
@@ -473,19 +825,17 @@ class StreamingManagedHost(ManagedHost):
                 #
                 # display useful information
                 #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (streaming)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Directive: {job.directive.name()}')
-                    print('ssh      : ' + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
+                console.print('-' * 40,
+                              f'Host     : {self.hostname} (streaming)',
+                              'Filename : ' + crayons.green(os.path.basename(remote_inpath)),
+                              f'Directive: {job.directive.name()}{predicted_note(job.timing)}',
+                              'ssh      : ' + ' '.join(cli) + '\n', sep='\n')
+
+                if pytranscoder.dry_run or self.sample_vetoed(job):
                     continue
 
+                journal.job('started', self.hostname, job.inpath, job.timing)
+
                 #
                 # Copy source file to remote
                 #
@@ -497,7 +847,8 @@ class StreamingManagedHost(ManagedHost):
                 scp = ['scp', inpath, self.props.user + '@' + self.props.ip + ':' + target_dir]
                 self.log(' '.join(scp))
 
-                code, output = run(scp)
+                with job.timing.phase('upload'):
+                    code, output = run(scp)
                 if code != 0:
                     self.log(crayons.red('Unknown error copying source to remote - media skipped'))
                     if self._manager.verbose:
@@ -511,8 +862,12 @@ class StreamingManagedHost(ManagedHost):
                     pytranscoder.status_queue.put({'host': self.hostname,
                                                    'file': basename,
                                                    'speed': stats['speed'],
+                                                   'fps': stats.get('fps', 0),
+                                                   'eta': calculate_eta(job.media_info, stats),
                                                    'comp': pct_comp,
                                                    'done': pct_done})
+                    journal.job('progress', self.hostname, job.inpath, job.timing, speed=stats['speed'],
+                                fps=stats.get('fps', 0), comp=pct_comp, done=pct_done)
                     if job.should_abort(pct_done):
                         # compression goal (threshold) not met, kill the job and waste no more time...
                         self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
@@ -523,7 +878,9 @@ class StreamingManagedHost(ManagedHost):
                 # Start remote
                 #
                 job_start = datetime.datetime.now()
-                code = self.ffmpeg.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, log_callback)
+                with job.timing.phase('encode'):
+                    code = self.ffmpeg.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd,
+                                                  log_callback)
                 job_stop = datetime.datetime.now()
 
                 #                if code != 0:
@@ -537,34 +894,55 @@ class StreamingManagedHost(ManagedHost):
                 cmd = ['scp', self.props.user + '@' + self.props.ip + ':' + remote_outpath, retrieved_copy_name]
                 self.log(' '.join(cmd))
 
-                code, output = run(cmd)
+                with job.timing.phase('download'):
+                    code, output = run(cmd)
 
                 #
                 # process completed, check results and finish
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
-                    self.complete(inpath, (job_stop - job_start).seconds)
+                    metrics.job_vetoed(self.hostname)
+                    journal.job('vetoed', self.hostname, job.inpath, job.timing)
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     os.remove(retrieved_copy_name)
                     continue
 
                 if code == 0:
-                    if not filter_threshold(job.directive, inpath, retrieved_copy_name):
+                    with job.timing.phase('threshold'):
+                        kept = filter_threshold(job.directive, inpath, retrieved_copy_name)
+                    if not kept:
                         self.log(
                             f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
+                        orig_size, new_size = os.path.getsize(inpath), os.path.getsize(retrieved_copy_name)
+                        log_prediction(self.log, job.timing, orig_size, new_size)
+                        metrics.job_vetoed(self.hostname)
+                        journal.job('vetoed', self.hostname, job.inpath, job.timing,
+                                    **completed_fields(job.timing, orig_size, new_size))
+                        self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                         os.remove(retrieved_copy_name)
                         continue
-                    self.complete(inpath, (job_stop - job_start).seconds)
-
-                    if not pytranscoder.keep_source:
-                        os.rename(retrieved_copy_name, retrieved_copy_name[0:-4])
-                        retrieved_copy_name = retrieved_copy_name[0:-4]
-                        if verbose:
-                            self.log(f'moving media to {inpath}')
-                        shutil.move(retrieved_copy_name, inpath)
+                    metrics.job_completed(self.hostname, os.path.getsize(inpath), os.path.getsize(retrieved_copy_name))
+                    job.set_encoded()
+                    log_prediction(self.log, job.timing, os.path.getsize(inpath),
+                                   os.path.getsize(retrieved_copy_name))
+                    journal.job('completed', self.hostname, job.inpath, job.timing,
+                                **completed_fields(job.timing, os.path.getsize(inpath),
+                                                   os.path.getsize(retrieved_copy_name)))
+
+                    if not job.keep_source:
+                        with job.timing.phase('finalize'):
+                            os.rename(retrieved_copy_name, retrieved_copy_name[0:-4])
+                            retrieved_copy_name = retrieved_copy_name[0:-4]
+                            if verbose:
+                                self.log(f'moving media to {inpath}')
+                            shutil.move(retrieved_copy_name, inpath)
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     self.log(crayons.green(f'Finished {inpath}'))
                 elif code is not None:
+                    metrics.job_failed(self.hostname)
+                    journal.job('failed', self.hostname, job.inpath, job.timing, reason=f'exit code {code}')
+                    timings.record(job.inpath, self.hostname, job.timing, failed=True)
                     self.log(crayons.red(f'error during remote transcode of {inpath}'))
                     self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
@@ -610,6 +988,7 @@ class MountedManagedHost(ManagedHost):
         while not self.queue.empty():
             try:
                 job: EncodeJob = self.queue.get()
+                job.timing.dequeued()
                 inpath = job.inpath
 
                 #
@@ -630,10 +1009,7 @@ class MountedManagedHost(ManagedHost):
                 remote_inpath = self.converted_path(remote_inpath)
                 remote_outpath = self.converted_path(remote_outpath)
 
-                stream_map = []
-                if job.media_info.is_multistream() and self._manager.config.automap:
-                    stream_map = job.directive.stream_map(job.media_info.stream, job.media_info.audio,
-                                                          job.media_info.subtitle)
+                stream_map = stream_options(job.directive, job.media_info, self._manager.config.automap)
                 cmd = ['-y', *job.directive.input_options_list(), '-i', f'"{remote_inpath}"',
                        *job.directive.output_options_list(self._manager.config, job.mixins), *stream_map,
                        f'"{remote_outpath}"']
@@ -641,20 +1017,17 @@ class MountedManagedHost(ManagedHost):
                 #
                 # display useful information
                 #
-                self.lock.acquire()
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (mounted)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-
-                    print(f'Directive: {job.directive.name()}')
-                    print('ssh      : ' + ' '.join(cmd) + '\n')
-                finally:
-                    self.lock.release()
+                console.print('-' * 40,
+                              f'Host     : {self.hostname} (mounted)',
+                              'Filename : ' + crayons.green(os.path.basename(remote_inpath)),
+                              f'Directive: {job.directive.name()}{predicted_note(job.timing)}',
+                              'ssh      : ' + ' '.join(cmd) + '\n', sep='\n')
 
-                if pytranscoder.dry_run:
+                if pytranscoder.dry_run or self.sample_vetoed(job):
                     continue
 
+                journal.job('started', self.hostname, job.inpath, job.timing)
+
                 basename = os.path.basename(job.inpath)
 
                 def log_callback(stats):
@@ -662,8 +1035,12 @@ class MountedManagedHost(ManagedHost):
                     pytranscoder.status_queue.put({'host': self.hostname,
                                                    'file': basename,
                                                    'speed': stats['speed'],
+                                                   'fps': stats.get('fps', 0),
+                                                   'eta': calculate_eta(job.media_info, stats),
                                                    'comp': pct_comp,
                                                    'done': pct_done})
+                    journal.job('progress', self.hostname, job.inpath, job.timing, speed=stats['speed'],
+                                fps=stats.get('fps', 0), comp=pct_comp, done=pct_done)
 
                     if job.should_abort(pct_done):
                         # compression goal (threshold) not met, kill the job and waste no more time...
@@ -675,7 +1052,9 @@ class MountedManagedHost(ManagedHost):
                 # Start remote
                 #
                 job_start = datetime.datetime.now()
-                code = self.ffmpeg.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, log_callback)
+                with job.timing.phase('encode'):
+                    code = self.ffmpeg.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd,
+                                                  log_callback)
                 job_stop = datetime.datetime.now()
 
                 #
@@ -683,28 +1062,45 @@ class MountedManagedHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
-                    self.complete(inpath, (job_stop - job_start).seconds)
+                    metrics.job_vetoed(self.hostname)
+                    journal.job('vetoed', self.hostname, job.inpath, job.timing)
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     os.remove(outpath)
                     continue
 
                 if code == 0:
-                    if not filter_threshold(job.directive, inpath, outpath):
+                    with job.timing.phase('threshold'):
+                        kept = filter_threshold(job.directive, inpath, outpath)
+                    if not kept:
                         self.log(
                             f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
+                        log_prediction(self.log, job.timing, os.path.getsize(inpath), os.path.getsize(outpath))
+                        metrics.job_vetoed(self.hostname)
+                        journal.job('vetoed', self.hostname, job.inpath, job.timing,
+                                    **completed_fields(job.timing, os.path.getsize(inpath), os.path.getsize(outpath)))
+                        self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                         os.remove(outpath)
                         continue
 
-                    if not pytranscoder.keep_source:
-                        if verbose:
-                            self.log('removing ' + inpath)
-                        os.remove(inpath)
-                        if verbose:
-                            self.log('renaming ' + outpath)
-                        os.rename(outpath, outpath[0:-4])
-                        self.complete(inpath, (job_stop - job_start).seconds)
+                    metrics.job_completed(self.hostname, os.path.getsize(inpath), os.path.getsize(outpath))
+                    job.set_encoded()
+                    log_prediction(self.log, job.timing, os.path.getsize(inpath), os.path.getsize(outpath))
+                    journal.job('completed', self.hostname, job.inpath, job.timing,
+                                **completed_fields(job.timing, os.path.getsize(inpath), os.path.getsize(outpath)))
+                    if not job.keep_source:
+                        with job.timing.phase('finalize'):
+                            if verbose:
+                                self.log('removing ' + inpath)
+                            os.remove(inpath)
+                            if verbose:
+                                self.log('renaming ' + outpath)
+                            os.rename(outpath, outpath[0:-4])
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     self.log(crayons.green(f'Finished {job.inpath}'))
                 elif code is not None:
+                    metrics.job_failed(self.hostname)
+                    journal.job('failed', self.hostname, job.inpath, job.timing, reason=f'exit code {code}')
+                    timings.record(job.inpath, self.hostname, job.timing, failed=True)
                     self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -742,6 +1138,7 @@ class LocalHost(ManagedHost):
         while not self.queue.empty():
             try:
                 job: EncodeJob = self.queue.get()
+                job.timing.dequeued()
                 inpath = job.inpath
 
                 #
@@ -755,10 +1152,7 @@ class LocalHost(ManagedHost):
                 remote_inpath = self.converted_path(inpath)
                 remote_outpath = self.converted_path(outpath)
 
-                stream_map = []
-                if job.media_info.is_multistream() and self._manager.config.automap:
-                    stream_map = job.directive.stream_map(job.media_info.stream, job.media_info.audio,
-                                                          job.media_info.subtitle)
+                stream_map = stream_options(job.directive, job.media_info, self._manager.config.automap)
                 cli = ['-y', *job.directive.input_options_list(), '-i', remote_inpath,
                        *job.directive.output_options_list(self._manager.config, job.mixins), *stream_map,
                        remote_outpath]
@@ -766,28 +1160,30 @@ class LocalHost(ManagedHost):
                 #
                 # display useful information
                 #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (local)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Directive: {job.directive.name()}')
-                    print('ffmpeg   : ' + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
+                console.print('-' * 40,
+                              f'Host     : {self.hostname} (local)',
+                              'Filename : ' + crayons.green(os.path.basename(remote_inpath)),
+                              f'Directive: {job.directive.name()}{predicted_note(job.timing)}',
+                              'ffmpeg   : ' + ' '.join(cli) + '\n', sep='\n')
+
+                if pytranscoder.dry_run or self.sample_vetoed(job):
                     continue
 
+                journal.job('started', self.hostname, job.inpath, job.timing)
+
                 basename = os.path.basename(job.inpath)
 
                 def log_callback(stats):
                     pct_done, pct_comp = calculate_progress(job.media_info, stats)
-                    pytranscoder.status_queue.put({'host': 'local',
+                    pytranscoder.status_queue.put({'host': self.hostname,
                                                    'file': basename,
                                                    'speed': stats['speed'],
+                                                   'fps': stats.get('fps', 0),
+                                                   'eta': calculate_eta(job.media_info, stats),
                                                    'comp': pct_comp,
                                                    'done': pct_done})
+                    journal.job('progress', self.hostname, job.inpath, job.timing, speed=stats['speed'],
+                                fps=stats.get('fps', 0), comp=pct_comp, done=pct_done)
 
                     if job.should_abort(pct_done):
                         # compression goal (threshold) not met, kill the job and waste no more time...
@@ -799,7 +1195,9 @@ class LocalHost(ManagedHost):
                 # Start process
                 #
                 job_start = datetime.datetime.now()
-                code = self.ffmpeg.run(cli, log_callback)
+                with job.timing.phase('encode'):
+                    code = self.ffmpeg.run(cli, log_callback)
+                job.timing.account(self.ffmpeg.last_usage)
                 job_stop = datetime.datetime.now()
 
                 #
@@ -807,28 +1205,45 @@ class LocalHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
-                    self.complete(inpath, (job_stop - job_start).seconds)
+                    metrics.job_vetoed(self.hostname)
+                    journal.job('vetoed', self.hostname, job.inpath, job.timing)
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     os.remove(outpath)
                     continue
 
                 if code == 0:
-                    if not filter_threshold(job.directive, inpath, outpath):
+                    with job.timing.phase('threshold'):
+                        kept = filter_threshold(job.directive, inpath, outpath)
+                    if not kept:
                         self.log(
                             f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
+                        log_prediction(self.log, job.timing, os.path.getsize(inpath), os.path.getsize(outpath))
+                        metrics.job_vetoed(self.hostname)
+                        journal.job('vetoed', self.hostname, job.inpath, job.timing,
+                                    **completed_fields(job.timing, os.path.getsize(inpath), os.path.getsize(outpath)))
+                        self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                         os.remove(outpath)
                         continue
 
-                    if not pytranscoder.keep_source:
-                        if verbose:
-                            self.log('removing ' + inpath)
-                        os.remove(inpath)
-                        if verbose:
-                            self.log('renaming ' + outpath)
-                        os.rename(outpath, outpath[0:-4])
-                        self.complete(inpath, (job_stop - job_start).seconds)
+                    metrics.job_completed(self.hostname, os.path.getsize(inpath), os.path.getsize(outpath))
+                    job.set_encoded()
+                    log_prediction(self.log, job.timing, os.path.getsize(inpath), os.path.getsize(outpath))
+                    journal.job('completed', self.hostname, job.inpath, job.timing,
+                                **completed_fields(job.timing, os.path.getsize(inpath), os.path.getsize(outpath)))
+                    if not job.keep_source:
+                        with job.timing.phase('finalize'):
+                            if verbose:
+                                self.log('removing ' + inpath)
+                            os.remove(inpath)
+                            if verbose:
+                                self.log('renaming ' + outpath)
+                            os.rename(outpath, outpath[0:-4])
+                    self.complete(inpath, (job_stop - job_start).seconds, job.timing)
                     self.log(crayons.green(f'Finished {job.inpath}'))
                 elif code is not None:
+                    metrics.job_failed(self.hostname)
+                    journal.job('failed', self.hostname, job.inpath, job.timing, reason=f'exit code {code}')
+                    timings.record(job.inpath, self.hostname, job.timing, failed=True)
                     self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -845,8 +1260,6 @@ class LocalHost(ManagedHost):
 class Cluster(Thread):
     """Thread to create host threads and wait for their completion."""
 
-    terminal_lock: Lock = Lock()  # class-level
-
     def __init__(self, name, configs: Dict, config: ConfigFile, ssh: str):
         """
         :param name:        Cluster name, used only for thread naming
@@ -857,14 +1270,23 @@ class Cluster(Thread):
         super().__init__(name=name, group=None, daemon=True)
         self.queues: Dict[str, Queue] = dict()
         self.ssh = ssh
-        self.hosts: List[ManagedHost] = list()
+        self.configs = configs
         self.config = config
         self.verbose = verbose
         self.ffmpeg = FFmpeg(config.ffmpeg_path)
-        self.lock = Cluster.terminal_lock
         self.completed: List = list()
-
-        for host, props in configs.items():
+        self.cache_stats: Dict[str, Dict] = dict()
+        self.cache_stats_lock = Lock()
+        self.agent_sessions: Dict[str, AgentSession] = dict()
+        self.agent_sessions_lock = Lock()
+        self.aggregator: Optional[StatusAggregator] = None
+        self.chunked: List[ChunkedJob] = list()
+        self.hosts: List[ManagedHost] = self.create_hosts()
+
+    def create_hosts(self) -> List[ManagedHost]:
+        """One thread per slot of each queue of each enabled host"""
+        hosts: List[ManagedHost] = list()
+        for host, props in self.configs.items():
             hostprops = RemoteHostProperties(host, props)
             if not hostprops.is_enabled:
                 continue
@@ -890,7 +1312,7 @@ class Cluster(Thread):
                         _h = LocalHost(host, hostprops, self.queues[host_queue], self)
                         if not _h.validate_settings():
                             sys.exit(1)
-                        self.hosts.append(_h)
+                        hosts.append(_h)
 
             elif hosttype == 'mounted':
                 for host_queue, slots in host_queues.items():
@@ -901,7 +1323,7 @@ class Cluster(Thread):
                         _h = MountedManagedHost(host, hostprops, self.queues[host_queue], self)
                         if not _h.validate_settings():
                             sys.exit(1)
-                        self.hosts.append(_h)
+                        hosts.append(_h)
 
             elif hosttype == 'streaming':
                 for host_queue, slots in host_queues.items():
@@ -912,7 +1334,7 @@ class Cluster(Thread):
                         _h = StreamingManagedHost(host, hostprops, self.queues[host_queue], self)
                         if not _h.validate_settings():
                             sys.exit(1)
-                        self.hosts.append(_h)
+                        hosts.append(_h)
 
             elif hosttype == 'agent':
                 for host_queue, slots in host_queues.items():
@@ -923,10 +1345,51 @@ class Cluster(Thread):
                         _h = AgentManagedHost(host, hostprops, self.queues[host_queue], self)
                         if not _h.validate_settings():
                             sys.exit(1)
-                        self.hosts.append(_h)
+                        hosts.append(_h)
 
             else:
                 print(crayons.red(f'Unknown cluster host type "{hosttype}" - skipping'))
+        return hosts
+
+    def match(self, path: str, media_info: MediaInfo, forced_directive: Optional[str],
+              timing: JobTiming) -> Tuple[Optional[Directives], Optional[Rule]]:
+        """Select the directive for a media file, from the forced one or the rules, reporting why if there is none
+
+        :return: The directive (None if the file is skipped) and the rule that matched
+        """
+        rule = None
+        if forced_directive is None:
+            #
+            # just interested in SKIP rule matches and queue designations here
+            #
+
+            with timing.phase('match'):
+                rule = self.config.match_rule(media_info)
+            if rule is None:
+                print(crayons.yellow(f'No matching profile found - skipped'))
+                return None, None
+            if rule.is_skip():
+                basename = os.path.basename(path)
+                print(f'{basename}: Skipping due to profile rule - {rule.name}')
+                return None, None
+            if is_multi(rule.profile):
+                print(crayons.red('Error: ') + f'Multiple outputs ({rule.profile}) are only supported in local mode')
+                return None, None
+            directive = self.directives[rule.profile]
+        else:
+            if forced_directive in self.directives:
+                directive = self.directives[forced_directive]
+            elif is_multi(forced_directive):
+                print(crayons.red('Error: ') + f'Multiple outputs ({forced_directive}) are only supported in local mode')
+                return None, None
+            else:
+                print(f"{forced_directive} not found")
+                return None, None
+
+        directive = select_directive(directive, media_info, self.config, rule)
+        if pytranscoder.verbose:
+            print(f"Matched to profile {directive.name()}")
+        return directive, rule
 
     def enqueue(self, file, forced_directive: Optional[str]):
         """Add a media file to this cluster queue.
@@ -938,40 +1401,31 @@ class Cluster(Thread):
         if pytranscoder.verbose:
             print('matching ' + path)
 
-        media_info = self.ffmpeg.fetch_details(path)
+        timing = JobTiming()
+        with timing.phase('probe'):
+            media_info = self.ffmpeg.fetch_details(path)
 
         if media_info is None:
             print(crayons.red(f'File not found: {path}'))
             return None, None
         if media_info.valid:
-            directive = None
-
             if pytranscoder.verbose:
                 print(str(media_info))
 
-            if forced_directive is None:
-                #
-                # just interested in SKIP rule matches and queue designations here
-                #
-
-                rule = self.config.match_rule(media_info)
-                if rule is None:
-                    print(crayons.yellow(f'No matching profile found - skipped'))
-                    return None, None
-                if rule.is_skip():
-                    basename = os.path.basename(path)
-                    print(f'{basename}: Skipping due to profile rule - {rule.name}')
+            directive, rule = self.match(path, media_info, forced_directive, timing)
+            if directive is None:
+                return None, None
+            journal.event('matched', file=path, directive=directive.name(), size_mb=media_info.filesize_mb,
+                          rule=rule.name if rule is not None else None,
+                          remux=isinstance(directive, RemuxDirective))
+            if not isinstance(directive, RemuxDirective):
+                history.apply(timing, media_info, directive.name())
+                if history_vetoed(directive, timing):
+                    print(f'{os.path.basename(path)}: Skipping, history predicts {timing.predicted_saved}% saved')
+                    journal.event('vetoed', file=path, directive=directive.name(), reason='history',
+                                  predicted_saved=timing.predicted_saved)
                     return None, None
-                directive = self.directives[rule.profile]
-            else:
-                if forced_directive in self.directives:
-                    directive = self.directives[forced_directive]
-                else:
-                    print(f"{forced_directive} not found")
-                    return None, None
-
-            if pytranscoder.verbose:
-                print(f"Matched to profile {directive.name()}")
+                directive = apply_crop(self.config, path, media_info, directive, timing)
 
             # not short circuited by a skip rule, add to appropriate queue
             queue_name = directive.queue_name() if directive.queue_name() is not None else '_default'
@@ -979,34 +1433,241 @@ class Cluster(Thread):
                 print(crayons.red('Error: ') +
                       f'Queue "{queue_name}" referenced in "{directive.name()}" not defined in any host')
                 exit(1)
-            job = EncodeJob(file, media_info, directive, None)
+            job = EncodeJob(file, media_info, directive, None, timing)
+            if use_segments(directive, media_info) and not pytranscoder.dry_run:
+                return self.enqueue_segments(queue_name, job)
+            job.timing.queued()
             self.queues[queue_name].put(job)
+            journal.event('enqueued', file=path, directive=directive.name(), queue=queue_name, cluster=self.name)
             return queue_name, job
         return None, None
 
+    def enqueue_segments(self, queue_name: str, job: EncodeJob):
+        """Split the job into video segments next to the source and queue them as separate jobs"""
+        inpath = job.inpath
+        outpath = inpath[0:inpath.rfind('.')] + job.directive.extension() + '.tmp'
+        encoder = SegmentedEncode(self.config.ffmpeg_path, self.config, inpath, outpath, job.media_info,
+                                  job.directive, job.mixins, distributed=True)
+        paths = encoder.split()
+        if not paths:
+            print(crayons.red(f'Unable to split {inpath} into segments - skipped'))
+            shutil.rmtree(encoder.workdir, ignore_errors=True)
+            return None, None
+
+        chunked = ChunkedJob(job, encoder)
+        segment_directive = SegmentDirective(job.directive)
+        for path in paths:
+            segment = EncodeJob(path, self.ffmpeg.fetch_details(path), segment_directive, job.mixins)
+            segment.chunk = chunked
+            chunked.segments.append(segment)
+            if encoder.is_done(path):
+                # encoded before an earlier run was interrupted
+                segment.encoded = True
+                continue
+            segment.attempts = 1
+            segment.timing.queued()
+            self.queues[queue_name].put(segment)
+        self.chunked.append(chunked)
+        journal.event('enqueued', file=inpath, directive=job.directive.name(), queue=queue_name, cluster=self.name,
+                      segments=len(paths))
+        print(f'{os.path.basename(inpath)}: split into {len(paths)} segments')
+        if encoder.resumed > 0:
+            print(f'{os.path.basename(inpath)}: resuming, {encoder.resumed} part(s) already encoded')
+        return queue_name, job
+
+    def merge_segments(self, chunked: ChunkedJob):
+        """Join the encoded segments of a chunked job and finish it as the hosts finish a job"""
+        job = chunked.job
+        inpath = job.inpath
+        outpath = chunked.encoder.outpath
+        with job.timing.phase('finalize'):
+            code = chunked.merge()
+        chunked.encoder.cleanup(failed=code != 0)
+        job.timing.account(chunked.encoder.last_usage)
+
+        if code is None:
+            failed = len([segment for segment in chunked.segments if not segment.encoded])
+            metrics.job_failed(self.name)
+            journal.job('failed', self.name, inpath, job.timing, reason=f'{failed} segment(s) not encoded')
+            timings.record(inpath, self.name, job.timing, failed=True)
+            console.print(crayons.red(f'{failed} segment(s) of {inpath} could not be encoded - skipped'))
+        elif code != 0:
+            metrics.job_failed(self.name)
+            journal.job('failed', self.name, inpath, job.timing, reason=f'merge exit code {code}')
+            timings.record(inpath, self.name, job.timing, failed=True)
+            console.print(crayons.red(f'Merging segments of {inpath} did not complete normally: '
+                                      f'{chunked.encoder.last_command}'),
+                          f'Output can be found in {chunked.encoder.log_path}', sep='\n')
+            if os.path.exists(outpath):
+                os.remove(outpath)
+        elif not filter_threshold(job.directive, inpath, outpath):
+            console.print(f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
+            metrics.job_vetoed(self.name)
+            journal.job('vetoed', self.name, inpath, job.timing)
+            timings.record(inpath, self.name, job.timing)
+            self.completed.append((inpath, 0))
+            os.remove(outpath)
+        else:
+            metrics.job_completed(self.name, os.path.getsize(inpath), os.path.getsize(outpath))
+            journal.job('completed', self.name, inpath, job.timing,
+                        **completed_fields(job.timing, os.path.getsize(inpath), os.path.getsize(outpath)))
+            if not job.keep_source:
+                os.remove(inpath)
+                os.rename(outpath, outpath[0:-4])
+            timings.record(inpath, self.name, job.timing)
+            self.completed.append((inpath, 0))
+            console.print(crayons.green(f'Finished {inpath} ({len(chunked.segments)} segments)'))
+
     def testrun(self):
         for host in self.hosts:
             host.testrun()
 
     def run(self):
+        try:
+            self.go()
+        finally:
+            if self.aggregator is not None:
+                self.aggregator.worker_finished()
+
+    def go(self):
         """Start all host threads and wait until queue is drained"""
 
+        self.plan_agent_capacity()
+
         if len(self.hosts) == 0:
-            print(f'No hosts available in cluster "{self.name}"')
+            console.print(f'No hosts available in cluster "{self.name}"')
             return
 
-        for host in self.hosts:
-            host.start()
+        if history.enabled:
+            for queue in self.queues.values():
+                order_queue(queue, lambda job: job.media_info.filesize_mb, lambda job: job.timing)
+
+        for chunked in self.chunked:
+            chunked.start_other_streams()
+
+        rounds = 0
+        while True:
+            encoded = self.encoded_segments()
+            for host in self.hosts:
+                host.start()
+
+            # all hosts running, wait for them to finish
+            for host in self.hosts:
+                host.join()
+                self.completed.extend([done for done in host.completed if not self.is_segment(done[0])])
+            rounds += 1
+
+            #
+            # failed segments of chunked jobs get another round, on fresh host threads
+            #
+            retries = [segment for chunked in self.chunked for segment in chunked.retries()]
+            if len(retries) == 0:
+                break
+            # jobs no host took, the hosts gave up before reaching them
+            untaken = self.drain_queues()
+            failed = [segment for segment in retries if not any([segment is job for _, job in untaken])]
+            if len(failed) == 0 and self.encoded_segments() == encoded:
+                console.print(crayons.red(f'No host took any of the {len(retries)} remaining segment(s) - giving up'))
+                break
+            if rounds >= SEGMENT_ROUNDS:
+                break
+            console.print(f'Retrying {len(retries)} segment(s)')
+            for queue, job in untaken:
+                queue.put(job)
+            for segment in failed:
+                segment.attempts += 1
+                segment.timing.queued()
+                self.queues[segment.directive.queue_name() or '_default'].put(segment)
+            self.hosts = self.create_hosts()
+            self.plan_agent_capacity()
+            if len(self.hosts) == 0:
+                break
 
-        # all hosts running, wait for them to finish
+        for chunked in self.chunked:
+            self.merge_segments(chunked)
+
+        for session in self.agent_sessions.values():
+            session.close()
+        self.dump_cache_stats()
+
+    def agent_session(self, hostname: str, props: RemoteHostProperties) -> Optional[AgentSession]:
+        """Session shared by all threads of an agent host, reconnecting if the previous one died"""
+        with self.agent_sessions_lock:
+            session = self.agent_sessions.get(hostname, None)
+            if session is None or session.closed.is_set():
+                session = AgentSession.open(props)
+                if session is None:
+                    return None
+                self.agent_sessions[hostname] = session
+            return session
+
+    def plan_agent_capacity(self):
+        """Query each agent once and start only as many of its threads as it has free slots.
+           Agents that are down or short on scratch space are dropped from this run.
+        """
+        agents: Dict[str, List[AgentManagedHost]] = dict()
         for host in self.hosts:
-            host.join()
-            self.completed.extend(host.completed)
+            if isinstance(host, AgentManagedHost):
+                agents.setdefault(host.hostname, []).append(host)
+
+        for hostname, threads in agents.items():
+            report = threads[0].fetch_report()
+            if report is None:
+                console.print(crayons.yellow(f'{hostname}: agent not available - skipped'))
+                allowed = 0
+            elif not threads[0].scratch_ok(report):
+                console.print(crayons.yellow(f'{hostname}: agent has only {report["scratch_mb"]} MB of scratch space '
+                                             f'- skipped'))
+                allowed = 0
+            else:
+                allowed = min(len(threads), report['free_slots'])
+                load = f"{report['load'][0]:.2f}" if report['load'] else '?'
+                console.print(f'{hostname}: agent ffmpeg {report["ffmpeg"]}, {report["cpus"]} cpus, load {load}, '
+                              f'{report["free_slots"]}/{report["slots"]} slots free, {report["scratch_mb"]} MB '
+                              f'scratch - using {allowed} slot(s)')
+            for host in threads[allowed:]:
+                self.hosts.remove(host)
+
+    def record_cache_lookup(self, hostname: str, hit: bool, filesize: int):
+        """Track agent input cache effectiveness, per host"""
+        with self.cache_stats_lock:
+            stats = self.cache_stats.setdefault(hostname, {'hits': 0, 'misses': 0, 'bytes_saved': 0})
+            if hit:
+                stats['hits'] += 1
+                stats['bytes_saved'] += filesize
+            else:
+                stats['misses'] += 1
+
+    def encoded_segments(self) -> int:
+        return sum([len([segment for segment in chunked.segments if segment.encoded]) for chunked in self.chunked])
+
+    def drain_queues(self) -> List:
+        """Take the jobs left on the queues off them, as (queue, job)"""
+        jobs = list()
+        for queue in self.queues.values():
+            while True:
+                try:
+                    jobs.append((queue, queue.get_nowait()))
+                except Empty:
+                    break
+                queue.task_done()
+        return jobs
+
+    def dump_cache_stats(self):
+        for hostname, stats in self.cache_stats.items():
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = int(stats['hits'] * 100 / lookups) if lookups > 0 else 0
+            saved_mb = int(stats['bytes_saved'] / (1024 * 1024))
+            console.print(f'{hostname}: agent cache hits {stats["hits"]}/{lookups} ({hit_rate}%), '
+                          f'{saved_mb} MB of uploads saved')
 
     def terminate(self):
         for host in self.hosts:
             host.terminate()
 
+    def is_segment(self, path: str) -> bool:
+        return any([path == segment.inpath for chunked in self.chunked for segment in chunked.segments])
+
     @property
     def directives(self):
         return self.config.directives
@@ -1037,10 +1698,16 @@ def manage_clusters(files, config: ConfigFile, testing=False) -> List:
     #
     # Start clusters, which will start hosts too
     #
-    for _, cluster in clusters.items():
+    aggregator = StatusAggregator()
+    metrics.aggregator = aggregator
+    for name, cluster in clusters.items():
+        metrics.watch_queues(cluster.queues, f'{name}/')
+        aggregator.watch_queues(cluster.queues, lambda job: job.media_info.runtime)
         if testing:
             cluster.testrun()
         else:
+            cluster.aggregator = aggregator
+            aggregator.worker_started()
             cluster.start()
 
     def sig_handler(signal, frame):
@@ -1052,29 +1719,13 @@ def manage_clusters(files, config: ConfigFile, testing=False) -> List:
     signal.signal(signal.SIGINT, sig_handler)
 
     if not testing:
-
-        busy = True
-        while busy:
-            try:
-                report = pytranscoder.status_queue.get(block=True, timeout=2)
-                host = report['host']
-                basename = report['file']
-                speed = report['speed']
-                comp = report['comp']
-                done = report['done']
-                print(f'{host:20}|{basename}: speed: {speed}x, comp: {comp}%, done: {done:3}%')
-                sys.stdout.flush()
-                pytranscoder.status_queue.task_done()
-            except Empty:
-                busy = False
-                for _, cluster in clusters.items():
-                    if cluster.is_alive():
-                        busy = True
+        aggregator.run()
+        console.flush()
 
         #
         # wait for each cluster thread to complete
         #
-    #        for _, cluster in clusters.items():
-    #            cluster.join()
-    #            completed.extend(cluster.completed)
+        for _, cluster in clusters.items():
+            cluster.join()
+            completed.extend(cluster.completed)
     return completed
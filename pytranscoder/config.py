@@ -5,6 +5,7 @@ from typing import Dict, Any, Optional, List
 import yaml
 
 from pytranscoder.media import MediaInfo
+from pytranscoder.multi import MultiDirective, is_multi, directive_names
 from pytranscoder.profile import Profile, Directives
 from pytranscoder.rule import Rule
 from pytranscoder.template import Template
@@ -70,9 +71,15 @@ class ConfigFile:
         return name in self.queues
 
     def has_directive(self, directive_name) -> bool:
+        if is_multi(directive_name):
+            return all([name in self.directives for name in directive_names(directive_name)])
         return directive_name in self.directives
 
     def get_directive(self, name) -> Directives:
+        if is_multi(name):
+            if not self.has_directive(name):
+                return None
+            return MultiDirective([self.directives[part] for part in directive_names(name)])
         return self.directives.get(name, None)
 
     def find_mixins(self, mixins: List[str]) -> List[Profile]:
@@ -106,10 +113,18 @@ class ConfigFile:
     def ssh_path(self):
         return self.settings.get('ssh', '/usr/bin/ssh')
 
+    @property
+    def crop_cache(self):
+        return os.path.expanduser(self.settings.get('crop_cache', '~/.transcode-crop.json'))
+
     @property
     def default_queue_file(self):
         return self.settings.get('default_queue_file', None)
 
+    @property
+    def log_buffer_kb(self) -> int:
+        return int(self.settings.get('log_buffer_kb', 64))
+
     def add_rule(self, name, rule: Rule):
         self.rules[name] = rule
 
@@ -0,0 +1,105 @@
+"""
+    Terminal output of all worker threads, written by a single thread so that a slow terminal (or ssh session)
+    never holds up an encode
+"""
+import atexit
+import sys
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import List, Optional
+
+_STATUS = object()              # queue marker, draw the latest progress table
+
+
+class Console:
+    """Messages are queued and written in order by the writer thread, started on first use.
+
+    The progress table is kept in a single slot rather than queued: if the terminal falls behind, a newer
+    table replaces one not yet drawn, so only the latest is ever written.
+    """
+
+    def __init__(self, out=None):
+        """
+        :param out: Output stream, default is sys.stdout
+        """
+        self._out = out
+        self.queue: Queue = Queue()
+        self.writer: Optional[Thread] = None
+        self.start_lock = Lock()
+        self.table_lock = Lock()
+        self.pending_table: Optional[List[str]] = None
+        self.drawn_lines = 0            # lines of the table on screen, 0 once anything is printed after it
+
+    @property
+    def out(self):
+        return self._out or sys.stdout
+
+    @property
+    def in_place(self) -> bool:
+        """Whether the progress table can be redrawn in place"""
+        return hasattr(self.out, 'isatty') and self.out.isatty()
+
+    def print(self, *args, sep=' ', end='\n'):
+        """Queue a message, formatted as print() would. Multiple lines in one call are never interleaved
+           with output from other threads.
+        """
+        self.put(sep.join([str(arg) for arg in args]) + end)
+
+    def status(self, lines: List[str]):
+        """Show the progress table, replacing the previous one if nothing was printed since"""
+        with self.table_lock:
+            waiting = self.pending_table is not None
+            self.pending_table = lines
+        if not waiting:
+            self.put(_STATUS)
+
+    def flush(self):
+        """Wait until everything queued so far has been written"""
+        if self.writer is not None:
+            self.queue.join()
+
+    def put(self, item):
+        if self.writer is None:
+            with self.start_lock:
+                if self.writer is None:
+                    self.writer = Thread(target=self.write_output, name='console', daemon=True)
+                    self.writer.start()
+                    atexit.register(self.flush)
+        self.queue.put(item)
+
+    def write_output(self):
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                out = self.out
+                out.write(''.join([self.render(item) for item in items]))
+                out.flush()
+            except (OSError, ValueError):
+                # terminal went away, nothing more can be shown
+                pass
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def render(self, item) -> str:
+        if item is not _STATUS:
+            self.drawn_lines = 0
+            return item
+        with self.table_lock:
+            lines, self.pending_table = self.pending_table, None
+        if lines is None:
+            return ''
+        text = '\n'.join(lines) + '\n'
+        if self.in_place and self.drawn_lines > 0:
+            # move up over the previous table and clear it
+            text = f'\x1b[{self.drawn_lines}F\x1b[J' + text
+        self.drawn_lines = len(lines)
+        return text
+
+
+console = Console()
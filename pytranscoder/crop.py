@@ -0,0 +1,177 @@
+"""
+    Automatic crop detection (autocrop: yes): ffmpeg's cropdetect is run on a few short, evenly spaced windows of the
+    source, all at once, and the black bars found in every window are cropped away by the encode. Results are cached
+    per file (path, size and modification time), so media are only analyzed once.
+"""
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from pytranscoder.media import MediaInfo
+from pytranscoder.multi import MultiDirective
+from pytranscoder.profile import Directives, DirectiveWrapper
+from pytranscoder.sample import sample_offsets
+from pytranscoder.timing import JobTiming
+
+WINDOWS = 4                 # windows of the source analyzed
+WINDOW_SECS = 5             # length of each window
+CROPDETECT = 'cropdetect=limit=24:round=2:reset=0'
+
+crop_re = re.compile(r'crop=(\d+):(\d+):(\d+):(\d+)')
+
+
+def window_offsets(runtime: int) -> List[Tuple[float, int]]:
+    """Start time and length of the windows to analyze, the start of the media if too short to sample"""
+    offsets = sample_offsets(runtime, WINDOWS, WINDOW_SECS)
+    if len(offsets) == 0:
+        return [(0.0, max(1, min(runtime, WINDOWS * WINDOW_SECS)))]
+    return [(offset, WINDOW_SECS) for offset in offsets]
+
+
+def parse_crop(output: str) -> Optional[Tuple[int, int, int, int]]:
+    """Last crop (w, h, x, y) reported by cropdetect, None if there is none or the window was all black"""
+    found = crop_re.findall(output)
+    if len(found) == 0:
+        return None
+    w, h, x, y = [int(value) for value in found[-1]]
+    if w <= 0 or h <= 0:
+        return None
+    return w, h, x, y
+
+
+def combine_crops(crops: List[Tuple[int, int, int, int]], width: int, height: int) -> Optional[str]:
+    """Smallest crop keeping the picture of every window, as w:h:x:y, None if nothing is cropped"""
+    if len(crops) == 0:
+        return None
+    left = min([x for _, _, x, _ in crops])
+    top = min([y for _, _, _, y in crops])
+    right = max([x + w for w, _, x, _ in crops])
+    bottom = max([y + h for _, h, _, y in crops])
+    if width and height:
+        right = min(right, width)
+        bottom = min(bottom, height)
+        if right - left >= width and bottom - top >= height:
+            return None
+    return f'{right - left}:{bottom - top}:{left}:{top}'
+
+
+def add_crop_filter(options: List[str], crop: str) -> List[str]:
+    """Output options with the crop filter applied first, merged into an existing video filter chain"""
+    options = list(options)
+    for i, opt in enumerate(options[0:-1]):
+        if opt in ['-vf', '-filter:v']:
+            options[i + 1] = f'crop={crop},{options[i + 1]}'
+            return options
+    return ['-vf', f'crop={crop}', *options]
+
+
+def detect_crops(ffmpeg_path: str, inpath: str, info: MediaInfo) -> Optional[List[Tuple[int, int, int, int]]]:
+    """Run cropdetect on the windows of the source in parallel.
+
+    :return: Crop found in each window that was not all black, or None if the analysis failed
+    """
+    windows = window_offsets(info.runtime)
+    with tempfile.TemporaryDirectory(prefix='pytranscoder-crop-') as tmpdir:
+        logs = [os.path.join(tmpdir, f'window{i}.log') for i in range(len(windows))]
+        procs = list()
+        for (offset, seconds), log in zip(windows, logs):
+            cli = [ffmpeg_path, '-hide_banner', '-nostats', '-ss', f'{offset:.3f}', '-t', str(seconds),
+                   '-i', inpath, '-map', f'0:{info.stream}', '-vf', CROPDETECT, '-an', '-sn', '-f', 'null', '-']
+            with open(log, 'w') as logfile:
+                procs.append(subprocess.Popen(cli, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                              stderr=logfile))
+        codes = [proc.wait() for proc in procs]
+        if any([code != 0 for code in codes]):
+            return None
+        found = list()
+        for log in logs:
+            with open(log, 'r', errors='replace') as logfile:
+                crop = parse_crop(logfile.read())
+            if crop is not None:
+                found.append(crop)
+    return found
+
+
+class CropCache:
+    """Detected crops by file identity, kept in a JSON file (config setting crop_cache)"""
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.crops: Dict[str, Optional[str]] = dict()
+        self.lock = threading.Lock()
+
+    def open(self, path: str):
+        self.path = path
+        self.crops = dict()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.crops = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def identity(inpath: str) -> str:
+        return f'{os.path.abspath(inpath)}|{os.path.getsize(inpath)}|{int(os.path.getmtime(inpath))}'
+
+    def has(self, inpath: str) -> bool:
+        return self.identity(inpath) in self.crops
+
+    def get(self, inpath: str) -> Optional[str]:
+        return self.crops.get(self.identity(inpath))
+
+    def put(self, inpath: str, crop: Optional[str]):
+        """Remember the crop of a file, None for no black bars, and write out the cache"""
+        with self.lock:
+            self.crops[self.identity(inpath)] = crop
+            if self.path is None:
+                return
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.crops, f)
+            os.replace(tmp, self.path)
+
+
+class CroppedDirective(DirectiveWrapper):
+    """Another directive, with the detected crop filter applied to its output"""
+
+    def __init__(self, parent: Directives, crop: str):
+        super().__init__(parent)
+        self.crop = crop
+
+    def output_options_list(self, config, mixins=None) -> List[str]:
+        return add_crop_filter(self.parent.output_options_list(config, mixins), self.crop)
+
+    def autocrop(self) -> bool:
+        return True
+
+
+crop_cache = CropCache()
+
+
+def apply_crop(config, inpath: str, info: MediaInfo, directive: Directives, timing: JobTiming) -> Directives:
+    """The directive with the crop of the media applied if it opts in and black bars were found, from the cache
+       or detected now
+    """
+    if isinstance(directive, MultiDirective):
+        return directive.map(lambda part: apply_crop(config, inpath, info, part, timing))
+    if not directive.autocrop() or not info.runtime:
+        return directive
+    if crop_cache.path != config.crop_cache:
+        crop_cache.open(config.crop_cache)
+    if crop_cache.has(inpath):
+        crop = crop_cache.get(inpath)
+    else:
+        with timing.phase('crop'):
+            found = detect_crops(config.ffmpeg_path, inpath, info)
+        if found is None:
+            return directive
+        crop = combine_crops(found, info.res_width, info.res_height)
+        crop_cache.put(inpath, crop)
+    if crop is None:
+        return directive
+    return CroppedDirective(directive, crop)
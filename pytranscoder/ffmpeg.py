@@ -4,21 +4,90 @@ import re
 import subprocess
 import sys
 import threading
+import time
 from pathlib import PurePath
-from random import randint
-from tempfile import gettempdir
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterable, Iterator, Optional
 import json
 
+from pytranscoder.console import console
 from pytranscoder.media import MediaInfo
-from pytranscoder.processor import Processor
+from pytranscoder.metrics import metrics
+from pytranscoder.processor import Processor, OutputLog
+from pytranscoder.transfer import recv_msg
 
 status_re = re.compile(
     r'^.* fps=\s*(?P<fps>.+?) q=(?P<q>.+\.\d) size=\s*(?P<size>\d+?)kB time=(?P<time>\d\d:\d\d:\d\d\.\d\d) .*speed=(?P<speed>.*?)x')
 
+#
+# Run ffmpeg with these to get machine-readable progress as blocks of key=value lines on stdout,
+# leaving stderr for diagnostics only
+#
+PROGRESS_OPTIONS = ['-progress', 'pipe:1', '-nostats']
+
 _CHARSET: str = sys.getdefaultencoding()
 
 
+def parse_progress(block: Dict[str, str]) -> Dict[str, Any]:
+    """Convert one -progress block into the stats given to monitoring callbacks.
+
+    Values ffmpeg reports as N/A (ie. size before the first packet is written) become 0.
+
+    :param block:   key=value pairs of the block, ending with the progress key
+    :return:        frame, fps, bitrate (kbits/s), out_time_us and total_size (bytes), plus the
+                    size, time (seconds) and speed values used by calculate_progress()
+    """
+    def number(key: str, cast=int):
+        try:
+            return cast(block.get(key, '0'))
+        except ValueError:
+            return cast(0)
+
+    # older ffmpeg versions only have out_time_ms, which despite the name is also in microseconds
+    out_time_us = number('out_time_us') if 'out_time_us' in block else number('out_time_ms')
+    total_size = number('total_size')
+    try:
+        bitrate = float(block.get('bitrate', '').replace('kbits/s', ''))
+    except ValueError:
+        bitrate = 0.0
+    speed = block.get('speed', 'N/A').strip().rstrip('x')
+    return {
+        'frame': number('frame'),
+        'fps': number('fps', float),
+        'bitrate': bitrate,
+        'out_time_us': out_time_us,
+        'total_size': total_size,
+        'size': total_size,
+        'time': out_time_us // 1_000_000,
+        'speed': speed if speed != 'N/A' else '0',
+    }
+
+
+def progress_blocks(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """Collect -progress output lines into blocks of key=value pairs, one per update"""
+    block: Dict[str, str] = dict()
+    for line in lines:
+        key, _, value = line.strip().partition('=')
+        block[key] = value
+        if key == 'progress':
+            yield block
+            block = dict()
+
+
+def parse_status(line: str) -> Optional[Dict[str, Any]]:
+    """Stats from a status line of ffmpeg's default stderr output (see status_re), the way progress was
+       monitored before -progress. Only used for comparison by benchmarks/progress_parsing.py.
+    """
+    match = status_re.match(line)
+    if match is None or len(match.groups()) < 5:
+        return None
+    info: Dict[str, Any] = match.groupdict()
+    info['size'] = int(info['size'].strip()) * 1024
+    hh, mm, ss = info['time'].split(':')
+    ss = ss.split('.')[0]
+    info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
+    return info
+
+
 class FFmpeg(Processor):
 
     def __init__(self, ffmpeg_path: str):
@@ -31,6 +100,13 @@ class FFmpeg(Processor):
         :param _path:   Absolute path to media file
         :return:        Instance of MediaInfo
         """
+        start = time.perf_counter()
+        try:
+            return self.probe(_path)
+        finally:
+            metrics.observe_probe(time.perf_counter() - start)
+
+    def probe(self, _path: str) -> MediaInfo:
         with subprocess.Popen([self.path, '-i', _path], stderr=subprocess.PIPE) as proc:
             output = proc.stderr.read().decode(encoding='utf8')
             mi = MediaInfo.parse_ffmpeg_details(_path, output)
@@ -54,76 +130,68 @@ class FFmpeg(Processor):
             info = json.loads(output)
             return MediaInfo.parse_ffmpeg_details_json(_path, info)
 
-    def monitor_ffmpeg(self, proc: subprocess.Popen):
+    def monitor_progress(self, proc: subprocess.Popen):
+        """Monitor an ffmpeg run started with PROGRESS_OPTIONS and a separate stderr pipe.
+
+        Progress blocks are read from stdout while stderr is copied to the transaction log by a helper thread.
+        If the caller stops early (closes the generator), ffmpeg is killed; the log is closed only after ffmpeg
+        has exited and its stderr has been copied.
+        """
         diff = datetime.timedelta(seconds=self.monitor_interval)
         event = datetime.datetime.now() + diff
 
-        #
-        # Create a transaction log for this run, to be left behind if an error is encountered.
-        #
-        suffix = randint(100, 999)
-        self.log_path: PurePath = PurePath(gettempdir(), 'pytranscoder-' + threading.current_thread().getName() + '-' +
-                                           str(suffix) + '.log')
-
-        with open(str(self.log_path), 'w') as logfile:
-            while proc.poll() is None:
-                line = proc.stdout.readline()
-                logfile.write(line)
-                logfile.flush()
-
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 5:
-                    if datetime.datetime.now() > event:
-                        event = datetime.datetime.now() + diff
-                        info: Dict[str, Any] = match.groupdict()
-
-                        info['size'] = int(info['size'].strip()) * 1024
-                        hh, mm, ss = info['time'].split(':')
-                        ss = ss.split('.')[0]
-                        info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-                        yield info
-
-        if proc.returncode == 0:
-            # if we got here then everything went fine, so remove the transaction log
-            try:
-                os.remove(str(self.log_path))
-            except Exception:
-                pass
-            self.log_path = None
-
-    def monitor_agent(self, sock):
+        output_log = self.open_log()
+        stderr_copier = threading.Thread(target=self.copy_stderr, args=(proc, output_log), daemon=True)
+        stderr_copier.start()
+
+        finished = False
+        try:
+            for block in progress_blocks(proc.stdout):
+                if datetime.datetime.now() > event:
+                    event = datetime.datetime.now() + diff
+                    yield parse_progress(block)
+            finished = True
+        finally:
+            if not finished:
+                proc.kill()
+            proc.wait()
+            stderr_copier.join()
+            self.close_log(finished and proc.returncode == 0)
+
+    @staticmethod
+    def copy_stderr(proc: subprocess.Popen, output_log: OutputLog):
+        for line in proc.stderr:
+            output_log.write(line)
+
+    def monitor_agent(self, channel):
+        """Monitor a transcode on an agent. The agent relays the combined ffmpeg output line by line,
+           in which the -progress key=value lines are collected into blocks.
+        """
         diff = datetime.timedelta(seconds=self.monitor_interval)
         event = datetime.datetime.now() + diff
+        block: Dict[str, str] = dict()
         while True:
-            c = sock.recv(1024).decode()
+            c = recv_msg(channel)
             if c.startswith("DONE|") or c.startswith("ERR|"):
-                print("Transcode complete, receiving results..")
+                console.print("Transcode complete, receiving results..")
                 # found end of processing marker
-                try:
-                    os.remove(str(self.log_path))
-                    self.log_path = None
-                except Exception:
-                    pass
-
                 yield c
 
-            sock.send(bytes("ACK!".encode()))
-            line = c
-
-            match = status_re.match(line)
-            if match is not None and len(match.groups()) >= 5:
+            key, sep, value = c.strip().partition('=')
+            if not sep or ' ' in key:
+                # diagnostic output
+                continue
+            block[key] = value
+            if key == 'progress':
                 if datetime.datetime.now() > event:
                     event = datetime.datetime.now() + diff
-                    info: Dict[str, Any] = match.groupdict()
-
-                    info['size'] = int(info['size'].strip()) * 1024
-                    hh, mm, ss = info['time'].split(':')
-                    ss = ss.split('.')[0]
-                    info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-                    yield info
+                    yield parse_progress(block)
+                block = dict()
 
     def run(self, params, event_callback) -> Optional[int]:
-        return self.execute_and_monitor(params, event_callback, self.monitor_ffmpeg)
+        return self.execute_and_monitor([*PROGRESS_OPTIONS, *params], event_callback, self.monitor_progress,
+                                        stderr=subprocess.PIPE)
 
     def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
-        return self.remote_execute_and_monitor(sshcli, user, ip, params, event_callback, self.monitor_ffmpeg)
+        return self.remote_execute_and_monitor(sshcli, user, ip, [*PROGRESS_OPTIONS, *params], event_callback,
+                                               self.monitor_progress, stderr=subprocess.PIPE)
@@ -0,0 +1,162 @@
+"""
+    Outcome prediction from past results (--history <journal>).
+
+    Completed and threshold-vetoed jobs in the journal record the source media (codec, resolution, bitrate, fps and
+    runtime) along with the sizes and encode time. For a new job, the past outcomes of the same directive nearest to
+    its media - weighted by how close they are - give the predicted compression and encode time. The predictions
+    are shown with --dry-run, order each queue by expected savings per CPU hour, and skip jobs of directives with
+    "threshold_history: yes" that are predicted to miss their threshold.
+"""
+import math
+from queue import Queue
+from typing import Dict, List, Optional
+
+from pytranscoder.journal import read_journal
+from pytranscoder.media import MediaInfo
+from pytranscoder.profile import Directives
+from pytranscoder.status import format_eta
+from pytranscoder.timing import JobTiming
+
+NEIGHBOURS = 5              # past outcomes a prediction is based on
+MIN_OUTCOMES = 3            # fewer outcomes of a directive than this and nothing is predicted
+CODEC_DISTANCE = 1.0        # distance added between media of different source codecs
+
+
+def media_features(info: MediaInfo) -> Dict:
+    """What is recorded of the source media of a job, for later predictions"""
+    return {'vcodec': info.vcodec, 'res_width': info.res_width, 'res_height': info.res_height,
+            'vbitrate': info.vbitrate, 'fps': float(info.fps or 0), 'runtime': info.runtime}
+
+
+class Outcome:
+    """Result of one past job"""
+
+    def __init__(self, directive: str, media: Dict, orig_size: int, new_size: int, encode_secs: float,
+                 cpu_secs: Optional[float]):
+        self.directive = directive
+        self.vcodec = media.get('vcodec')
+        self.pixels = math.log2(max((media.get('res_width') or 1) * (media.get('res_height') or 1), 1))
+        self.bitrate = math.log2(max(media.get('vbitrate') or 1, 1))
+        self.fps = float(media.get('fps') or 0)
+        self.saved_pct = 100 - new_size * 100 / orig_size
+        runtime = media.get('runtime') or 0
+        # encode time per second of media, unknown for jobs encoded in segments
+        self.secs_per_sec = encode_secs / runtime if runtime > 0 and encode_secs > 0 else None
+        self.cpu_per_sec = cpu_secs / runtime if runtime > 0 and cpu_secs else None
+
+    @staticmethod
+    def from_event(rec: Dict) -> Optional['Outcome']:
+        if rec.get('event') not in ['completed', 'vetoed'] or 'media' not in rec or not rec.get('orig_size'):
+            return None
+        usage = rec.get('usage') or {}
+        cpu_secs = None
+        if usage.get('cpu_user') is not None:
+            cpu_secs = usage['cpu_user'] + usage.get('cpu_sys', 0)
+        return Outcome(rec.get('directive'), rec['media'], rec['orig_size'], rec.get('new_size', 0),
+                       rec.get('phases', {}).get('encode', 0.0), cpu_secs)
+
+    def distance(self, other: 'Outcome') -> float:
+        codec = 0.0 if self.vcodec == other.vcodec else CODEC_DISTANCE
+        return codec + abs(self.pixels - other.pixels) + abs(self.bitrate - other.bitrate) + \
+            abs(self.fps - other.fps) / 30
+
+
+class Prediction:
+
+    def __init__(self, saved_pct: int, seconds: Optional[float], cpu_seconds: Optional[float], outcomes: int):
+        self.saved_pct = saved_pct
+        self.seconds = seconds
+        self.cpu_seconds = cpu_seconds
+        self.outcomes = outcomes        # past outcomes of the directive available
+
+
+def weighted(values: List, weights: List[float]) -> Optional[float]:
+    pairs = [(value, weight) for value, weight in zip(values, weights) if value is not None]
+    if len(pairs) == 0:
+        return None
+    return sum([value * weight for value, weight in pairs]) / sum([weight for _, weight in pairs])
+
+
+class History:
+
+    def __init__(self):
+        self.outcomes: Dict[str, List[Outcome]] = dict()     # by directive
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.outcomes) > 0
+
+    def load(self, path: str):
+        """Read past outcomes from a journal"""
+        self.add([Outcome.from_event(rec) for rec in read_journal(path)])
+
+    def add(self, outcomes: List[Optional[Outcome]]):
+        for outcome in outcomes:
+            if outcome is not None:
+                self.outcomes.setdefault(outcome.directive, []).append(outcome)
+
+    def predict(self, info: MediaInfo, directive: str) -> Optional[Prediction]:
+        """Compression and encode time of the media with the directive, from the nearest past outcomes"""
+        past = self.outcomes.get(directive, [])
+        if len(past) < MIN_OUTCOMES or not info.runtime:
+            return None
+        target = Outcome(directive, media_features(info), 1, 0, 0.0, None)
+        nearest = sorted(past, key=target.distance)[0:NEIGHBOURS]
+        weights = [1 / (0.1 + target.distance(outcome)) for outcome in nearest]
+        saved = weighted([outcome.saved_pct for outcome in nearest], weights)
+        per_sec = weighted([outcome.secs_per_sec for outcome in nearest], weights)
+        cpu_per_sec = weighted([outcome.cpu_per_sec for outcome in nearest], weights)
+        return Prediction(int(round(saved)), per_sec * info.runtime if per_sec is not None else None,
+                          cpu_per_sec * info.runtime if cpu_per_sec is not None else None, len(past))
+
+    def apply(self, timing: JobTiming, info: MediaInfo, directive: str):
+        """Record the media of the job, for future predictions, and predict its outcome if there is any history"""
+        timing.media = media_features(info)
+        if not self.enabled:
+            return
+        prediction = self.predict(info, directive)
+        if prediction is not None:
+            timing.predicted_saved = prediction.saved_pct
+            timing.predicted_secs = prediction.seconds
+            timing.predicted_cpu_secs = prediction.cpu_seconds
+
+
+def savings_rate(filesize_mb: float, timing: JobTiming) -> float:
+    """Expected MB saved per CPU hour (or encode hour if CPU time is not known), 0 if there is no prediction"""
+    seconds = timing.predicted_cpu_secs or timing.predicted_secs
+    if timing.predicted_saved is None or not seconds:
+        return 0.0
+    return filesize_mb * timing.predicted_saved / 100 / (seconds / 3600)
+
+
+def history_vetoed(directive: Directives, timing: JobTiming) -> bool:
+    """True if the directive skips jobs predicted to miss its threshold and this one is"""
+    return directive.threshold() > 0 and directive.threshold_history() and timing.predicted_saved is not None and \
+        timing.predicted_saved < directive.threshold()
+
+
+def predicted_note(timing: JobTiming) -> str:
+    """Prediction of a job for display after its directive, empty if none"""
+    if timing.predicted_saved is None:
+        return ''
+    text = f' (predicted {timing.predicted_saved}% saved'
+    if timing.predicted_secs is not None:
+        text += f', {format_eta(timing.predicted_secs)} to encode'
+    return text + ')'
+
+
+def order_queue(queue: Queue, filesize_mb, timing):
+    """Reorder the jobs of a queue, not yet started, by expected savings per CPU hour, highest first
+
+    :param filesize_mb: Function of a job returning its source size
+    :param timing: Function of a job returning its JobTiming
+    """
+    jobs = list()
+    while not queue.empty():
+        jobs.append(queue.get_nowait())
+        queue.task_done()
+    for job in sorted(jobs, key=lambda j: savings_rate(filesize_mb(j), timing(j)), reverse=True):
+        queue.put(job)
+
+
+history = History()
@@ -0,0 +1,144 @@
+"""
+    Append-only journal of job events as JSON lines (--journal), and a throughput report built from it (--report)
+
+    Events are handed to a single writer thread through a queue so worker threads never wait on file I/O.
+    Event types: matched, enqueued, started, progress, vetoed, failed, completed
+"""
+import json
+import time
+from queue import Queue, Empty
+from threading import Thread
+from typing import Dict, List, Optional
+
+from pytranscoder.sample import prediction_fields
+from pytranscoder.timing import JobTiming
+
+WRITE_BATCH = 256                   # most events written per flush
+
+
+class Journal:
+
+    def __init__(self):
+        self.queue: Queue = Queue()
+        self.writer: Optional[Thread] = None
+        self.path: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.writer is not None
+
+    def open(self, path: str):
+        """Start appending events to path"""
+        self.path = path
+        self.writer = Thread(target=self.write_events, name='journal', daemon=True)
+        self.writer.start()
+
+    def close(self):
+        """Write out all pending events and stop the writer"""
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+
+    def event(self, event: str, **fields):
+        if self.writer is None:
+            return
+        self.queue.put({'event': event, 'ts': round(time.time(), 3), **fields})
+
+    def job(self, event: str, host: Optional[str], path: str, timing: JobTiming, **fields):
+        """Record an event of a job, identified by file, host and directive"""
+        if self.writer is None:
+            return
+        self.event(event, host=host, file=str(path), directive=timing.directive, **fields)
+
+    def write_events(self):
+        with open(self.path, 'a') as journal_file:
+            done = False
+            while not done:
+                batch = [self.queue.get()]
+                while len(batch) < WRITE_BATCH:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                if None in batch:
+                    done = True
+                    batch = batch[0:batch.index(None)]
+                journal_file.write(''.join([json.dumps(rec) + '\n' for rec in batch]))
+                journal_file.flush()
+
+
+def completed_fields(timing: JobTiming, orig_size: int, new_size: int) -> Dict:
+    """Sizes, timings and source media of a completed (or threshold vetoed) job"""
+    fields = {'orig_size': orig_size, 'new_size': new_size,
+              'phases': {name: round(seconds, 3) for name, seconds in timing.phases.items()}}
+    if timing.usage is not None:
+        fields['usage'] = timing.usage.to_dict()
+    if timing.media is not None:
+        fields['media'] = timing.media
+    fields.update(prediction_fields(timing, orig_size, new_size))
+    return fields
+
+
+def summarize(events: List[Dict], key: str) -> Dict[str, Dict]:
+    """Totals per host or directive of the events in a journal.
+
+    Throughput is taken over the span from the first job started to the last job ended for that host or directive.
+    """
+    groups: Dict[str, Dict] = dict()
+    for rec in events:
+        if rec['event'] not in ['started', 'completed', 'failed', 'vetoed']:
+            continue
+        name = rec.get(key) or '-'
+        group = groups.setdefault(name, {'completed': 0, 'failed': 0, 'vetoed': 0, 'orig_size': 0, 'new_size': 0,
+                                         'encode': 0.0, 'first': None, 'last': None})
+        if rec['event'] == 'started':
+            if group['first'] is None or rec['ts'] < group['first']:
+                group['first'] = rec['ts']
+            continue
+        group[rec['event']] += 1
+        group['last'] = max(group['last'] or 0, rec['ts'])
+        if rec['event'] == 'completed':
+            group['orig_size'] += rec.get('orig_size', 0)
+            group['new_size'] += rec.get('new_size', 0)
+            group['encode'] += rec.get('phases', {}).get('encode', 0.0)
+
+    for group in groups.values():
+        span = 0.0
+        if group['first'] is not None and group['last'] is not None:
+            span = max(group['last'] - group['first'], 0.0)
+        group['span'] = span
+        group['files_per_hour'] = group['completed'] * 3600 / span if span > 0 else 0.0
+        group['mb_per_sec'] = group['orig_size'] / 1048576 / span if span > 0 else 0.0
+        group['saved_pct'] = 100 - int(group['new_size'] * 100 / group['orig_size']) if group['orig_size'] > 0 else 0
+    return groups
+
+
+def read_journal(path: str) -> List[Dict]:
+    events = list()
+    with open(path, 'r') as journal_file:
+        for line in journal_file:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # partial last line of a run that was killed
+                continue
+    return events
+
+
+def report(path: str):
+    """Print throughput per host and per profile from a journal"""
+    events = read_journal(path)
+    print(f'{len(events)} events in {path}')
+    for title, key in [('HOST', 'host'), ('PROFILE', 'directive')]:
+        print()
+        print(f'{title:20} {"DONE":>5} {"FAIL":>5} {"VETO":>5} {"IN MB":>9} {"OUT MB":>9} {"SAVED":>6} '
+              f'{"ENCODE":>9} {"FILES/H":>8} {"MB/S":>7}')
+        for name, group in sorted(summarize(events, key).items()):
+            print(f'{name:20.20} {group["completed"]:5} {group["failed"]:5} {group["vetoed"]:5} '
+                  f'{group["orig_size"] // 1048576:9} {group["new_size"] // 1048576:9} {group["saved_pct"]:5}% '
+                  f'{group["encode"]:8.0f}s {group["files_per_hour"]:8.1f} {group["mb_per_sec"]:7.2f}')
+
+
+journal = Journal()
@@ -14,6 +14,34 @@ video_dur = re.compile(r".*Duration: (\d+):(\d+):(\d+)", re.DOTALL)
 video_info = re.compile(r'.*Stream #0:(\d+)(?:\(\w+\))?: Video: (\w+).*, (yuv\w+)[(,].* (\d+)x(\d+).* (\d+)(\.\d.)? fps', re.DOTALL)
 audio_info = re.compile(r'^\s+Stream #0:(?P<stream>\d+)(\((?P<lang>\w+)\))?: Audio: (?P<format>\w+).*?(?P<default>\(default\))?$', re.MULTILINE)
 subtitle_info = re.compile(r'^\s+Stream #0:(?P<stream>\d+)(\((?P<lang>\w+)\))?: Subtitle:', re.MULTILINE)
+overall_bitrate = re.compile(r'Duration: .*?, bitrate: (\d+) kb/s')
+video_bitrate = re.compile(r'Stream #0:\d+[^:\n]*: Video: [^\n]*?, (\d+) kb/s')
+stream_bitrate = re.compile(r', (\d+) kb/s')
+stream_bps = re.compile(r'^\s+BPS(?:-\w+)?\s*: (\d+)\s*$', re.MULTILINE)
+
+
+def kbps(filesize_mb: float, runtime: int) -> int:
+    """Average bitrate of a file of the given size and length"""
+    if not filesize_mb or not runtime:
+        return 0
+    return int(filesize_mb * 1024 * 1024 * 8 / 1000 / runtime)
+
+
+def audio_kbps(output: str, stream_match) -> Optional[int]:
+    """Bitrate of a stream from its line of ffmpeg output or, in mkv, its BPS tag. None if not shown"""
+    match = stream_bitrate.search(stream_match.group(0))
+    if match:
+        return int(match.group(1))
+    end = output.find('Stream #', stream_match.end())
+    match = stream_bps.search(output, stream_match.end(), end if end >= 0 else len(output))
+    return int(match.group(1)) // 1000 if match else None
+
+
+def bits_per_pixel(vbitrate: int, width: int, height: int, fps) -> float:
+    """Video bits per pixel per frame, a resolution and framerate independent measure of how compressed video is"""
+    if not vbitrate or not width or not height or not fps or float(fps) == 0:
+        return 0.0
+    return round(vbitrate * 1000 / (width * height * float(fps)), 4)
 
 
 class MediaInfo:
@@ -34,6 +62,17 @@ class MediaInfo:
         self.colorspace = info['colorspace']
         self.audio = info['audio']
         self.subtitle = info['subtitle']
+        # kb/s, derived from the size and runtime when not reported (the video bitrate as an upper bound)
+        self.bitrate = info.get('bitrate') or kbps(self.filesize_mb, self.runtime)
+        self.vbitrate = info.get('vbitrate') or self.bitrate
+        self.bpp = bits_per_pixel(self.vbitrate, self.res_width, self.res_height, self.fps)
+
+    def to_dict(self) -> Dict:
+        """Details in the form accepted by the constructor, for saving"""
+        return {'path': self.path, 'vcodec': self.vcodec, 'stream': self.stream, 'res_height': self.res_height,
+                'res_width': self.res_width, 'runtime': self.runtime, 'filesize_mb': self.filesize_mb,
+                'fps': self.fps, 'colorspace': self.colorspace, 'audio': self.audio, 'subtitle': self.subtitle,
+                'bitrate': self.bitrate, 'vbitrate': self.vbitrate}
 
     def __str__(self):
         runtime = "{:0>8}".format(str(timedelta(seconds=self.runtime)))
@@ -41,7 +80,7 @@ class MediaInfo:
         audio = '(' + ','.join(audios) + ')'
         subs = [s['stream'] + ':' + s['lang'] + ':' + s['default'] for s in self.subtitle]
         sub = '(' + ','.join(subs) + ')'
-        buf = f"{self.path}, {self.filesize_mb}mb, {self.fps} fps, {self.res_width}x{self.res_height}, {runtime}, {self.vcodec}, audio={audio}, sub={sub}"
+        buf = f"{self.path}, {self.filesize_mb}mb, {self.fps} fps, {self.res_width}x{self.res_height}, {runtime}, {self.vcodec}, {self.vbitrate}kb/s ({self.bpp} bpp), audio={audio}, sub={sub}"
         return buf
 
     def is_multistream(self) -> bool:
@@ -132,7 +171,7 @@ class MediaInfo:
 
             expr = f'{rangelow} <= {attr} <= {rangehigh}'
 
-        elif value.isnumeric():
+        elif value.replace('.', '', 1).isnumeric():
             # simple numeric equality test
 
             if pred == 'runtime':
@@ -178,6 +217,7 @@ class MediaInfo:
             ainfo = audio_match.groupdict()
             if ainfo['lang'] is None:
                 ainfo['lang'] = 'und'
+            ainfo['bitrate'] = audio_kbps(output, audio_match)
             audio_tracks.append(ainfo)
 
         subtitle_tracks = list()
@@ -204,6 +244,12 @@ class MediaInfo:
             'audio': audio_tracks,
             'subtitle': subtitle_tracks
         }
+        match3 = overall_bitrate.search(output)
+        if match3 is not None:
+            minfo['bitrate'] = int(match3.group(1))
+        match4 = video_bitrate.search(output)
+        if match4 is not None:
+            minfo['vbitrate'] = int(match4.group(1))
         return MediaInfo(minfo)
 
     @staticmethod
@@ -226,6 +272,8 @@ class MediaInfo:
                 fr = int(int(fr_parts[0]) / int(fr_parts[1]))
                 minfo['fps'] = str(fr)
                 minfo['colorspace'] = stream['pix_fmt']
+                if 'bit_rate' in stream:
+                    minfo['vbitrate'] = int(stream['bit_rate']) // 1000
                 if 'duration' in stream:
                     minfo['runtime'] = int(float(stream['duration']))
                 else:
@@ -242,6 +290,9 @@ class MediaInfo:
                 audio['stream'] = str(stream['index'])
                 audio['format'] = stream['codec_name']
                 audio['default'] = 0
+                bit_rate = stream.get('bit_rate') or stream.get('tags', {}).get('BPS') or \
+                    stream.get('tags', {}).get('BPS-eng')
+                audio['bitrate'] = int(bit_rate) // 1000 if bit_rate and str(bit_rate).isdigit() else None
                 if 'disposition' in stream:
                     if 'default' in stream['disposition']:
                         audio['default'] = stream['disposition']['default']
@@ -295,6 +346,7 @@ class MediaInfo:
             ainfo = audio_match.groupdict()
             if ainfo['lang'] is None:
                 ainfo['lang'] = 'und'
+            ainfo['bitrate'] = audio_kbps(output, audio_match)
             audio_tracks.append(ainfo)
 
         subtitle_tracks = list()
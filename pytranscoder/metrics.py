@@ -0,0 +1,144 @@
+"""
+    Run metrics served in Prometheus text format from an optional localhost HTTP listener (--metrics-port)
+
+    Nothing here is called while an encode is running: per-job progress is read from the status aggregator
+    and queue depths from the queues themselves when scraped. Counters are only updated as jobs end.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, Tuple, List, Optional
+
+PROBE_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+COUNTERS = {
+    'pytranscoder_jobs_completed_total': 'Jobs encoded and kept',
+    'pytranscoder_jobs_failed_total': 'Jobs where ffmpeg did not complete normally',
+    'pytranscoder_jobs_vetoed_total': 'Jobs cancelled or discarded for not meeting the compression threshold',
+    'pytranscoder_bytes_saved_total': 'Reduction in size of kept encodes, in bytes',
+}
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: Dict[Tuple[str, str], float] = dict()        # (name, host) -> value
+        self.probe_counts: List[int] = [0] * (len(PROBE_BUCKETS) + 1)
+        self.probe_sum = 0.0
+        self.queues: Dict[str, Queue] = dict()
+        self.aggregator = None
+
+    def count(self, name: str, host: str, amount: float = 1):
+        with self.lock:
+            self.counters[(name, host)] = self.counters.get((name, host), 0) + amount
+
+    def job_completed(self, host: str, orig_size: int, new_size: int):
+        self.count('pytranscoder_jobs_completed_total', host)
+        self.count('pytranscoder_bytes_saved_total', host, orig_size - new_size)
+
+    def job_failed(self, host: str):
+        self.count('pytranscoder_jobs_failed_total', host)
+
+    def job_vetoed(self, host: str):
+        self.count('pytranscoder_jobs_vetoed_total', host)
+
+    def observe_probe(self, seconds: float):
+        bucket = len(PROBE_BUCKETS)
+        for i, bound in enumerate(PROBE_BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+        with self.lock:
+            self.probe_counts[bucket] += 1
+            self.probe_sum += seconds
+
+    def watch_queues(self, queues: Dict[str, Queue], prefix: str = ''):
+        """Report the depth of these queues, named with an optional prefix (ie. the cluster name)"""
+        for name, queue in queues.items():
+            self.queues[prefix + name] = queue
+
+    def exposition(self) -> str:
+        """All metrics in Prometheus text format"""
+        lines = ['# HELP pytranscoder_queue_depth Files waiting in queue',
+                 '# TYPE pytranscoder_queue_depth gauge']
+        for name, queue in sorted(self.queues.items()):
+            lines.append(f'pytranscoder_queue_depth{{queue="{escape(name)}"}} {queue.qsize()}')
+
+        jobs = dict(self.aggregator.jobs) if self.aggregator is not None else dict()
+        active: Dict[str, int] = dict()
+        for (host, _), _ in jobs.items():
+            active[host] = active.get(host, 0) + 1
+        lines.extend(['# HELP pytranscoder_active_jobs Jobs in progress',
+                      '# TYPE pytranscoder_active_jobs gauge'])
+        for host, count in sorted(active.items()):
+            lines.append(f'pytranscoder_active_jobs{{host="{escape(host)}"}} {count}')
+
+        for metric, key, text in [('pytranscoder_job_speed', 'speed', 'Encoding speed relative to realtime'),
+                                  ('pytranscoder_job_fps', 'fps', 'Frames encoded per second'),
+                                  ('pytranscoder_job_compression_percent', 'comp', 'Estimated size reduction'),
+                                  ('pytranscoder_job_done_percent', 'done', 'Portion of the media encoded')]:
+            lines.extend([f'# HELP {metric} {text}', f'# TYPE {metric} gauge'])
+            for (host, basename), job in sorted(jobs.items()):
+                try:
+                    value = float(job.get(key, 0))
+                except (TypeError, ValueError):
+                    value = 0.0
+                lines.append(f'{metric}{{host="{escape(host)}",file="{escape(basename)}"}} {value}')
+
+        with self.lock:
+            counters = dict(self.counters)
+            probe_counts = list(self.probe_counts)
+            probe_sum = self.probe_sum
+        for metric, text in COUNTERS.items():
+            lines.extend([f'# HELP {metric} {text}', f'# TYPE {metric} counter'])
+            for (name, host), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f'{metric}{{host="{escape(host)}"}} {value:g}')
+
+        lines.extend(['# HELP pytranscoder_probe_seconds Time to read media information',
+                      '# TYPE pytranscoder_probe_seconds histogram'])
+        cumulative = 0
+        for bound, count in zip(PROBE_BUCKETS + ['+Inf'], probe_counts):
+            cumulative += count
+            lines.append(f'pytranscoder_probe_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'pytranscoder_probe_seconds_sum {probe_sum}')
+        lines.append(f'pytranscoder_probe_seconds_count {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = metrics.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of the console
+        pass
+
+
+def serve(port: int) -> Optional[ThreadingHTTPServer]:
+    """Start the metrics listener on localhost in the background"""
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as ex:
+        print(f'Unable to start metrics listener on port {port}: {ex}')
+        return None
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+metrics = Metrics()
@@ -0,0 +1,76 @@
+"""
+    Single-decode multi-output encoding: several profiles or templates named together (-p hevc,mobile or a rule
+    with profile: hevc,mobile) run as one ffmpeg process with an output per directive, so the source is read and
+    decoded once. Each output has its own options, stream map and threshold. The first directive's output replaces
+    the source as usual; the others are kept next to it as <name>.<directive><extension>.
+"""
+from pathlib import Path, PurePath
+from typing import Callable, List, Optional
+
+from pytranscoder.media import MediaInfo
+from pytranscoder.profile import Directives, DirectiveWrapper, stream_options
+
+SEPARATOR = ','
+
+
+def is_multi(name: Optional[str]) -> bool:
+    return name is not None and SEPARATOR in name
+
+
+def directive_names(name: str) -> List[str]:
+    return [part.strip() for part in name.split(SEPARATOR) if len(part.strip()) > 0]
+
+
+class MultiDirective(DirectiveWrapper):
+    """Directives whose outputs are encoded together. Used as a single directive only for selection and queueing,
+       from the first one; thresholds, sampling and segments apply per output, or not at all.
+    """
+
+    parent_features = False
+
+    def __init__(self, parts: List[Directives]):
+        # one input, so the first directive decides how it is read
+        super().__init__(parts[0])
+        self.parts = parts
+
+    def map(self, fn: Callable[[Directives], Directives]) -> 'MultiDirective':
+        """The same outputs with fn applied to the directive of each"""
+        return MultiDirective([fn(part) for part in self.parts])
+
+    def name(self) -> str:
+        return SEPARATOR.join([part.name() for part in self.parts])
+
+
+class Output:
+    """One output of a multi-output job"""
+
+    def __init__(self, directive: Directives, inpath: Path, primary: bool, fls_path: Optional[str]):
+        """
+        :param primary: True for the output that replaces the source
+        """
+        self.directive = directive
+        self.primary = primary
+        self.vetoed = False
+        self.predicted_comp: Optional[int] = None
+        ext = directive.extension()
+        if primary:
+            self.final = inpath.with_suffix(ext)
+        else:
+            self.final = inpath.with_name(f'{inpath.stem}.{directive.name()}{ext}')
+        if fls_path:
+            self.path = PurePath(fls_path, self.final.name)
+        else:
+            self.path = Path(str(self.final) + '.tmp')
+
+
+def job_outputs(directive: MultiDirective, inpath: Path, fls_path: Optional[str]) -> List[Output]:
+    return [Output(part, inpath, i == 0, fls_path) for i, part in enumerate(directive.parts)]
+
+
+def output_cli(config, inpath: Path, info: MediaInfo, outputs: List[Output], mixins: Optional[List[str]]) -> List[str]:
+    """ffmpeg arguments reading the source once and writing every output"""
+    cli = ['-y', *outputs[0].directive.input_options_list(), '-i', str(inpath)]
+    for output in outputs:
+        stream_map = stream_options(output.directive, info, config.automap)
+        cli.extend([*output.directive.output_options_list(config, mixins), *stream_map, str(output.path)])
+    return cli
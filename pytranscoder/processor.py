@@ -1,8 +1,60 @@
 import subprocess
+import threading
+from collections import deque
 from pathlib import PurePath
+from random import randint
+from tempfile import gettempdir
 from typing import Optional
 
+import pytranscoder
 from pytranscoder.media import MediaInfo
+from pytranscoder.transfer import send_msg
+from pytranscoder.usage import AccountedPopen, ResourceUsage
+
+
+class OutputLog:
+    """Most recent output of a run, kept in memory and written to the transaction log only if the run fails.
+
+    With --full-log every line is written straight to the log file instead, and the file is kept.
+    """
+
+    def __init__(self, log_path: str, max_kb: int, full: bool = False):
+        self.log_path = log_path
+        self.max_size = max_kb * 1024
+        self.full = full
+        self.lines = deque()
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.logfile = open(log_path, 'w') if full else None
+
+    def write(self, line: str):
+        if self.full:
+            self.logfile.write(line)
+            return
+        with self.lock:
+            self.lines.append(line)
+            self.size += len(line)
+            while self.size > self.max_size and len(self.lines) > 1:
+                self.size -= len(self.lines.popleft())
+                self.dropped += 1
+
+    def save(self):
+        """Persist what was kept to log_path"""
+        if self.full:
+            self.logfile.flush()
+            return
+        with self.lock:
+            lines = list(self.lines)
+        with open(self.log_path, 'w') as logfile:
+            if self.dropped > 0:
+                logfile.write(f'[{self.dropped} earlier lines not kept]\n')
+            logfile.writelines(lines)
+
+    def close(self):
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
 
 
 class Processor:
@@ -10,7 +62,9 @@ class Processor:
     def __init__(self, path: str):
         self.path = path
         self.log_path: PurePath = None
+        self.output_log: Optional[OutputLog] = None
         self.last_command = ''
+        self.last_usage: Optional[ResourceUsage] = None
 
     @property
     def is_available(self) -> bool:
@@ -25,50 +79,86 @@ class Processor:
     def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
         return None
 
-    def execute_and_monitor(self, params, event_callback, monitor) -> Optional[int]:
-        self.last_command = ' '.join([self.path, *params])
-        with subprocess.Popen([self.path,
-                               *params],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              shell=False) as p:
+    def open_log(self) -> OutputLog:
+        """Start the transaction log for a new run, to be left behind if an error is encountered"""
+        suffix = randint(100, 999)
+        self.log_path = PurePath(gettempdir(), 'pytranscoder-' + threading.current_thread().getName() + '-' +
+                                 str(suffix) + '.log')
+        self.output_log = OutputLog(str(self.log_path), pytranscoder.log_buffer_kb, full=pytranscoder.full_log)
+        return self.output_log
+
+    def close_log(self, success: bool):
+        """Write out the transaction log of a failed or vetoed run. Nothing is left on disk for a successful one
+           unless --full-log is in effect.
+        """
+        if self.output_log is None:
+            return
+        if not success:
+            self.output_log.save()
+        self.output_log.close()
+        if success and not self.output_log.full:
+            self.log_path = None
+        self.output_log = None
 
-            for stats in monitor(p):
-                if event_callback is not None:
-                    veto = event_callback(stats)
-                    if veto:
-                        p.kill()
-                        return None
-            return p.returncode
+    def execute_and_monitor(self, params, event_callback, monitor, stderr=subprocess.STDOUT) -> Optional[int]:
+        self.last_command = ' '.join([self.path, *params])
+        self.last_usage = None
+        p = AccountedPopen([self.path,
+                            *params],
+                           stdout=subprocess.PIPE,
+                           stderr=stderr,
+                           universal_newlines=True,
+                           shell=False)
+        try:
+            with p:
+                progress = monitor(p)
+                for stats in progress:
+                    # samples the peak memory of the child while it runs
+                    p.poll()
+                    if event_callback is not None:
+                        veto = event_callback(stats)
+                        if veto:
+                            p.kill()
+                            # the monitor waits for the output to be drained, then writes out the log
+                            progress.close()
+                            return None
+                return p.returncode
+        finally:
+            # the process has been reaped on leaving the with block
+            self.last_usage = p.usage
 
-    def monitor_agent_ffmpeg(self, sock, event_callback, monitor):
-        for stats in monitor(sock):
+    def monitor_agent_ffmpeg(self, channel, event_callback, monitor):
+        for stats in monitor(channel):
             if isinstance(stats, str):
                 break
             if event_callback is not None:
                 veto = event_callback(stats)
                 if veto:
-                    sock.send(bytes("VETO".encode()))
+                    send_msg(channel, "VETO")
                     return False, stats
         return True, stats
 
-    def remote_execute_and_monitor(self, sshcli: str, user: str, ip: str, params: list, event_callback, monitor) -> Optional[int]:
+    def remote_execute_and_monitor(self, sshcli: str, user: str, ip: str, params: list, event_callback, monitor,
+                                   stderr=subprocess.STDOUT) -> Optional[int]:
         cli = [sshcli, '-v', user + '@' + ip, self.path, *params]
         self.last_command = ' '.join(cli)
+        self.last_usage = None          # only the ssh client would be measured here
         with subprocess.Popen(cli,
                               stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
+                              stderr=stderr,
                               universal_newlines=True,
                               shell=False) as p:
+            progress = monitor(p)
             try:
-                for stats in monitor(p):
+                for stats in progress:
                     if event_callback is not None:
                         veto = event_callback(stats)
                         if veto:
                             p.kill()
+                            progress.close()
                             return None
                 return p.returncode
             except KeyboardInterrupt:
                 p.kill()
+                progress.close()
         return None
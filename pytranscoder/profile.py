@@ -25,9 +25,119 @@ class Directives:
     def threshold(self) -> int:
         pass
 
+    def threshold_samples(self) -> int:
+        pass
+
+    def threshold_sample_secs(self) -> int:
+        pass
+
+    def segments(self) -> int:
+        pass
+
+    def checkpoint_secs(self) -> int:
+        pass
+
+    def remux(self) -> bool:
+        pass
+
+    def threshold_history(self) -> bool:
+        pass
+
+    def autocrop(self) -> bool:
+        pass
+
     def stream_map(self, video_stream: str, audio: List, subtitle: List) -> List[str]:
         pass
 
+    def audio_options(self, audio: List) -> List[str]:
+        pass
+
+
+class DirectiveWrapper(Directives):
+    """Another directive with some of its settings changed, everything not overridden is the parent's.
+
+    Wrappers for a job derived from the parent's (a segment, a remux, ...) set parent_features False to leave out
+    its thresholds, sampling, segments, checkpoints, remux, history and crop settings.
+    """
+
+    parent_features = True
+
+    def __init__(self, parent: Directives):
+        self.parent = parent
+
+    def name(self) -> str:
+        return self.parent.name()
+
+    def extension(self) -> str:
+        return self.parent.extension()
+
+    def input_options_list(self) -> List[str]:
+        return self.parent.input_options_list()
+
+    def output_options_list(self, config, mixins=None) -> List[str]:
+        return self.parent.output_options_list(config, mixins)
+
+    def threshold_check(self) -> int:
+        return self.parent.threshold_check() if self.parent_features else 100
+
+    def queue_name(self) -> str:
+        return self.parent.queue_name()
+
+    def threshold(self) -> int:
+        return self.parent.threshold() if self.parent_features else 0
+
+    def threshold_samples(self) -> int:
+        return self.parent.threshold_samples() if self.parent_features else 0
+
+    def threshold_sample_secs(self) -> int:
+        return self.parent.threshold_sample_secs()
+
+    def segments(self) -> int:
+        return self.parent.segments() if self.parent_features else 0
+
+    def checkpoint_secs(self) -> int:
+        return self.parent.checkpoint_secs() if self.parent_features else 0
+
+    def remux(self) -> bool:
+        return self.parent.remux() if self.parent_features else False
+
+    def threshold_history(self) -> bool:
+        return self.parent.threshold_history() if self.parent_features else False
+
+    def autocrop(self) -> bool:
+        return self.parent.autocrop() if self.parent_features else False
+
+    def stream_map(self, video_stream: str, audio: List, subtitle: List) -> List[str]:
+        return self.parent.stream_map(video_stream, audio, subtitle)
+
+    def audio_options(self, audio: List) -> List[str]:
+        return self.parent.audio_options(audio)
+
+
+def copy_audio_options(mapped: List, codecs: List[str], max_bitrate: Optional[int]) -> List[str]:
+    """-c:a:N copy for each mapped audio stream already in one of the codecs, and within max_bitrate if given
+       (streams of unknown bitrate are then encoded)
+    """
+    options = list()
+    for i, s in enumerate(mapped):
+        if s.get('format') not in codecs:
+            continue
+        if max_bitrate and (s.get('bitrate') is None or s['bitrate'] > max_bitrate):
+            continue
+        options.extend([f'-c:a:{i}', 'copy'])
+    return options
+
+
+def stream_options(directive: Directives, info, automap: bool) -> List[str]:
+    """Stream mapping of the directive for the media, followed by its per audio stream options"""
+    options = []
+    if info.is_multistream() and automap:
+        options = directive.stream_map(info.stream, info.audio, info.subtitle)
+    if len(options) > 0 or len(info.audio) < 2:
+        # output audio streams are known only when mapped, or when there is at most one
+        options = [*options, *directive.audio_options(info.audio)]
+    return options
+
 
 class Options:
     def __init__(self, opts: List = None):
@@ -149,6 +259,27 @@ class Profile(Directives):
     def threshold_check(self) -> int:
         return self.profile.get('threshold_check', 100)
 
+    def threshold_samples(self) -> int:
+        return self.profile.get('threshold_samples', 0)
+
+    def threshold_sample_secs(self) -> int:
+        return self.profile.get('threshold_sample_secs', 10)
+
+    def segments(self) -> int:
+        return self.profile.get('segments', 0)
+
+    def checkpoint_secs(self) -> int:
+        return self.profile.get('checkpoint_secs', 0)
+
+    def remux(self) -> bool:
+        return self.profile.get('remux', False)
+
+    def threshold_history(self) -> bool:
+        return self.profile.get('threshold_history', False)
+
+    def autocrop(self) -> bool:
+        return self.profile.get('autocrop', False)
+
     @property
     def include_profiles(self) -> List[str]:
         alist: str = self.profile.get('include', None)
@@ -203,6 +334,18 @@ class Profile(Directives):
             return []
         return subtitle_section.get('exclude_languages', [])
 
+    def audio_copy_codecs(self) -> list:
+        audio_section = self.profile.get('audio')
+        if audio_section is None:
+            return []
+        return audio_section.get('copy_codecs', [])
+
+    def audio_copy_max_bitrate(self) -> Optional[int]:
+        audio_section = self.profile.get('audio')
+        if audio_section is None:
+            return None
+        return audio_section.get('copy_max_bitrate', None)
+
     def default_audio(self) -> Optional[str]:
         audio_section = self.profile.get('audio')
         if audio_section is None:
@@ -215,31 +358,33 @@ class Profile(Directives):
             return None
         return subtitle_section.get('default_language', [])
 
-    def _map_streams(self, stream_type: str, streams: List, excludes: list, includes: list, defl: str) -> list:
+    @staticmethod
+    def _mapped_streams(streams: List, excludes: list, includes: list) -> list:
         if excludes is None:
             excludes = []
         if not includes:
             includes = None
-        seq_list = list()
         mapped = list()
-        default_reassign = False
         for s in streams:
             stream_lang = s.get('lang', 'none')
             #
             # includes take precedence over excludes
             #
             if includes is not None and stream_lang not in includes:
-                if s.get('default', None) is not None:
-                    default_reassign = True
                 continue
-
             if stream_lang in excludes:
-                if s.get('default', None) is not None:
-                    default_reassign = True
                 continue
-
-            # if we got here, map the stream
             mapped.append(s)
+        return mapped
+
+    def _map_streams(self, stream_type: str, streams: List, excludes: list, includes: list, defl: str) -> list:
+        seq_list = list()
+        mapped = self._mapped_streams(streams, excludes, includes)
+        default_reassign = False
+        for s in streams:
+            if s not in mapped and s.get('default', None) is not None:
+                default_reassign = True
+        for s in mapped:
             seq = s['stream']
             seq_list.append('-map')
             seq_list.append(f'0:{seq}')
@@ -280,6 +425,13 @@ class Profile(Directives):
         subtitle_streams = self._map_streams("s", subtitle, excl_subtitle, incl_subtitle, defl_subtitle)
         return seq_list + audio_streams + subtitle_streams
 
+    def audio_options(self, audio: List) -> List[str]:
+        codecs = self.audio_copy_codecs()
+        if len(codecs) == 0:
+            return []
+        mapped = self._mapped_streams(audio, self.excluded_audio(), self.included_audio())
+        return copy_audio_options(mapped, codecs, self.audio_copy_max_bitrate())
+
     @staticmethod
     def find_mixin_section(mixins: List[Profile], mixin_type: str):
         for mixin in mixins:
@@ -0,0 +1,71 @@
+"""
+    Remux fast path: a stream copy into the container and stream selection of a directive, in place of an encode.
+
+    Used when a rule asks for it (action: remux), or when a directive allows it (remux: yes) and the media already has
+    the video codec the directive encodes to. Only the container and the mapped audio and subtitle tracks change,
+    so the job takes seconds and is never vetoed by the directive's threshold.
+"""
+from typing import List, Optional
+
+from pytranscoder.media import MediaInfo
+from pytranscoder.multi import MultiDirective
+from pytranscoder.profile import Directives, DirectiveWrapper
+from pytranscoder.rule import Rule
+from pytranscoder.segment import output_format
+
+#
+# ffmpeg video encoders and the codec names ffmpeg reports for the media they produce
+#
+VIDEO_ENCODERS = {
+    'libx265': 'hevc', 'hevc_nvenc': 'hevc', 'hevc_qsv': 'hevc', 'hevc_vaapi': 'hevc', 'hevc_amf': 'hevc',
+    'hevc_videotoolbox': 'hevc', 'nvenc_hevc': 'hevc',
+    'libx264': 'h264', 'h264_nvenc': 'h264', 'h264_qsv': 'h264', 'h264_vaapi': 'h264', 'h264_amf': 'h264',
+    'h264_videotoolbox': 'h264', 'nvenc_h264': 'h264',
+    'libaom-av1': 'av1', 'libsvtav1': 'av1', 'librav1e': 'av1', 'av1_nvenc': 'av1', 'av1_qsv': 'av1',
+    'av1_vaapi': 'av1', 'av1_amf': 'av1',
+    'libvpx-vp9': 'vp9', 'vp9_qsv': 'vp9', 'vp9_vaapi': 'vp9',
+    'libvpx': 'vp8', 'libxvid': 'mpeg4', 'mpeg4': 'mpeg4', 'mpeg2video': 'mpeg2video',
+}
+
+
+def video_codec(options: List[str]) -> Optional[str]:
+    """Codec the output options encode video to, None if not known or copied"""
+    for i, opt in enumerate(options[0:-1]):
+        if opt in ['-c:v', '-vcodec', '-codec:v']:
+            encoder = options[i + 1]
+            return VIDEO_ENCODERS.get(encoder, None)
+    return None
+
+
+class RemuxDirective(DirectiveWrapper):
+    """Stream copy with the container, format and stream selection of another directive"""
+
+    parent_features = False
+
+    def input_options_list(self) -> List[str]:
+        # nothing is decoded
+        return []
+
+    def output_options_list(self, config, mixins=None) -> List[str]:
+        return ['-c', 'copy', *output_format(self.parent.output_options_list(config, mixins))]
+
+    def remux(self) -> bool:
+        return True
+
+    def audio_options(self, audio: List) -> List[str]:
+        # streams are copied anyway
+        return []
+
+
+def select_directive(directive: Directives, info: MediaInfo, config, rule: Optional[Rule] = None) -> Directives:
+    """The directive to run for the media: a remux in place of the given one if the rule asks for it, or if the
+       directive allows it and the media already has the video codec it encodes to
+    """
+    if isinstance(directive, MultiDirective):
+        return directive.map(lambda part: select_directive(part, info, config, rule))
+    if rule is not None and rule.is_remux():
+        return RemuxDirective(directive)
+    if directive.remux() and info.vcodec is not None and info.vcodec == video_codec(
+            directive.output_options_list(config)):
+        return RemuxDirective(directive)
+    return directive
@@ -4,14 +4,20 @@ from typing import Dict
 from pytranscoder import verbose
 from pytranscoder.media import MediaInfo
 
-valid_predicates = ['vcodec', 'res_height', 'res_width', 'runtime', 'filesize_mb', 'fps', 'path']
-numeric_predicates = ['res_height', 'res_width', 'runtime', 'filesize_mb', 'fps']
+valid_predicates = ['vcodec', 'res_height', 'res_width', 'runtime', 'filesize_mb', 'fps', 'path', 'bitrate', 'vbitrate',
+                    'bpp']
+valid_actions = ['encode', 'remux']
+numeric_predicates = ['res_height', 'res_width', 'runtime', 'filesize_mb', 'fps', 'bitrate', 'vbitrate', 'bpp']
 
 
 class Rule:
     def __init__(self, name: str, rule: Dict):
         self.name = name
         self.profile = rule['profile']
+        self.action = rule.get('action', 'encode')
+        if self.action not in valid_actions:
+            print(f'Invalid action {self.action} in rule {self.name}')
+            exit(1)
         if 'criteria' in rule:
             self.criteria = rule['criteria']
         else:
@@ -20,6 +26,9 @@ class Rule:
     def is_skip(self):
         return self.profile.upper() == 'SKIP'
 
+    def is_remux(self):
+        return self.action == 'remux'
+
     def match(self, media_info: MediaInfo) -> bool:
         if verbose:
             print(f' > evaluating "{self.name}"')
@@ -0,0 +1,97 @@
+"""
+    Pre-encode compression prediction (threshold_samples): a few short, evenly spaced segments of the source are
+    encoded with the job's directive, all at once, and the final size extrapolated from theirs. Jobs predicted to
+    miss their threshold are skipped before the full encode starts.
+"""
+import math
+import os
+import subprocess
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+from pytranscoder.media import MediaInfo
+from pytranscoder.profile import Directives, stream_options
+from pytranscoder.timing import JobTiming
+
+
+def sample_offsets(runtime: int, count: int, seconds: int) -> List[float]:
+    """Start times of count segments of the given length, centered in equal slices of the runtime.
+
+    :return: Empty list if the media is too short for sampling to save anything
+    """
+    if count < 1 or seconds < 1 or runtime < count * seconds * 4:
+        return []
+    slice_len = runtime / count
+    return [slice_len * i + (slice_len - seconds) / 2 for i in range(count)]
+
+
+def predicted_compression(orig_size: int, runtime: int, sampled_seconds: int, sampled_size: int) -> int:
+    """Percent compression of the whole file, assuming the samples are representative"""
+    sampled_source = orig_size * sampled_seconds / runtime
+    return 100 - math.floor(sampled_size * 100 / sampled_source)
+
+
+def encode_samples(ffmpeg_path: str, config, inpath: str, info: MediaInfo, directive: Directives,
+                   mixins: Optional[List[str]]) -> Optional[int]:
+    """Encode the sample segments in parallel and predict the compression of the full encode.
+
+    :return: Predicted percent compression, or None if the media is too short or a sample failed
+    """
+    seconds = directive.threshold_sample_secs()
+    offsets = sample_offsets(info.runtime, directive.threshold_samples(), seconds)
+    if len(offsets) == 0:
+        return None
+
+    stream_map = stream_options(directive, info, config.automap)
+
+    with tempfile.TemporaryDirectory(prefix='pytranscoder-sample-') as tmpdir:
+        outputs = [os.path.join(tmpdir, f'sample{i}{directive.extension()}') for i in range(len(offsets))]
+        procs = list()
+        for offset, output in zip(offsets, outputs):
+            cli = [ffmpeg_path, '-y', '-v', 'error', *directive.input_options_list(), '-ss', f'{offset:.3f}',
+                   '-t', str(seconds), '-i', inpath, *directive.output_options_list(config, mixins), *stream_map,
+                   output]
+            procs.append(subprocess.Popen(cli, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL))
+        codes = [proc.wait() for proc in procs]
+        if any([code != 0 for code in codes]) or not all([os.path.exists(output) for output in outputs]):
+            return None
+        sampled_size = sum([os.path.getsize(output) for output in outputs])
+
+    return predicted_compression(os.path.getsize(inpath), info.runtime, seconds * len(offsets), sampled_size)
+
+
+def predict_vetoed(ffmpeg_path: str, config, inpath: str, info: MediaInfo, directive: Directives,
+                   mixins: Optional[List[str]], timing: JobTiming, log: Callable) -> bool:
+    """Sample the job if its directive asks for it, keeping the prediction in timing.
+
+    :return: True if the job is predicted to miss its threshold and should be skipped
+    """
+    if directive.threshold() <= 0 or directive.threshold_samples() < 1:
+        return False
+    with timing.phase('sample'):
+        predicted = encode_samples(ffmpeg_path, config, inpath, info, directive, mixins)
+    if predicted is None:
+        return False
+    timing.predicted_comp = predicted
+    if predicted < directive.threshold():
+        log(f'Encoding of {os.path.basename(inpath)} skipped, samples predict {predicted}% compression '
+            f'(threshold {directive.threshold()}%)')
+        return True
+    return False
+
+
+def prediction_fields(timing: JobTiming, orig_size: int, new_size: int) -> Dict:
+    """Predicted and actual compression of a sampled job, for the journal"""
+    if timing.predicted_comp is None or orig_size <= 0:
+        return {}
+    actual = 100 - math.floor(new_size * 100 / orig_size)
+    return {'predicted_comp': timing.predicted_comp, 'actual_comp': actual,
+            'prediction_error': actual - timing.predicted_comp}
+
+
+def log_prediction(log: Callable, timing: JobTiming, orig_size: int, new_size: int):
+    fields = prediction_fields(timing, orig_size, new_size)
+    if len(fields) > 0:
+        log(f'Predicted {fields["predicted_comp"]}% compression, actual {fields["actual_comp"]}% '
+            f'(error {fields["prediction_error"]:+}%)')
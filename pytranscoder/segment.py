@@ -0,0 +1,365 @@
+"""
+    Segment-parallel encoding of a single file (profile setting "segments").
+
+    The video stream is split at keyframes into segments without re-encoding, the segments are encoded concurrently,
+    then losslessly joined with the concat demuxer. Audio and subtitles are encoded once, from the source, in parallel
+    with the video segments and muxed in with the joined video. The result must match the source duration.
+
+    With "checkpoint_secs" the segments and a manifest of those already encoded are kept next to the .tmp output until
+    the encode succeeds, so an encode interrupted by Ctrl-C, a reboot or a lost connection resumes from the last
+    finished segment when the file is run again. The manifest is only used for the same source (path, size and
+    modification time) and the same options and split; otherwise the encode starts over.
+"""
+import glob
+import json
+import os
+import shutil
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from pytranscoder.ffmpeg import FFmpeg
+from pytranscoder.media import MediaInfo
+from pytranscoder.profile import Directives, DirectiveWrapper, stream_options
+from pytranscoder.usage import ResourceUsage
+
+MIN_SEGMENT_SECONDS = 60        # media is not split into segments shorter than this
+DURATION_TOLERANCE = 2          # seconds the output may differ from the source
+MANIFEST = 'manifest.json'
+
+
+def split_times(runtime: int, count: int) -> List[int]:
+    """Times to split the media into (up to) count equal segments, empty if not worth splitting"""
+    count = min(count, runtime // MIN_SEGMENT_SECONDS)
+    if count < 2:
+        return []
+    return [runtime * i // count for i in range(1, count)]
+
+
+def segment_count(directive: Directives, runtime: int) -> int:
+    """Segments to split into: the "segments" setting, or more to checkpoint at least every checkpoint_secs"""
+    count = directive.segments()
+    if directive.checkpoint_secs() > 0:
+        count = max(count, runtime // directive.checkpoint_secs())
+    return count
+
+
+def use_segments(directive: Directives, info: MediaInfo) -> bool:
+    return len(split_times(info.runtime, segment_count(directive, info.runtime))) > 0
+
+
+def output_format(options: List[str]) -> List[str]:
+    """The -f option of an output options list, needed where the output name has no usable extension (.tmp)"""
+    for i, opt in enumerate(options[0:-1]):
+        if opt == '-f':
+            return ['-f', options[i + 1]]
+    return []
+
+
+def concat_list(paths: List[str]) -> str:
+    """Contents of a concat demuxer list file"""
+    return ''.join(["file '" + path.replace("'", "'\\''") + "'\n" for path in paths])
+
+
+class SegmentDirective(DirectiveWrapper):
+    """Directive for one video segment of a file: the video options of the file's directive, matroska output
+       and no threshold, which is checked on the joined result instead
+    """
+
+    parent_features = False
+
+    def extension(self) -> str:
+        return '.mkv'
+
+    def output_options_list(self, config, mixins=None) -> List[str]:
+        return [*self.parent.output_options_list(config, mixins), '-map', '0:v', '-an', '-sn', '-f', 'matroska']
+
+    def stream_map(self, video_stream: str, audio: List, subtitle: List) -> List[str]:
+        return []
+
+    def audio_options(self, audio: List) -> List[str]:
+        return []
+
+
+class Checkpoint:
+    """Manifest of a checkpointed encode: the segments split from the source and those encoded so far"""
+
+    def __init__(self, workdir: str, identity: Dict):
+        """
+        :param identity: Source and settings the segments are valid for
+        """
+        self.workdir = workdir
+        self.path = os.path.join(workdir, MANIFEST)
+        self.identity = identity
+        self.sources: List[str] = list()
+        self.done: List[str] = list()
+        self.lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Pick up the manifest of an earlier run.
+
+        :return: True if it is for the same source and settings and its segments are all still there
+        """
+        try:
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest.get('identity') != self.identity:
+            return False
+        if not all([os.path.exists(os.path.join(self.workdir, name)) for name in manifest['sources']]):
+            return False
+        self.sources = manifest['sources']
+        self.done = [name for name in manifest['done'] if os.path.exists(os.path.join(self.workdir, name))]
+        return True
+
+    def save(self):
+        with self.lock:
+            self._write()
+
+    def finished(self, name: str):
+        with self.lock:
+            if name not in self.done:
+                self.done.append(name)
+            self._write()
+
+    def is_done(self, name: str) -> bool:
+        return name in self.done
+
+    def _write(self):
+        # replaced in one step, an interruption never leaves half a manifest
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'identity': self.identity, 'sources': self.sources, 'done': self.done}, f)
+        os.replace(tmp, self.path)
+
+
+class SegmentedEncode:
+    """Encode one file in segments, in parallel. Presents last_command, log_path and last_usage like FFmpeg,
+       so callers report failures the same way.
+    """
+
+    def __init__(self, ffmpeg_path: str, config, inpath: str, outpath: str, info: MediaInfo, directive: Directives,
+                 mixins: Optional[List[str]], workdir: Optional[str] = None, distributed: bool = False):
+        """
+        :param workdir: Where to keep the segments, default is next to the output
+        :param distributed: Segments are encoded by cluster hosts, replacing each segment with its result
+        """
+        self.ffmpeg_path = ffmpeg_path
+        self.config = config
+        self.inpath = inpath
+        self.outpath = outpath
+        self.info = info
+        self.directive = directive
+        self.mixins = mixins
+        self.workdir = workdir or outpath + '.segments'
+        self.times = split_times(info.runtime, segment_count(directive, info.runtime))
+        self.parallel = max(1, directive.segments())
+        self.distributed = distributed
+        self.checkpoint: Optional[Checkpoint] = None
+        self.others: Optional[str] = None       # audio and subtitles, if any
+        if len(info.audio) > 0 or len(info.subtitle) > 0:
+            self.others = os.path.join(self.workdir, 'other_streams.mkv')
+        self.last_command = ''
+        self.log_path = None
+        self.last_usage: Optional[ResourceUsage] = None
+        self.lock = threading.Lock()
+        self.vetoed = threading.Event()
+        self.progress: Dict[int, Dict] = dict()
+
+    @property
+    def count(self) -> int:
+        """Planned number of segments, the split may yield fewer if keyframes are far apart"""
+        return len(self.times) + 1
+
+    @property
+    def output_options(self) -> List[str]:
+        return self.directive.output_options_list(self.config, self.mixins)
+
+    @property
+    def resumed(self) -> int:
+        """Segments (and other streams) already encoded by an earlier, interrupted run"""
+        return len(self.checkpoint.done) if self.checkpoint is not None else 0
+
+    def run(self, event_callback: Optional[Callable] = None, log: Optional[Callable] = None) -> Optional[int]:
+        """Same results as FFmpeg.run: 0 on success, None if vetoed by event_callback, otherwise an error code.
+
+        :param event_callback: Called with progress of the whole file, as the combined progress of the segments
+        :param log: Called with a message when resuming from a checkpoint
+        """
+        code = 1
+        try:
+            segments = self.split()
+            if segments is not None:
+                if self.resumed > 0 and log is not None:
+                    log(f'Resuming {os.path.basename(self.inpath)}, {self.resumed} part(s) already encoded')
+                code = self.encode(segments, event_callback)
+            return code
+        finally:
+            self.cleanup(failed=code is not None and code != 0)
+
+    def cleanup(self, failed: bool):
+        """Remove the segments, unless the encode failed and can be resumed from them"""
+        if failed and self.checkpoint is not None:
+            return
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def identity(self) -> Dict:
+        return {'source': self.inpath, 'size': os.path.getsize(self.inpath),
+                'mtime': int(os.path.getmtime(self.inpath)), 'input_options': self.directive.input_options_list(),
+                'output_options': self.output_options, 'times': self.times, 'distributed': self.distributed}
+
+    def is_done(self, path: str) -> bool:
+        return self.checkpoint is not None and self.checkpoint.is_done(os.path.basename(path))
+
+    def segment_done(self, path: str):
+        if self.checkpoint is not None:
+            self.checkpoint.finished(os.path.basename(path))
+
+    def execute(self, ffmpeg: FFmpeg, params: List[str], event_callback=None) -> Optional[int]:
+        code = ffmpeg.run(params, event_callback)
+        with self.lock:
+            if ffmpeg.last_usage is not None:
+                if self.last_usage is None:
+                    self.last_usage = ResourceUsage()
+                self.last_usage.add(ffmpeg.last_usage)
+            if code != 0:
+                self.last_command = ffmpeg.last_command
+                self.log_path = ffmpeg.log_path
+        return code
+
+    def split(self) -> Optional[List[str]]:
+        """Copy the video stream into keyframe-aligned segments, or pick up those of an interrupted checkpointed run"""
+        if self.directive.checkpoint_secs() > 0:
+            self.checkpoint = Checkpoint(self.workdir, self.identity())
+            if self.checkpoint.load():
+                return [os.path.join(self.workdir, name) for name in self.checkpoint.sources]
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        os.makedirs(self.workdir)
+
+        # named after the source, as hosts of a cluster may encode segments of several files in one working dir
+        prefix = os.path.splitext(os.path.basename(self.inpath))[0].replace('%', '%%')
+        pattern = os.path.join(self.workdir, prefix + '.part%03d.mkv')
+        params = ['-y', '-i', self.inpath, '-map', f'0:{self.info.stream}', '-c', 'copy', '-f', 'segment',
+                  '-segment_times', ','.join([str(t) for t in self.times]), '-segment_format', 'matroska',
+                  '-reset_timestamps', '1', pattern]
+        if self.execute(FFmpeg(self.ffmpeg_path), params) != 0:
+            return None
+        prefix = glob.escape(os.path.splitext(os.path.basename(self.inpath))[0])
+        sources = sorted(glob.glob(os.path.join(glob.escape(self.workdir), prefix + '.part[0-9][0-9][0-9].mkv')))
+        if self.checkpoint is not None:
+            self.checkpoint.sources = [os.path.basename(source) for source in sources]
+            self.checkpoint.save()
+        return sources
+
+    def segment_params(self, source: str, output: str) -> List[str]:
+        segment_directive = SegmentDirective(self.directive)
+        return ['-y', *segment_directive.input_options_list(), '-i', source,
+                *segment_directive.output_options_list(self.config, self.mixins), output]
+
+    def other_streams_params(self) -> List[str]:
+        """Audio and subtitles of the source, encoded once"""
+        stream_map = stream_options(self.directive, self.info, self.config.automap)
+        return ['-y', '-i', self.inpath, *self.output_options, *stream_map, '-vn', '-dn', '-f', 'matroska',
+                self.others]
+
+    def encode_other_streams(self, event_callback: Optional[Callable] = None) -> Optional[int]:
+        if self.others is None or self.is_done(self.others):
+            return 0
+        code = self.execute(FFmpeg(self.ffmpeg_path), self.other_streams_params(), event_callback)
+        if code == 0:
+            self.segment_done(self.others)
+        return code
+
+    def segment_callback(self, index: int, event_callback: Optional[Callable]):
+        def callback(stats):
+            if self.vetoed.is_set():
+                return True
+            if event_callback is None:
+                return False
+            with self.lock:
+                self.progress[index] = stats
+                combined = {'time': sum([s['time'] for s in self.progress.values()]),
+                            'size': sum([s['size'] for s in self.progress.values()]),
+                            'fps': sum([s.get('fps', 0) for s in self.progress.values()])}
+                try:
+                    combined['speed'] = f"{sum([float(s['speed']) for s in self.progress.values()]):.2f}"
+                except ValueError:
+                    combined['speed'] = '0'
+                if event_callback(combined):
+                    self.vetoed.set()
+            return self.vetoed.is_set()
+        return callback
+
+    def encode(self, segments: List[str], event_callback: Optional[Callable]) -> Optional[int]:
+        """Encode the segments, up to the "segments" setting at a time, along with the other streams"""
+        outputs = [os.path.join(self.workdir, f'encoded{i:03}.mkv') for i in range(len(segments))]
+        codes: Dict[str, Optional[int]] = dict()
+        pending = deque()
+        for i, output in enumerate(outputs):
+            if self.is_done(output):
+                # counted in the progress as it was when finished
+                self.progress[i] = {'time': self.info.runtime // len(segments), 'size': os.path.getsize(output),
+                                    'fps': 0, 'speed': '0'}
+            else:
+                pending.append(i)
+
+        def record(name: str, code: Optional[int]):
+            codes[name] = code
+            if code is not None and code != 0:
+                # no point finishing the others
+                self.vetoed.set()
+
+        def run_segments():
+            while not self.vetoed.is_set():
+                with self.lock:
+                    if len(pending) == 0:
+                        return
+                    i = pending.popleft()
+                code = self.execute(FFmpeg(self.ffmpeg_path), self.segment_params(segments[i], outputs[i]),
+                                    self.segment_callback(i, event_callback))
+                record(str(i), code)
+                if code == 0:
+                    self.segment_done(outputs[i])
+                    with self.lock:
+                        if i in self.progress:
+                            self.progress[i] = {**self.progress[i], 'fps': 0, 'speed': '0'}
+
+        def run_others():
+            record('other', self.encode_other_streams(lambda stats: self.vetoed.is_set()))
+
+        workers = [threading.Thread(target=run_segments, name=f'{threading.current_thread().name}-seg{n}')
+                   for n in range(min(self.parallel, len(pending)))]
+        if self.others is not None:
+            workers.append(threading.Thread(target=run_others, name=f'{threading.current_thread().name}-audio'))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        failed = [code for code in codes.values() if code is not None and code != 0]
+        if len(failed) > 0:
+            return failed[0]
+        if self.vetoed.is_set():
+            return None
+        return self.join(outputs)
+
+    def join(self, outputs: List[str]) -> int:
+        """Concatenate the encoded segments, add the other streams and check the result"""
+        list_path = os.path.join(self.workdir, 'segments.txt')
+        with open(list_path, 'w') as f:
+            f.write(concat_list(outputs))
+        params = ['-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if self.others is not None:
+            params.extend(['-i', self.others, '-map', '0:v', '-map', '1'])
+        params.extend(['-c', 'copy', *output_format(self.output_options), self.outpath])
+        code = self.execute(FFmpeg(self.ffmpeg_path), params)
+        if code != 0:
+            return code
+
+        result = FFmpeg(self.ffmpeg_path).fetch_details(self.outpath)
+        if not result.valid or abs(result.runtime - self.info.runtime) > DURATION_TOLERANCE:
+            runtime = result.runtime if result.valid else 'unknown'
+            self.last_command = f'duration check: source {self.info.runtime}s, output {runtime}s'
+            return 1
+        return 0
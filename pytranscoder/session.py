@@ -0,0 +1,199 @@
+"""
+    Long-lived, multiplexed connections between the cluster manager and agents.
+
+    Every frame on the wire carries a channel id. Channel 0 is reserved for session control (handshake and
+    heartbeats), every other channel carries the messages of one job, so many jobs can share one connection.
+
+    File chunks are flow controlled per channel: a sender may have at most WINDOW_FRAMES of them unprocessed
+    by the receiver, which grants more with CREDIT control messages as it consumes them. What a channel buffers
+    is bounded that way, without ever blocking the reader thread.
+"""
+import socket
+import struct
+import time
+from queue import Queue, Empty
+from threading import Lock, Event, Thread, Semaphore
+from typing import Dict, Optional
+
+CONTROL_CHANNEL = 0
+WINDOW_FRAMES = 8               # flow-controlled frames a channel may have in flight to the peer
+CREDIT = 'CREDIT|'
+
+_frame_header = struct.Struct('!II')
+
+
+def recv_exact(sock, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        count = sock.recv_into(view[pos:], size - pos)
+        if count == 0:
+            raise ConnectionError('connection closed by peer')
+        pos += count
+    return bytes(buf)
+
+
+class Channel:
+    """One job's view of a session, used like a message pipe"""
+
+    def __init__(self, session, channel_id: int):
+        self.session = session
+        self.id = channel_id
+        # unbounded, so a slow channel never holds up the reader thread, and with it the heartbeats and
+        # the other channels of the session. Large payloads are kept in check by the credit window instead.
+        self.inbox: Queue = Queue()
+        self.credits = Semaphore(WINDOW_FRAMES)
+        self.consumed = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed.is_set()
+
+    def send(self, payload: bytes):
+        self.session.send(self.id, payload)
+
+    def recv(self, timeout: Optional[float] = None) -> bytes:
+        """Wait for the next frame on this channel.
+
+        :raises ConnectionError: if the session dies while waiting
+        :raises TimeoutError:    if nothing arrived within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.inbox.get(timeout=0.5)
+            except Empty:
+                if self.session.closed.is_set():
+                    raise ConnectionError('session closed')
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError('no response on channel')
+
+    def poll(self) -> Optional[bytes]:
+        """Return the next frame if one is waiting, without blocking"""
+        try:
+            return self.inbox.get_nowait()
+        except Empty:
+            if self.session.closed.is_set():
+                raise ConnectionError('session closed')
+            return None
+
+    def wait_credit(self) -> bool:
+        """Wait until the peer can take another flow-controlled frame.
+
+        :return: False if a message arrived from the peer in the meantime (ie. it gave up on the transfer)
+        :raises ConnectionError: if the session dies while waiting
+        """
+        while not self.credits.acquire(timeout=0.5):
+            if self.session.closed.is_set():
+                raise ConnectionError('session closed')
+            if not self.inbox.empty():
+                return False
+        return True
+
+    def frame_consumed(self):
+        """A flow-controlled frame has been processed, grant the peer more once half the window is used"""
+        self.consumed += 1
+        if self.consumed >= WINDOW_FRAMES // 2:
+            self.session.send_control(f'{CREDIT}{self.id}|{self.consumed}')
+            self.consumed = 0
+
+    def grant(self, frames: int):
+        for _ in range(frames):
+            self.credits.release()
+
+    def close(self):
+        self.session.remove_channel(self.id)
+
+
+class Session:
+    """Base for both ends of a connection. A reader thread routes incoming frames to their channels."""
+
+    def __init__(self, sock, timeout: float):
+        """
+        :param sock:    Connected socket
+        :param timeout: Seconds of silence from the peer after which the session is considered dead
+        """
+        self.sock = sock
+        self.timeout = timeout
+        self.send_lock = Lock()
+        self.channels: Dict[int, Channel] = dict()
+        self.channels_lock = Lock()
+        self.closed = Event()
+
+    def send(self, channel_id: int, payload: bytes):
+        if self.closed.is_set():
+            raise ConnectionError('session closed')
+        try:
+            with self.send_lock:
+                self.sock.sendall(_frame_header.pack(channel_id, len(payload)))
+                self.sock.sendall(payload)
+        except OSError:
+            self.close()
+            raise
+
+    def send_control(self, msg: str):
+        self.send(CONTROL_CHANNEL, msg.encode())
+
+    def add_channel(self, channel_id: int) -> Channel:
+        channel = Channel(self, channel_id)
+        with self.channels_lock:
+            self.channels[channel_id] = channel
+        return channel
+
+    def remove_channel(self, channel_id: int):
+        with self.channels_lock:
+            self.channels.pop(channel_id, None)
+
+    def start_reader(self):
+        Thread(target=self.read_loop, name='session-reader', daemon=True).start()
+
+    def read_loop(self):
+        try:
+            while not self.closed.is_set():
+                self.sock.settimeout(self.timeout)
+                channel_id, size = _frame_header.unpack(recv_exact(self.sock, _frame_header.size))
+                payload = recv_exact(self.sock, size)
+                if channel_id == CONTROL_CHANNEL:
+                    msg = payload.decode()
+                    if msg.startswith(CREDIT):
+                        self.on_credit(msg)
+                    else:
+                        self.on_control(msg)
+                    continue
+                with self.channels_lock:
+                    channel = self.channels.get(channel_id, None)
+                if channel is None:
+                    self.on_new_channel(channel_id, payload)
+                    continue
+                channel.inbox.put_nowait(payload)
+        except (OSError, ValueError):
+            # includes socket.timeout - the peer stopped answering heartbeats
+            pass
+        finally:
+            self.close()
+
+    def on_credit(self, msg: str):
+        _, channel_id, frames = msg.split('|')
+        with self.channels_lock:
+            channel = self.channels.get(int(channel_id), None)
+        if channel is not None:
+            channel.grant(int(frames))
+
+    def on_control(self, msg: str):
+        pass
+
+    def on_new_channel(self, channel_id: int, payload: bytes):
+        """Frame for an unknown channel - the agent starts a job here, the cluster manager drops it"""
+        pass
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            # unblock any thread still sending or receiving
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
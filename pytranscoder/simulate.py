@@ -0,0 +1,250 @@
+"""
+    Discrete-event simulation of a cluster run, for comparing queue, slot and host settings without encoding anything.
+
+    Jobs are matched to profiles with Cluster.match and put on the queues of a Cluster, which also creates the host
+    threads; one worker is simulated per thread. Each worker takes the next job from its queue as soon as it is free
+    and stops when the queue is empty, like the ManagedHost threads. Time is virtual and ties are broken by host order,
+    so a run is repeatable.
+
+    Job durations come from per-host speed profiles (--speeds), a YAML or JSON file such as:
+
+        default:
+          speed: 1.0            # encode speed as a multiple of realtime, for 1080p, per slot with all slots busy
+        hosts:
+          bigbox:
+            speed: 2.5
+            profiles:           # optional speed per profile
+              hevc_hq: 1.2
+            transfer_mbps: 900  # network rate for agent and streaming hosts, which copy media both ways
+            overhead: 3         # seconds of fixed cost per job (startup, probing, renaming)
+            output_ratio: 0.5   # output size as a fraction of the input, for download time
+
+    Encode time scales with the pixel count of the media relative to 1080p. Remuxes take only the overhead and transfers.
+"""
+import heapq
+import json
+import os
+from queue import Queue, Empty
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+from pytranscoder.cluster import Cluster
+from pytranscoder.config import ConfigFile
+from pytranscoder.media import MediaInfo
+from pytranscoder.remux import RemuxDirective
+from pytranscoder.status import format_eta
+from pytranscoder.timing import JobTiming
+
+REFERENCE_PIXELS = 1920 * 1080
+TRANSFER_HOST_TYPES = ['agent', 'streaming']
+
+
+class SpeedProfile:
+    """How fast one host works through a job"""
+
+    def __init__(self, props: Dict, defaults: Optional[Dict] = None):
+        settings = dict(defaults or {})
+        settings.update(props or {})
+        self.speed = float(settings.get('speed', 1.0))
+        self.profiles: Dict[str, float] = settings.get('profiles', {})
+        self.transfer_mbps = float(settings.get('transfer_mbps', 1000))
+        self.overhead = float(settings.get('overhead', 0))
+        self.output_ratio = float(settings.get('output_ratio', 0.5))
+
+    def encode_seconds(self, media: MediaInfo, directive: str) -> float:
+        speed = float(self.profiles.get(directive, self.speed))
+        pixels = (media.res_width or 1920) * (media.res_height or 1080)
+        return media.runtime * pixels / REFERENCE_PIXELS / speed
+
+    def transfer_seconds(self, media: MediaInfo) -> float:
+        megabits = media.filesize_mb * 8 * (1 + self.output_ratio)
+        return megabits / self.transfer_mbps
+
+
+class SimJob:
+
+    def __init__(self, media: MediaInfo, directive: str, queue: str, remux: bool = False):
+        self.media = media
+        self.directive = directive
+        self.queue = queue
+        self.remux = remux
+        self.start = 0.0
+        self.end = 0.0
+
+
+class SimSlot:
+    """One worker thread of a host, serving one queue"""
+
+    def __init__(self, host: str, host_type: str, queue: str, speed: SpeedProfile):
+        self.host = host
+        self.host_type = host_type
+        self.queue = queue
+        self.speed = speed
+        self.jobs: List[SimJob] = list()
+
+    def duration(self, job: SimJob) -> float:
+        seconds = self.speed.overhead
+        if not job.remux:
+            seconds += self.speed.encode_seconds(job.media, job.directive)
+        if self.host_type in TRANSFER_HOST_TYPES:
+            seconds += self.speed.transfer_seconds(job.media)
+        return seconds
+
+    @property
+    def busy(self) -> float:
+        return sum([job.end - job.start for job in self.jobs])
+
+    @property
+    def finished(self) -> float:
+        return self.jobs[-1].end if len(self.jobs) > 0 else 0.0
+
+    def idle(self, makespan: float) -> List[float]:
+        """Periods without a job over the whole run: before the first, between jobs and after the last"""
+        starts = [job.start for job in self.jobs] + [makespan]
+        ends = [0.0] + [job.end for job in self.jobs]
+        return [start - end for start, end in zip(starts, ends) if start > end]
+
+
+def load_media(path: str) -> List[MediaInfo]:
+    """Read media details saved with --save-media, one JSON object per line"""
+    media = list()
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                media.append(MediaInfo(json.loads(line)))
+    return media
+
+
+def load_speeds(path: Optional[str]) -> Dict:
+    if path is None:
+        return dict()
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=yaml.Loader) or dict()
+
+
+def plan_jobs(cluster: Cluster, media: List[MediaInfo], forced_directive: Optional[str]) -> Tuple[List[SimJob], int]:
+    """Match media to profiles and queues with Cluster.match, as Cluster.enqueue does.
+
+    :return: Jobs to run, and the number of media skipped, by rules or for lack of a directive
+    """
+    jobs = list()
+    skipped = 0
+    for info in media:
+        directive, _ = cluster.match(info.path, info, forced_directive, JobTiming())
+        if directive is None:
+            skipped += 1
+            continue
+        queue = directive.queue_name() if directive.queue_name() is not None else '_default'
+        jobs.append(SimJob(info, directive.name(), queue, isinstance(directive, RemuxDirective)))
+    return jobs, skipped
+
+
+def build_slots(cluster: Cluster, speeds: Dict) -> List[SimSlot]:
+    """One worker per host thread of the cluster, serving the same queue"""
+    slots = list()
+    host_speeds = speeds.get('hosts', {}) or {}
+    queue_names = {id(queue): name for name, queue in cluster.queues.items()}
+    for host in cluster.hosts:
+        speed = SpeedProfile(host_speeds.get(host.hostname, {}), speeds.get('default', {}))
+        slots.append(SimSlot(host.hostname, host.props.host_type, queue_names[id(host.queue)], speed))
+    return slots
+
+
+def simulate(jobs: List[SimJob], slots: List[SimSlot], queues: Dict[str, Queue]) -> List[SimJob]:
+    """Run the jobs on the slots in virtual time, through the queues of the cluster.
+
+    :return: Jobs left over in queues no host serves
+    """
+    unserved = list()
+    for job in jobs:
+        if job.queue in queues:
+            queues[job.queue].put(job)
+        else:
+            unserved.append(job)
+
+    free = [(0.0, order, slot) for order, slot in enumerate(slots)]
+    heapq.heapify(free)
+    while len(free) > 0:
+        now, order, slot = heapq.heappop(free)
+        try:
+            job = queues[slot.queue].get_nowait()
+        except Empty:
+            # queue drained, the host thread ends
+            continue
+        job.start = now
+        job.end = now + slot.duration(job)
+        slot.jobs.append(job)
+        heapq.heappush(free, (job.end, order, slot))
+
+    return unserved
+
+
+def report(slots: List[SimSlot], jobs: List[SimJob], unserved: List[SimJob], skipped: int):
+    makespan = max([slot.finished for slot in slots] + [0.0])
+    print(f'{len(jobs)} job(s), {skipped} skipped, makespan {format_eta(makespan)}')
+    if len(unserved) > 0:
+        queues = sorted(set([job.queue for job in unserved]))
+        print(f'{len(unserved)} job(s) in queue(s) no enabled host serves: {", ".join(queues)}')
+
+    print()
+    print(f'{"HOST":16} {"SLOTS":>5} {"JOBS":>5} {"BUSY":>10} {"UTIL":>5} {"FINISHED":>10} {"IDLE":>10} '
+          f'{"LONGEST IDLE":>12}')
+    hosts: Dict[str, List[SimSlot]] = dict()
+    for slot in slots:
+        hosts.setdefault(slot.host, []).append(slot)
+    for host, host_slots in hosts.items():
+        busy = sum([slot.busy for slot in host_slots])
+        capacity = makespan * len(host_slots)
+        util = int(busy * 100 / capacity) if capacity > 0 else 0
+        finished = max([slot.finished for slot in host_slots])
+        gaps = [gap for slot in host_slots for gap in slot.idle(makespan)] or [0.0]
+        print(f'{host:16.16} {len(host_slots):5} {sum([len(slot.jobs) for slot in host_slots]):5} '
+              f'{format_eta(busy):>10} {util:4}% {format_eta(finished):>10} {format_eta(sum(gaps)):>10} '
+              f'{format_eta(max(gaps)):>12}')
+
+    print()
+    print(f'{"QUEUE":16} {"JOBS":>5} {"MEAN WAIT":>10} {"MAX WAIT":>10}')
+    by_queue: Dict[str, List[SimJob]] = dict()
+    for job in jobs:
+        if job not in unserved:
+            by_queue.setdefault(job.queue, []).append(job)
+    for queue, queue_jobs in sorted(by_queue.items()):
+        waits = [job.start for job in queue_jobs]
+        print(f'{queue:16.16} {len(queue_jobs):5} {format_eta(sum(waits) / len(waits)):>10} '
+              f'{format_eta(max(waits)):>10}')
+
+
+def run(config: ConfigFile, media_path: str, speeds_path: Optional[str], cluster: Optional[str],
+        forced_directive: Optional[str] = None):
+    """Simulate the run of the saved media on a cluster (or the only one configured)"""
+    clusters = config.settings.get('clusters', None)
+    if not clusters:
+        print('Error: no clusters defined')
+        return
+    if cluster is None:
+        if len(clusters) > 1:
+            print(f'Select a cluster to simulate with -c ({", ".join(clusters.keys())})')
+            return
+        cluster = list(clusters.keys())[0]
+    if cluster not in clusters:
+        print(f'Cluster "{cluster}" not defined')
+        return
+
+    media = [info for info in load_media(media_path) if info.valid]
+    sim_cluster = Cluster(cluster, clusters[cluster], config, config.ssh_path)
+    jobs, skipped = plan_jobs(sim_cluster, media, forced_directive)
+    slots = build_slots(sim_cluster, load_speeds(speeds_path))
+    unserved = simulate(jobs, slots, sim_cluster.queues)
+    report(slots, jobs, unserved, skipped)
+
+
+def save_media(ffmpeg, paths: List[str], out_path: str):
+    """Probe media and append the details to out_path for later simulations"""
+    with open(out_path, 'a') as f:
+        for path in paths:
+            info = ffmpeg.fetch_details(os.path.abspath(path))
+            if info is None or not info.valid:
+                print(f'Unable to read media details of {path} - skipped')
+                continue
+            f.write(json.dumps(info.to_dict()) + '\n')
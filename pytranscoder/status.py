@@ -0,0 +1,154 @@
+"""
+    Aggregation of the progress reports posted to pytranscoder.status_queue into a periodically refreshed table
+"""
+import time
+from queue import Empty, Queue
+from threading import Condition
+from typing import Dict, Tuple, List, Optional, Callable, Any
+
+import pytranscoder
+from pytranscoder.console import Console, console as default_console
+
+REFRESH_SECONDS = 2
+LOG_REFRESH_SECONDS = 30        # when not writing to a terminal, print the table no more often than this
+STALE_SECONDS = 120             # drop a job that stopped reporting, ie. it finished or was skipped
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{(seconds % 3600) // 60:02}:{seconds % 60:02}'
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class StatusAggregator:
+    """Keeps the latest report of every job in progress and renders them at a fixed rate.
+
+    Worker threads call worker_finished() when done, which ends run() without waiting for the next refresh.
+    The overall ETA also covers jobs still waiting in the queues given to watch_queues(), at the combined speed
+    of the jobs in progress.
+    """
+
+    def __init__(self, refresh: float = REFRESH_SECONDS, console: Optional[Console] = None):
+        """
+        :param refresh: Seconds between table updates
+        :param console: Console to show the table on, redrawn in place if it is a terminal
+        """
+        self.refresh = refresh
+        self.console = console or default_console
+        self.jobs: Dict[Tuple[str, str], Dict] = dict()
+        self.workers = 0
+        self.cond = Condition()
+        self.last_table: List[str] = list()
+        self.last_render = 0.0
+        self.queues: List[Tuple[Queue, Callable[[Any], float]]] = list()
+
+    def worker_started(self):
+        with self.cond:
+            self.workers += 1
+
+    def worker_finished(self):
+        with self.cond:
+            self.workers -= 1
+            self.cond.notify_all()
+
+    def watch_queues(self, queues: Dict[str, Queue], runtime: Callable[[Any], float]):
+        """Include the jobs waiting in these queues in the overall ETA, runtime giving the media seconds of a job"""
+        for queue in queues.values():
+            self.queues.append((queue, runtime))
+
+    def queued(self) -> Tuple[int, float]:
+        """Number and total media runtime of the jobs not started yet"""
+        count = 0
+        seconds = 0.0
+        for queue, runtime in self.queues:
+            with queue.mutex:
+                jobs = list(queue.queue)
+            count += len(jobs)
+            seconds += sum([max(to_float(runtime(job)), 0) for job in jobs])
+        return count, seconds
+
+    def run(self):
+        """Render until all workers have finished"""
+        while True:
+            with self.cond:
+                done = self.cond.wait_for(lambda: self.workers <= 0, timeout=self.refresh)
+            self.collect()
+            if done:
+                break
+            self.render()
+
+    def collect(self):
+        """Take all pending reports from the status queue"""
+        now = time.monotonic()
+        while True:
+            try:
+                report = pytranscoder.status_queue.get_nowait()
+            except Empty:
+                break
+            key = (report['host'], report['file'])
+            if report.get('finished', False):
+                self.jobs.pop(key, None)
+            else:
+                self.jobs[key] = dict(report, updated=now)
+            pytranscoder.status_queue.task_done()
+
+        for key in [key for key, job in self.jobs.items() if now - job['updated'] > STALE_SECONDS]:
+            del self.jobs[key]
+
+    def table(self) -> List[str]:
+        lines = [f'{"HOST":16} {"FILE":40} {"SPEED":>7} {"FPS":>7} {"COMP":>5} {"DONE":>5} {"ETA":>9}']
+        hosts: Dict[str, Dict] = dict()
+        speed = 0.0                 # media seconds encoded per second, all jobs together
+        remaining = 0.0             # media seconds left in the jobs in progress
+        for (host, basename), job in sorted(self.jobs.items()):
+            fps = to_float(job.get('fps'))
+            eta = job.get('eta')
+            if eta is not None:
+                speed += to_float(job['speed'])
+                remaining += eta * to_float(job['speed'])
+            lines.append(f'{host:16.16} {basename:40.40} {job["speed"]:>6}x {fps:7.1f} {job["comp"]:4}% '
+                         f'{job["done"]:4}% {format_eta(eta):>9}')
+            totals = hosts.setdefault(host, {'jobs': 0, 'fps': 0.0, 'eta': None})
+            totals['jobs'] += 1
+            totals['fps'] += fps
+            if eta is not None:
+                totals['eta'] = max(eta, totals['eta'] or 0)
+
+        lines.append('-' * 95)
+        for host, totals in sorted(hosts.items()):
+            lines.append(f'{host:16.16} {totals["jobs"]:3} job(s) {totals["fps"]:9.1f} fps   '
+                         f'ETA {format_eta(totals["eta"])}')
+        etas = [totals['eta'] for totals in hosts.values() if totals['eta'] is not None]
+        overall_eta = max(etas) if len(etas) > 0 else None
+        queued, queued_runtime = self.queued()
+        if queued > 0:
+            # queued jobs are taken up as slots free, assume they encode as fast as the jobs in progress
+            overall_eta = max(overall_eta, (remaining + queued_runtime) / speed) if speed > 0 else None
+        fps = sum([totals['fps'] for totals in hosts.values()])
+        total = f'{"TOTAL":16} {len(self.jobs):3} job(s) {fps:9.1f} fps   ETA {format_eta(overall_eta)}'
+        if queued > 0:
+            total += f' ({queued} queued)'
+        lines.append(total)
+        return lines
+
+    def render(self):
+        if len(self.jobs) == 0:
+            return
+        now = time.monotonic()
+        in_place = self.console.in_place
+        if not in_place and now - self.last_render < max(self.refresh, LOG_REFRESH_SECONDS):
+            return
+        lines = self.table()
+        if not in_place and lines == self.last_table:
+            return
+        self.last_render = now
+        self.last_table = lines
+        self.console.status(lines)
@@ -2,7 +2,7 @@
 from __future__ import annotations
 from typing import Dict, List, Optional, Any
 
-from pytranscoder.profile import Directives
+from pytranscoder.profile import Directives, copy_audio_options
 
 
 class Template(Directives):
@@ -56,6 +56,27 @@ class Template(Directives):
     def threshold_check(self) -> int:
         return self.template.get('threshold_check', 100)
 
+    def threshold_samples(self) -> int:
+        return self.template.get('threshold_samples', 0)
+
+    def threshold_sample_secs(self) -> int:
+        return self.template.get('threshold_sample_secs', 10)
+
+    def segments(self) -> int:
+        return self.template.get('segments', 0)
+
+    def checkpoint_secs(self) -> int:
+        return self.template.get('checkpoint_secs', 0)
+
+    def remux(self) -> bool:
+        return self.template.get('remux', False)
+
+    def threshold_history(self) -> bool:
+        return self.template.get('threshold_history', False)
+
+    def autocrop(self) -> bool:
+        return self.template.get('autocrop', False)
+
     def _map_streams(self, stream_type: str, streams: List) -> list:
         seq_list = list()
         mapped = list()
@@ -114,3 +135,11 @@ class Template(Directives):
         audio_streams = self._map_streams("a", audio)
         subtitle_streams = self._map_streams("s", subtitle)
         return seq_list + audio_streams + subtitle_streams
+
+    def audio_options(self, audio: List) -> List[str]:
+        codecs = (self.template.get("audio-copy", None) or "").split()
+        if len(codecs) == 0:
+            return []
+        includes = (self.template.get("audio-lang", None) or "").split()
+        mapped = [s for s in audio if len(includes) == 0 or s.get('lang', 'none') in includes]
+        return copy_audio_options(mapped, codecs, self.template.get("audio-copy-bitrate", None))
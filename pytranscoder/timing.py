@@ -0,0 +1,124 @@
+"""
+    Wall time spent in each phase of a job and the resources used by its encode, for the run summary
+    and JSON lines export (--timing-log)
+"""
+import json
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, IO, Optional, List
+
+from pytranscoder.usage import ResourceUsage
+
+PHASES = ['probe', 'match', 'crop', 'queue_wait', 'sample', 'upload', 'encode', 'download', 'threshold', 'finalize']
+
+
+class JobTiming:
+    """Seconds spent per phase of one job, measured with perf_counter. Repeated phases (ie. a job
+       returned to the queue and picked up again) accumulate.
+    """
+
+    def __init__(self, directive: str = ''):
+        self.phases: Dict[str, float] = dict()
+        self.enqueued: Optional[float] = None
+        self.directive = directive
+        self.usage: Optional[ResourceUsage] = None
+        self.predicted_comp: Optional[int] = None       # percent compression predicted by sample encodes
+        self.media: Optional[Dict] = None               # source media features, for the history of outcomes
+        self.predicted_saved: Optional[int] = None      # percent saved predicted from the history
+        self.predicted_secs: Optional[float] = None
+        self.predicted_cpu_secs: Optional[float] = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def queued(self):
+        self.enqueued = time.perf_counter()
+
+    def dequeued(self):
+        if self.enqueued is not None:
+            self.add('queue_wait', time.perf_counter() - self.enqueued)
+            self.enqueued = None
+
+    def account(self, usage: Optional[ResourceUsage]):
+        """Add the resource usage of an encode of this job, if it could be measured"""
+        if usage is None:
+            return
+        if self.usage is None:
+            self.usage = ResourceUsage()
+        self.usage.add(usage)
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+
+class TimingLog:
+    """Timing and resource usage records of finished and failed jobs, optionally appended to a JSON lines file
+       as each job finishes
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.records: List[Dict] = list()
+        self.export_path: Optional[str] = None
+        self.export: Optional[IO] = None
+
+    def record(self, path: str, host: str, timing: JobTiming, failed: bool = False):
+        rec = {'file': path, 'host': host, 'directive': timing.directive, 'time': time.time(), 'failed': failed,
+               'total': round(timing.total, 6)}
+        rec.update({name: round(timing.phases.get(name, 0.0), 6) for name in PHASES})
+        if timing.usage is not None:
+            rec.update(timing.usage.to_dict())
+        else:
+            # not measured, ie. ffmpeg run over ssh
+            rec.update({name: None for name in ResourceUsage.FIELDS})
+        with self.lock:
+            self.records.append(rec)
+            if self.export_path is not None:
+                if self.export is None:
+                    self.export = open(self.export_path, 'a')
+                self.export.write(json.dumps(rec) + '\n')
+                self.export.flush()
+
+    def close(self):
+        with self.lock:
+            if self.export is not None:
+                self.export.close()
+                self.export = None
+
+    def phase_totals(self) -> Dict[str, float]:
+        with self.lock:
+            return {name: sum([rec[name] for rec in self.records]) for name in PHASES}
+
+    def usage_by_directive(self) -> Dict[str, Dict]:
+        """Resource usage totals of the measured jobs of each directive, with the peak and mean of max RSS"""
+        totals: Dict[str, Dict] = dict()
+        with self.lock:
+            for rec in self.records:
+                if rec['cpu_user'] is None:
+                    continue
+                entry = totals.setdefault(rec['directive'], {'jobs': 0, 'cpu_user': 0.0, 'cpu_sys': 0.0,
+                                                             'peak_rss_kb': 0, 'mean_rss_kb': 0,
+                                                             'read_blocks': 0, 'write_blocks': 0})
+                entry['jobs'] += 1
+                entry['cpu_user'] += rec['cpu_user']
+                entry['cpu_sys'] += rec['cpu_sys']
+                entry['peak_rss_kb'] = max(entry['peak_rss_kb'], rec['max_rss_kb'])
+                entry['mean_rss_kb'] += rec['max_rss_kb']
+                entry['read_blocks'] += rec['read_blocks']
+                entry['write_blocks'] += rec['write_blocks']
+        for entry in totals.values():
+            entry['mean_rss_kb'] //= entry['jobs']
+        return totals
+
+
+timings = TimingLog()
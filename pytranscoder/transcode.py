@@ -7,8 +7,8 @@ import sys
 from pathlib import Path, PurePath
 from typing import Set, List, Optional
 
-from queue import Queue, Empty
-from threading import Thread, Lock
+from queue import Queue
+from threading import Thread
 import crayons
 
 import pytranscoder
@@ -17,11 +17,23 @@ from pytranscoder import __version__
 from pytranscoder.agent import Agent
 from pytranscoder.cluster import manage_clusters
 from pytranscoder.config import ConfigFile
+from pytranscoder.console import console
+from pytranscoder.crop import apply_crop
 from pytranscoder.ffmpeg import FFmpeg
+from pytranscoder.history import history, history_vetoed, order_queue, predicted_note
+from pytranscoder.journal import journal, completed_fields, report
 from pytranscoder.media import MediaInfo
-from pytranscoder.profile import Profile, Directives
+from pytranscoder.metrics import metrics, serve
+from pytranscoder.multi import MultiDirective, job_outputs, output_cli
+from pytranscoder.profile import Profile, Directives, stream_options
+from pytranscoder.remux import RemuxDirective, select_directive
+from pytranscoder.sample import predict_vetoed, log_prediction
+from pytranscoder.segment import SegmentedEncode, use_segments
+from pytranscoder import simulate
+from pytranscoder.status import StatusAggregator
 from pytranscoder.template import Template
-from pytranscoder.utils import filter_threshold, files_from_file, calculate_progress, dump_stats
+from pytranscoder.timing import JobTiming, timings
+from pytranscoder.utils import filter_threshold, files_from_file, calculate_progress, calculate_eta, dump_stats
 
 DEFAULT_CONFIG = os.path.expanduser('~/.transcode.yml')
 
@@ -29,11 +41,14 @@ DEFAULT_CONFIG = os.path.expanduser('~/.transcode.yml')
 class LocalJob:
     """One file with matched profile to be encoded"""
 
-    def __init__(self, inpath: str, directives: Directives, mixins: List[str], info: MediaInfo):
+    def __init__(self, inpath: str, directives: Directives, mixins: List[str], info: MediaInfo,
+                 timing: Optional[JobTiming] = None):
         self.inpath = Path(os.path.abspath(inpath))
         self.directives = directives
         self.info = info
         self.mixins = mixins
+        self.timing = timing or JobTiming()
+        self.timing.directive = directives.name()
 
 
 class QueueThread(Thread):
@@ -52,30 +67,128 @@ class QueueThread(Thread):
         self._manager = manager
         self.ffmpeg = FFmpeg(self.config.ffmpeg_path)
 
-    @property
-    def lock(self):
-        return self._manager.lock
-
-    def complete(self, path: Path, elapsed_seconds):
+    def complete(self, path: Path, elapsed_seconds, timing: Optional[JobTiming] = None):
         self._manager.complete.append((str(path), elapsed_seconds))
+        if timing is not None:
+            timings.record(str(path), 'local', timing)
+        pytranscoder.status_queue.put({'host': 'local', 'file': path.name, 'finished': True})
 
     def start_test(self):
         self.go()
 
     def run(self):
-        self.go()
+        try:
+            self.go()
+        finally:
+            self._manager.aggregator.worker_finished()
 
     def log(self, *args, **kwargs):
-        self.lock.acquire()
-        print(*args, **kwargs)
-        sys.stdout.flush()
-        self.lock.release()
+        console.print(*args, **kwargs)
+
+    def progress(self, job: LocalJob, stats):
+        """Report the progress of an encode, returning percent done and compression"""
+        pct_done, pct_comp = calculate_progress(job.info, stats)
+        pytranscoder.status_queue.put({ 'host': 'local',
+                                        'file': job.inpath.name,
+                                        'speed': stats['speed'],
+                                        'fps': stats.get('fps', 0),
+                                        'eta': calculate_eta(job.info, stats),
+                                        'comp': pct_comp,
+                                        'done': pct_done})
+        journal.job('progress', 'local', job.inpath, job.timing, speed=stats['speed'],
+                    fps=stats.get('fps', 0), comp=pct_comp, done=pct_done)
+        return pct_done, pct_comp
+
+    def encode_outputs(self, job: LocalJob):
+        """Encode a job of several directives as one ffmpeg process, with an output for each"""
+        outputs = job_outputs(job.directives, job.inpath, self.config.fls_path())
+        cli = output_cli(self.config, job.inpath, job.info, outputs, job.mixins)
+        console.print('-' * 40,
+                      'Filename : ' + crayons.green(job.inpath.name),
+                      f'Directive: {job.directives.name()}',
+                      'ffmpeg   :' + ' '.join(cli) + '\n', sep='\n')
+        if pytranscoder.dry_run:
+            return
+
+        # outputs predicted to miss their threshold are dropped before the encode starts
+        for output in outputs:
+            output.vetoed = predict_vetoed(self.config.ffmpeg_path, self.config, str(job.inpath), job.info,
+                                           output.directive, job.mixins, job.timing, self.log)
+            output.predicted_comp, job.timing.predicted_comp = job.timing.predicted_comp, None
+            if output.vetoed:
+                metrics.job_vetoed('local')
+                journal.event('vetoed', host='local', file=str(job.inpath), directive=output.directive.name(),
+                              reason='predicted', predicted_comp=output.predicted_comp)
+        outputs = [output for output in outputs if not output.vetoed]
+        if len(outputs) == 0:
+            self.complete(job.inpath, 0, job.timing)
+            return
+        cli = output_cli(self.config, job.inpath, job.info, outputs, job.mixins)
+
+        def log_callback(stats):
+            # the size ffmpeg reports is not per output, so thresholds are only checked once finished
+            self.progress(job, stats)
+            return False
+
+        journal.job('started', 'local', job.inpath, job.timing)
+        job_start = datetime.datetime.now()
+        with job.timing.phase('encode'):
+            code = self.ffmpeg.run(cli, log_callback)
+        job.timing.account(self.ffmpeg.last_usage)
+        elapsed = datetime.datetime.now() - job_start
+
+        if code != 0:
+            metrics.job_failed('local')
+            journal.job('failed', 'local', job.inpath, job.timing, reason=f'exit code {code}')
+            timings.record(str(job.inpath), 'local', job.timing, failed=True)
+            self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
+            self.log(f'Output can be found in {self.ffmpeg.log_path}')
+            for output in outputs:
+                try:
+                    os.unlink(str(output.path))
+                except:
+                    pass
+            return
+
+        orig_size = os.path.getsize(str(job.inpath))
+        for output in outputs:
+            new_size = os.path.getsize(str(output.path))
+            job.timing.predicted_comp = output.predicted_comp
+            fields = completed_fields(job.timing, orig_size, new_size)
+            with job.timing.phase('threshold'):
+                kept = filter_threshold(output.directive, str(job.inpath), str(output.path))
+            if not kept:
+                self.log(f'{output.directive.name()} output of {job.inpath} did not meet minimum savings threshold, '
+                         f'skipped')
+                log_prediction(self.log, job.timing, orig_size, new_size)
+                metrics.job_vetoed('local')
+                journal.event('vetoed', host='local', file=str(job.inpath), directive=output.directive.name(), **fields)
+                os.unlink(str(output.path))
+                continue
+
+            metrics.job_completed('local', orig_size, new_size)
+            log_prediction(self.log, job.timing, orig_size, new_size)
+            journal.event('completed', host='local', file=str(job.inpath), directive=output.directive.name(), **fields)
+            if output.primary and pytranscoder.keep_source:
+                self.log(crayons.yellow(f'Finished {output.path}, original file unchanged'))
+                continue
+            with job.timing.phase('finalize'):
+                if output.primary:
+                    job.inpath.unlink()
+                shutil.move(str(output.path), str(output.final))
+            self.log(crayons.green(f'Finished {output.final}'))
+        job.timing.predicted_comp = None
+        self.complete(job.inpath, elapsed.seconds, job.timing)
 
     def go(self):
 
         while not self.queue.empty():
             try:
                 job: LocalJob = self.queue.get()
+                job.timing.dequeued()
+                if isinstance(job.directives, MultiDirective):
+                    self.encode_outputs(job)
+                    continue
 
                 fls = False
                 if self.config.fls_path():
@@ -85,35 +198,33 @@ class QueueThread(Thread):
                 else:
                     outpath = job.inpath.with_suffix(job.directives.extension() + '.tmp')
 
-                stream_map = []
-                if job.info.is_multistream() and self.config.automap:
-                    stream_map = job.directives.stream_map(job.info.stream, job.info.audio, job.info.subtitle)
+                stream_map = stream_options(job.directives, job.info, self.config.automap)
                 cli = ['-y', *job.directives.input_options_list(), '-i', str(job.inpath), *job.directives.output_options_list(self.config, job.mixins), *stream_map, str(outpath)]
 
                 #
                 # display useful information
                 #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print( 'Filename : ' + crayons.green(os.path.basename(str(job.inpath))))
-                    print(f'Directive: {job.directives.name()}')
-                    print( 'ffmpeg   :' + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
+                console.print('-' * 40,
+                              'Filename : ' + crayons.green(os.path.basename(str(job.inpath))),
+                              f'Directive: {job.directives.name()}{predicted_note(job.timing)}',
+                              'ffmpeg   :' + ' '.join(cli) + '\n', sep='\n')
 
                 if pytranscoder.dry_run:
                     continue
 
+                if predict_vetoed(self.config.ffmpeg_path, self.config, str(job.inpath), job.info, job.directives,
+                                  job.mixins, job.timing, self.log):
+                    metrics.job_vetoed('local')
+                    journal.job('vetoed', 'local', job.inpath, job.timing, reason='predicted',
+                                predicted_comp=job.timing.predicted_comp)
+                    self.complete(job.inpath, 0, job.timing)
+                    continue
+
+                journal.job('started', 'local', job.inpath, job.timing)
                 basename = job.inpath.name
 
                 def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.info, stats)
-                    pytranscoder.status_queue.put({ 'host': 'local',
-                                                    'file': basename,
-                                                    'speed': stats['speed'],
-                                                    'comp': pct_comp,
-                                                    'done': pct_done})
+                    pct_done, pct_comp = self.progress(job, stats)
                     if job.directives.threshold_check() < 100:
                         if pct_done >= job.directives.threshold_check() and pct_comp < job.directives.threshold():
                             # compression goal (threshold) not met, kill the job and waste no more time...
@@ -122,35 +233,65 @@ class QueueThread(Thread):
                     return False
 
                 job_start = datetime.datetime.now()
-                code = self.ffmpeg.run(cli, log_callback)
+                runner = self.ffmpeg
+                with job.timing.phase('encode'):
+                    if use_segments(job.directives, job.info):
+                        runner = SegmentedEncode(self.config.ffmpeg_path, self.config, str(job.inpath), str(outpath),
+                                                 job.info, job.directives, job.mixins)
+                        self.log(f'Encoding {basename} in {runner.count} segments')
+                        code = runner.run(log_callback, self.log)
+                    else:
+                        code = self.ffmpeg.run(cli, log_callback)
+                job.timing.account(runner.last_usage)
                 job_stop = datetime.datetime.now()
                 elapsed = job_stop - job_start
 
-                if code == 0:
-                    if not filter_threshold(job.directives, str(job.inpath), outpath):
+                if code is None:
+                    metrics.job_vetoed('local')
+                    journal.job('vetoed', 'local', job.inpath, job.timing)
+                    timings.record(str(job.inpath), 'local', job.timing)
+                elif code == 0:
+                    with job.timing.phase('threshold'):
+                        kept = filter_threshold(job.directives, str(job.inpath), outpath)
+                    if not kept:
                         # oops, this transcode didn't do so well, lets keep the original and scrap this attempt
                         self.log(f'Transcoded file {job.inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(job.inpath, (job_stop - job_start).seconds)
+                        orig_size, new_size = os.path.getsize(str(job.inpath)), os.path.getsize(str(outpath))
+                        log_prediction(self.log, job.timing, orig_size, new_size)
+                        metrics.job_vetoed('local')
+                        journal.job('vetoed', 'local', job.inpath, job.timing,
+                                    **completed_fields(job.timing, orig_size, new_size))
+                        self.complete(job.inpath, (job_stop - job_start).seconds, job.timing)
                         os.unlink(str(outpath))
                         continue
 
-                    self.complete(job.inpath, elapsed.seconds)
+                    metrics.job_completed('local', os.path.getsize(str(job.inpath)), os.path.getsize(str(outpath)))
+                    log_prediction(self.log, job.timing, os.path.getsize(str(job.inpath)),
+                                   os.path.getsize(str(outpath)))
+                    journal.job('completed', 'local', job.inpath, job.timing,
+                                **completed_fields(job.timing, os.path.getsize(str(job.inpath)),
+                                                   os.path.getsize(str(outpath))))
                     if not pytranscoder.keep_source:
                         if pytranscoder.verbose:
                             self.log(f'replacing {job.inpath} with {outpath}')
-                        job.inpath.unlink()
+                        with job.timing.phase('finalize'):
+                            job.inpath.unlink()
 
-                        if fls:
-                            shutil.move(outpath, job.inpath.with_suffix(job.directives.extension()))
-                        else:
-                            outpath.rename(job.inpath.with_suffix(job.directives.extension()))
+                            if fls:
+                                shutil.move(outpath, job.inpath.with_suffix(job.directives.extension()))
+                            else:
+                                outpath.rename(job.inpath.with_suffix(job.directives.extension()))
 
                         self.log(crayons.green(f'Finished {job.inpath}'))
                     else:
                         self.log(crayons.yellow(f'Finished {outpath}, original file unchanged'))
-                elif code is not None:
-                    self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
-                    self.log(f'Output can be found in {self.ffmpeg.log_path}')
+                    self.complete(job.inpath, elapsed.seconds, job.timing)
+                else:
+                    metrics.job_failed('local')
+                    journal.job('failed', 'local', job.inpath, job.timing, reason=f'exit code {code}')
+                    timings.record(str(job.inpath), 'local', job.timing, failed=True)
+                    self.log(f' Did not complete normally: {runner.last_command}')
+                    self.log(f'Output can be found in {runner.log_path}')
                     try:
                         outpath.unlink()
                     except:
@@ -162,12 +303,13 @@ class QueueThread(Thread):
 class LocalHost:
     """Encapsulates functionality for local encoding"""
 
-    lock:       Lock = Lock()
     complete:   List = list()            # list of completed files, shared across threads
 
     def __init__(self, configfile: ConfigFile):
         self.queues = dict()
         self.configfile = configfile
+        self.aggregator = StatusAggregator()
+        metrics.aggregator = self.aggregator
 
         #
         # initialize the queues
@@ -175,6 +317,8 @@ class LocalHost:
         self.queues['_default_'] = Queue()
         for qname in configfile.queues.keys():
             self.queues[qname] = Queue()
+        metrics.watch_queues(self.queues)
+        self.aggregator.watch_queues(self.queues, lambda job: job.info.runtime)
 
     def start(self):
         """After initialization this is where processing begins"""
@@ -183,6 +327,8 @@ class LocalHost:
         #
         jobs = list()
         for name, queue in self.queues.items():
+            if history.enabled:
+                order_queue(queue, lambda job: job.info.filesize_mb, lambda job: job.timing)
 
             # determine the number of threads to allocate for each queue, minimum of defined max or queued jobs
 
@@ -197,27 +343,11 @@ class LocalHost:
             for _ in range(concurrent_max):
                 t = QueueThread(name, queue, self.configfile, self)
                 jobs.append(t)
+                self.aggregator.worker_started()
                 t.start()
 
-        busy = True
-        while busy:
-            try:
-                report = pytranscoder.status_queue.get(block=True, timeout=2)
-                basename = report['file']
-                speed = report['speed']
-                comp = report['comp']
-                done = report['done']
-
-                self.lock.acquire()
-                print(f'{basename}: speed: {speed}x, comp: {comp}%, done: {done:3}%')
-                sys.stdout.flush()
-                self.lock.release()
-                pytranscoder.status_queue.task_done()
-            except Empty:
-                busy = False
-                for job in jobs:
-                    if job.is_alive():
-                        busy = True
+        self.aggregator.run()
+        console.flush()
 
         # wait for all queues to drain and all jobs to complete
 #        for _, queue in self.queues.items():
@@ -248,7 +378,9 @@ class LocalHost:
             if forced_directive:
                 the_profile = self.configfile.get_directive(forced_directive)
 
-            media_info = ffmpeg.fetch_details(path)
+            timing = JobTiming()
+            with timing.phase('probe'):
+                media_info = ffmpeg.fetch_details(path)
 
             if media_info is None:
                 print(crayons.red(f'File not found: {path}'))
@@ -259,8 +391,10 @@ class LocalHost:
                 if pytranscoder.verbose:
                     print(str(media_info))
 
+                rule = None
                 if forced_directive is None:
-                    rule = self.configfile.match_rule(media_info)
+                    with timing.phase('match'):
+                        rule = self.configfile.match_rule(media_info)
                     if rule is None:
                         print(crayons.green(os.path.basename(path)), crayons.yellow(f'No matching profile or template found - skipped'))
                         continue
@@ -275,8 +409,22 @@ class LocalHost:
                     #
                     directive_name = forced_directive
 
-                the_directive = self.configfile.get_directive(directive_name)
+                the_directive = select_directive(self.configfile.get_directive(directive_name), media_info,
+                                                 self.configfile, rule)
                 qname = the_directive.queue_name()
+                journal.event('matched', file=os.path.abspath(path), directive=directive_name,
+                              size_mb=media_info.filesize_mb, rule=rule.name if forced_directive is None else None,
+                              remux=isinstance(the_directive, RemuxDirective))
+                if not isinstance(the_directive, RemuxDirective):
+                    history.apply(timing, media_info, directive_name)
+                    if history_vetoed(the_directive, timing):
+                        print(crayons.green(os.path.basename(path)),
+                              f'SKIPPED (history predicts {timing.predicted_saved}% saved)')
+                        journal.event('vetoed', file=os.path.abspath(path), directive=directive_name,
+                                      reason='history', predicted_saved=timing.predicted_saved)
+                        self.complete.append((path, 0))
+                        continue
+                    the_directive = apply_crop(self.configfile, path, media_info, the_directive, timing)
                 if pytranscoder.verbose:
                     print('Matched with {the_directive}')
                 if qname is not None:
@@ -286,11 +434,15 @@ class LocalHost:
                         )
                         sys.exit(1)
                     else:
-                        self.queues[qname].put(LocalJob(path, the_directive, mixins, media_info))
+                        timing.queued()
+                        self.queues[qname].put(LocalJob(path, the_directive, mixins, media_info, timing))
+                        journal.event('enqueued', file=os.path.abspath(path), directive=directive_name, queue=qname)
                         if pytranscoder.verbose:
                             print('Added to queue {qname}')
                 else:
-                    self.queues['_default_'].put(LocalJob(path, the_directive, mixins, media_info))
+                    timing.queued()
+                    self.queues['_default_'].put(LocalJob(path, the_directive, mixins, media_info, timing))
+                    journal.event('enqueued', file=os.path.abspath(path), directive=directive_name, queue='_default_')
 
 
 def cleanup_queuefile(queue_path: str, completed: Set):
@@ -334,8 +486,11 @@ def start():
         print('usage: pytranscoder [OPTIONS]')
         print('  or   pytranscoder [OPTIONS] --from-file <filename>')
         print('  or   pytranscoder [OPTIONS] file ...')
-        print('  or   pytranscoder --agent')
+        print('  or   pytranscoder --agent [--cache-size <GB>] [--slots <n>]')
         print('  or   pytranscoder -c <cluster> file... [--host <name>] -c <cluster> file...')
+        print('  or   pytranscoder --report <journal file>')
+        print('  or   pytranscoder --save-media <media file> file ...')
+        print('  or   pytranscoder --simulate <media file> [--speeds <file>] [-c <cluster>] [-p <profile>]')
         print('No parameters indicates to process the default queue files using profile matching rules.')
         print(
             'The --from-file filename is a file containing a list of full paths to files for transcoding. ')
@@ -344,14 +499,23 @@ def start():
         print('  -s         Process files sequentially even if configured for multiple concurrent jobs')
         print('  --dry-run  Run without actually transcoding or modifying anything, useful to test rules and profiles')
         print('  -v         Verbose output, helpful in debugging profiles and rules')
+        print('  --full-log Keep the complete ffmpeg output of every run, not just the tail of failed ones')
+        print('  --metrics-port <port>  Serve run metrics in Prometheus text format on http://localhost:<port>/metrics')
+        print('  --timing-log <file>  Append the time spent in each phase of every job to <file>, as JSON lines')
+        print('  --journal <file>  Append job events (queued, started, progress, outcome) to <file>, as JSON lines')
+        print('  --history <file>  Predict savings and encode time of each job from the outcomes in journal <file>,')
+        print('             and start the jobs expected to save the most per CPU hour first')
         print(
             '  -k         Keep source files after transcoding. If used, the transcoded file will have the same '
             'name and .tmp extension')
         print('  -y <file>  Full path to configuration file.  Default is ~/.transcode.yml')
         print('  -p         profile to use. If used with --from-file, applies to all listed media in <filename>')
+        print('             Separate multiples with a comma to encode them all with one ffmpeg (local mode only)')
         print('  -t         template to use, simpler alternative to profiles')
         print('  -m         Add mixins to profile. Separate multiples with a comma')
         print('  --agent    Start in agent mode on a host and listen for transcode requests from other pytranscoder.')
+        print('  --cache-size <GB>  In agent mode, keep up to <GB> of recently received media for reuse by retries and other profiles')
+        print('  --slots <n>  In agent mode, number of concurrent transcodes to accept (default 1)')
         print('\n** PyPi Repo: https://pypi.org/project/pytranscoder-ffmpeg/')
         print('** Read the docs at https://pytranscoder.readthedocs.io/en/latest/')
         sys.exit(0)
@@ -364,6 +528,14 @@ def start():
     mixins = None
     queue_path = None
     agent_mode = False
+    agent_cache_size = 0
+    agent_slots = 1
+    metrics_port = None
+    journal_path = None
+    history_path = None
+    save_media_path = None
+    simulate_path = None
+    speeds_path = None
     cluster = None
     configfile: Optional[ConfigFile] = None
     host_override = None
@@ -392,6 +564,32 @@ def start():
                 pytranscoder.keep_source = True
             elif sys.argv[arg] == '--dry-run':
                 pytranscoder.dry_run = True
+            elif sys.argv[arg] == '--full-log':
+                pytranscoder.full_log = True
+            elif sys.argv[arg] == '--metrics-port':     # serve run metrics on localhost
+                metrics_port = int(sys.argv[arg + 1])
+                arg += 1
+            elif sys.argv[arg] == '--timing-log':       # export per-phase job timing as JSON lines
+                timings.export_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--journal':          # record job events as JSON lines
+                journal_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--history':          # predict outcomes from a journal
+                history_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--report':           # summarize a journal and exit
+                report(sys.argv[arg + 1])
+                sys.exit(0)
+            elif sys.argv[arg] == '--save-media':       # probe files for later simulation
+                save_media_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--simulate':         # simulate a cluster run of saved media
+                simulate_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--speeds':           # host speed profiles for simulation
+                speeds_path = sys.argv[arg + 1]
+                arg += 1
             elif sys.argv[arg] == '--host':             # run all cluster encodes on specific host
                 host_override = sys.argv[arg + 1]
                 arg += 1
@@ -405,6 +603,11 @@ def start():
                 arg += 1
             elif sys.argv[arg] == "--agent":            # agent/server mode
                 agent_mode = True
+            elif sys.argv[arg] == "--cache-size":       # agent source media cache size (GB)
+                agent_cache_size = int(sys.argv[arg + 1]) * 1024
+                arg += 1
+            elif sys.argv[arg] == "--slots":            # agent concurrent transcodes
+                agent_slots = int(sys.argv[arg + 1])
                 arg += 1
             else:
                 if os.name == "nt":
@@ -419,13 +622,32 @@ def start():
             arg += 1
 
     if agent_mode:
-        agent = Agent()
+        agent = Agent(agent_cache_size, agent_slots)
         agent.run()
         sys.exit(0)
 
     if configfile is None:
         configfile = ConfigFile(DEFAULT_CONFIG)
 
+    if simulate_path is not None:
+        simulate.run(configfile, simulate_path, speeds_path, cluster, profile)
+        sys.exit(0)
+
+    if save_media_path is not None:
+        simulate.save_media(FFmpeg(configfile.ffmpeg_path), [f[0] for f in files], save_media_path)
+        sys.exit(0)
+
+    pytranscoder.log_buffer_kb = configfile.log_buffer_kb
+
+    if metrics_port is not None:
+        serve(metrics_port)
+
+    if history_path is not None:
+        history.load(history_path)
+
+    if journal_path is not None:
+        journal.open(journal_path)
+
     if not configfile.colorize:
         crayons.disable()
     else:
@@ -455,6 +677,8 @@ def start():
                     if name != host_override:
                         this_config['status'] = 'disabled'
         completed: List = manage_clusters(files, configfile)
+        journal.close()
+        timings.close()
         if len(completed) > 0:
             qpath = queue_path if queue_path is not None else configfile.default_queue_file
             pathlist = [p for p, _ in completed]
@@ -468,6 +692,8 @@ def start():
     # start all threads and wait for work to complete
     #
     host.start()
+    journal.close()
+    timings.close()
     if len(host.complete) > 0:
         completed_paths = [p for p, _ in host.complete]
         cleanup_queuefile(queue_path, set(completed_paths))
@@ -0,0 +1,193 @@
+"""
+    Messaging and chunked, checksummed file transfer over a session channel (see session.py)
+"""
+import hashlib
+import json
+import math
+import os
+from typing import List, Optional
+
+from pytranscoder.session import Channel
+
+CHUNK_SIZE = 1_000_000
+DIGEST_SIZE = 32                # sha256
+CHECKPOINT_CHUNKS = 64          # persist the resume manifest every 64 confirmed chunks
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 65536
+
+
+class TransferError(Exception):
+    """Raised when a received chunk or file does not match its checksum"""
+    pass
+
+
+def send_msg(channel: Channel, msg: str):
+    channel.send(msg.encode())
+
+
+def recv_msg(channel: Channel, timeout: Optional[float] = None) -> str:
+    return channel.recv(timeout).decode()
+
+
+def chunk_digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def file_digest(digests: List[bytes]) -> str:
+    """Whole-file digest, derived from the per-chunk digests so the file never has to be read twice"""
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def chunk_digests(path: str, upto: int) -> List[bytes]:
+    """Compute chunk digests of the first <upto> bytes of a local file (needed only when resuming)"""
+    digests = []
+    with open(path, 'rb') as f:
+        while upto > 0:
+            blk = f.read(min(CHUNK_SIZE, upto))
+            if len(blk) == 0:
+                break
+            digests.append(chunk_digest(blk))
+            upto -= len(blk)
+    return digests
+
+
+def sampled_fingerprint(path: str) -> str:
+    """Cheap content identity of a file: its size plus evenly spaced samples, including the first and last blocks"""
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        if size <= FINGERPRINT_SAMPLES * FINGERPRINT_SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            step = (size - FINGERPRINT_SAMPLE_SIZE) // (FINGERPRINT_SAMPLES - 1)
+            for i in range(FINGERPRINT_SAMPLES):
+                f.seek(i * step)
+                h.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return f'{h.hexdigest()[0:32]}-{size}'
+
+
+class TransferManifest:
+    """Record of the verified chunks of a partially received file, kept next to it for resuming"""
+
+    def __init__(self, path: str, size: int, ident: str):
+        """
+        :param path:    Path of the partial file being received
+        :param size:    Expected total size of the file
+        :param ident:   Identity of the source (ie. fingerprint), a mismatch invalidates any partial transfer
+        """
+        self.path = path
+        self.size = size
+        self.ident = ident
+        self.digests: List[bytes] = list()
+
+    @property
+    def manifest_path(self) -> str:
+        return self.path + '.json'
+
+    @property
+    def offset(self) -> int:
+        return min(len(self.digests) * CHUNK_SIZE, self.size)
+
+    def load(self):
+        """Pick up a previous partial transfer of the same file, if any"""
+        try:
+            with open(self.manifest_path, 'r') as f:
+                saved = json.load(f)
+            if saved['size'] == self.size and saved['ident'] == self.ident and os.path.exists(self.path):
+                digests = [bytes.fromhex(d) for d in saved['digests']]
+                if os.path.getsize(self.path) >= min(len(digests) * CHUNK_SIZE, self.size):
+                    self.digests = digests
+        except (OSError, ValueError, KeyError):
+            self.digests = list()
+        return self
+
+    def save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'ident': self.ident, 'digests': [d.hex() for d in self.digests]}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def remove(self):
+        for path in [self.path, self.manifest_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def finish(self, final_path: str):
+        os.replace(self.path, final_path)
+        try:
+            os.remove(self.manifest_path)
+        except FileNotFoundError:
+            pass
+
+
+def send_file(channel: Channel, path: str, offset: int = 0, digests: Optional[List[bytes]] = None) -> List[bytes]:
+    """Stream a file as checksummed chunks, starting at offset.
+
+    :param channel: Open session channel
+    :param path:    Local file to send
+    :param offset:  Position to resume from, must be on a chunk boundary or the end of the file
+    :param digests: Digests of the chunks before offset, if already known
+    :return:        Digests of all chunks of the file
+    """
+    if digests is None or len(digests) * CHUNK_SIZE < offset:
+        digests = chunk_digests(path, offset)
+    # a resume at the end of the file keeps the digest of its last, partial chunk
+    digests = digests[0:math.ceil(offset / CHUNK_SIZE)]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            blk = f.read(CHUNK_SIZE)
+            if len(blk) == 0:
+                break
+            if not channel.wait_credit():
+                # the receiver reported a problem, no point sending the rest
+                break
+            digest = chunk_digest(blk)
+            channel.send(digest + blk)
+            digests.append(digest)
+            if not channel.inbox.empty():
+                # the receiver reported a problem, no point sending the rest
+                break
+    return digests
+
+
+def receive_file(channel: Channel, manifest: TransferManifest, persist: bool = True) -> List[bytes]:
+    """Receive checksummed chunks into manifest.path, resuming at manifest.offset.
+
+    Every chunk is verified as it arrives and the manifest is checkpointed periodically so that an
+    interrupted transfer can later continue from the last confirmed offset.
+
+    :param channel:     Open session channel
+    :param manifest:    Manifest of the file being received
+    :param persist:     Save the manifest to disk for resuming
+    :return:            Digests of all chunks of the file
+    """
+    offset = manifest.offset
+    mode = 'r+b' if offset > 0 else 'wb'
+    with open(manifest.path, mode) as f:
+        f.truncate(offset)
+        f.seek(offset)
+        unsaved = 0
+        try:
+            while offset < manifest.size:
+                frame = channel.recv()
+                digest, blk = frame[0:DIGEST_SIZE], frame[DIGEST_SIZE:]
+                if chunk_digest(blk) != digest:
+                    raise TransferError(f'checksum mismatch on chunk {len(manifest.digests)}')
+                f.write(blk)
+                channel.frame_consumed()
+                manifest.digests.append(digest)
+                offset += len(blk)
+                unsaved += 1
+                if persist and unsaved >= CHECKPOINT_CHUNKS:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    manifest.save()
+                    unsaved = 0
+        finally:
+            if persist and unsaved > 0:
+                f.flush()
+                manifest.save()
+    return manifest.digests
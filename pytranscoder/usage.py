@@ -0,0 +1,127 @@
+"""
+    Resource usage (CPU time, peak memory, block I/O) of the ffmpeg child process of a job
+"""
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+
+LOST_STATUS = -1            # returncode of a child reaped elsewhere, whose exit status is unknown
+
+
+class ResourceUsage:
+    """CPU seconds, peak resident memory and blocks read/written (512-byte units on Linux) of one process"""
+
+    FIELDS = ['cpu_user', 'cpu_sys', 'max_rss_kb', 'read_blocks', 'write_blocks']
+
+    def __init__(self, cpu_user: float = 0.0, cpu_sys: float = 0.0, max_rss_kb: int = 0,
+                 read_blocks: int = 0, write_blocks: int = 0):
+        self.cpu_user = cpu_user
+        self.cpu_sys = cpu_sys
+        self.max_rss_kb = max_rss_kb
+        self.read_blocks = read_blocks
+        self.write_blocks = write_blocks
+
+    @staticmethod
+    def from_rusage(ru) -> 'ResourceUsage':
+        max_rss = ru.ru_maxrss
+        if sys.platform == 'darwin':
+            # reported in bytes rather than KB
+            max_rss //= 1024
+        return ResourceUsage(ru.ru_utime, ru.ru_stime, max_rss, ru.ru_inblock, ru.ru_oublock)
+
+    def add(self, other: 'ResourceUsage') -> 'ResourceUsage':
+        """Accumulate another run of the same job (ie. a retry). Peak memory is the larger of the two."""
+        self.cpu_user += other.cpu_user
+        self.cpu_sys += other.cpu_sys
+        self.max_rss_kb = max(self.max_rss_kb, other.max_rss_kb)
+        self.read_blocks += other.read_blocks
+        self.write_blocks += other.write_blocks
+        return self
+
+    def to_dict(self) -> Dict:
+        return {'cpu_user': round(self.cpu_user, 3), 'cpu_sys': round(self.cpu_sys, 3),
+                'max_rss_kb': self.max_rss_kb, 'read_blocks': self.read_blocks, 'write_blocks': self.write_blocks}
+
+    def to_field(self) -> str:
+        """Compact form for the agent protocol"""
+        return f'{self.cpu_user:.3f},{self.cpu_sys:.3f},{self.max_rss_kb},{self.read_blocks},{self.write_blocks}'
+
+    @staticmethod
+    def from_field(field: str) -> Optional['ResourceUsage']:
+        try:
+            user, system, rss, read, write = field.split(',')
+            return ResourceUsage(float(user), float(system), int(rss), int(read), int(write))
+        except ValueError:
+            return None
+
+
+def peak_rss_kb(pid: int) -> Optional[int]:
+    """High-water resident memory of a running process, from /proc (Linux), None if not available"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class AccountedPopen(subprocess.Popen):
+    """Popen that reaps its child itself with wait4(), from wait() and poll(), so the resource usage of that one
+    process is known after it exits.
+
+    Unlike getrusage(RUSAGE_CHILDREN) this is unaffected by other encodes running in parallel threads. The max RSS
+    reported by wait4() also counts the memory of this process the child was forked from, so on Linux the peak
+    sampled from /proc on every poll() is used instead; poll regularly while the child runs.
+    Where wait4() is not available (Windows) it behaves as a plain Popen and usage stays None.
+    """
+
+    usage: Optional[ResourceUsage] = None
+    sampled_rss_kb: Optional[int] = None
+
+    if hasattr(os, 'wait4'):
+
+        def poll(self) -> Optional[int]:
+            if self.returncode is None:
+                self.sample()
+                self.reap(os.WNOHANG)
+            return self.returncode
+
+        def wait(self, timeout: Optional[float] = None) -> int:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            delay = 0.001
+            while self.poll() is None:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(self.args, timeout)
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.25)
+            return self.returncode
+
+    def sample(self):
+        rss = peak_rss_kb(self.pid)
+        if rss is not None:
+            self.sampled_rss_kb = max(self.sampled_rss_kb or 0, rss)
+
+    def reap(self, options: int):
+        try:
+            pid, status, ru = os.wait4(self.pid, options)
+        except ChildProcessError:
+            # reaped elsewhere, the status is lost: count the run as failed rather than trust its output
+            print(f'Exit status of {self.args[0]} (pid {self.pid}) lost, treating the run as failed')
+            self.returncode = LOST_STATUS
+            return
+        if pid == 0:
+            return
+        self.usage = ResourceUsage.from_rusage(ru)
+        if self.sampled_rss_kb is not None:
+            self.usage.max_rss_kb = self.sampled_rss_kb
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
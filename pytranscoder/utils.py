@@ -3,11 +3,12 @@ import math
 import os
 import platform
 import subprocess
-from typing import Dict
+from typing import Dict, Optional
 
 import pytranscoder
 from pytranscoder.media import MediaInfo
 from pytranscoder.profile import Directives
+from pytranscoder.timing import timings, PHASES
 
 
 def filter_threshold(profile: Directives, inpath, outpath):
@@ -57,6 +58,17 @@ def calculate_progress(info: MediaInfo, stats: Dict) -> (int, int):
     return pct_done, pct_comp
 
 
+def calculate_eta(info: MediaInfo, stats: Dict) -> Optional[float]:
+    """Estimated seconds until the encode finishes, based on the remaining runtime and current speed"""
+    try:
+        speed = float(stats['speed'])
+    except (KeyError, ValueError):
+        return None
+    if info.runtime <= 0 or speed <= 0:
+        return None
+    return max(info.runtime - stats['time'], 0) / speed
+
+
 def run(cmd):
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False)
     output = p.communicate()[0].decode('utf-8')
@@ -77,3 +89,23 @@ def dump_stats(completed):
         _sec = int(elapsed % 60)
         print(f"{pathname}  ({_min:3}m {_sec:2}s)")
     print()
+
+    totals = timings.phase_totals()
+    wall = sum(totals.values())
+    if wall > 0:
+        print("Time by phase, all jobs:")
+        for phase in PHASES:
+            print(f"  {phase:12} {totals[phase]:10.2f}s  {totals[phase] * 100 / wall:5.1f}%")
+        print()
+
+    usage = timings.usage_by_directive()
+    if len(usage) > 0:
+        print("ffmpeg resource usage by directive:")
+        print(f"  {'DIRECTIVE':20} {'JOBS':>5} {'CPU USER':>10} {'CPU SYS':>9} {'CPU/JOB':>9} {'PEAK RSS':>9} "
+              f"{'MEAN RSS':>9} {'READ':>9} {'WRITE':>9}")
+        for name, entry in sorted(usage.items()):
+            cpu_per_job = (entry['cpu_user'] + entry['cpu_sys']) / entry['jobs']
+            print(f"  {name:20.20} {entry['jobs']:5} {entry['cpu_user']:9.1f}s {entry['cpu_sys']:8.1f}s "
+                  f"{cpu_per_job:8.1f}s {entry['peak_rss_kb'] // 1024:6} MB {entry['mean_rss_kb'] // 1024:6} MB "
+                  f"{entry['read_blocks'] * 512 // 1048576:6} MB {entry['write_blocks'] * 512 // 1048576:6} MB")
+        print()
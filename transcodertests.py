@@ -1,15 +1,48 @@
 
 import unittest
+import io
+import json
 import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from queue import Queue
 from typing import Dict
 from unittest import mock
 
-from pytranscoder.cluster import RemoteHostProperties, Cluster, StreamingManagedHost
+import pytranscoder
+from pytranscoder.agent import Agent, InputCache
+from pytranscoder.cluster import RemoteHostProperties, Cluster, StreamingManagedHost, AgentManagedHost, EncodeJob, \
+    ChunkedJob, SEGMENT_ATTEMPTS, manage_clusters
 from pytranscoder.config import ConfigFile
 from pytranscoder.ffmpeg import status_re, FFmpeg
-from pytranscoder.media import MediaInfo
-from pytranscoder.profile import Profile
+from pytranscoder.history import History, Outcome, history_vetoed, order_queue
+from pytranscoder.media import MediaInfo, kbps
+from pytranscoder.metrics import Metrics
+from pytranscoder.multi import MultiDirective, job_outputs, output_cli
+from pytranscoder.processor import OutputLog
+from pytranscoder.profile import Profile, stream_options
+from pytranscoder.remux import RemuxDirective, select_directive, video_codec
+from pytranscoder.rule import Rule
+from pytranscoder.sample import sample_offsets, predicted_compression, predict_vetoed, prediction_fields
+from pytranscoder.segment import SegmentedEncode, SegmentDirective, Checkpoint, split_times, segment_count, use_segments, \
+    output_format, concat_list
+from pytranscoder.session import Session, WINDOW_FRAMES
+from pytranscoder.status import StatusAggregator
+from pytranscoder.console import Console
+from pytranscoder.crop import CropCache, apply_crop, parse_crop, combine_crops, add_crop_filter
+from pytranscoder import simulate
+from pytranscoder.journal import Journal, completed_fields, read_journal, summarize
+from pytranscoder.template import Template
+from pytranscoder.timing import JobTiming, TimingLog
+from pytranscoder.usage import AccountedPopen, ResourceUsage, LOST_STATUS
 from pytranscoder.transcode import LocalHost
+from pytranscoder.transfer import TransferManifest, send_file, receive_file, file_digest, chunk_digests, CHUNK_SIZE, \
+    sampled_fingerprint, send_msg, recv_msg
 from pytranscoder.utils import files_from_file, get_local_os_type, calculate_progress, dump_stats, is_exceeded_threshold
 
 
@@ -92,6 +125,569 @@ class TranscoderTests(unittest.TestCase):
         self.assertIsNotNone(match, 'no ffmpeg status match')
         self.assertTrue(len(match.groups()) == 5, 'Expected 5 matches')
 
+    def test_ffmpeg_progress_blocks(self):
+        class FakeProc:
+            stdout = ['frame=0\n', 'fps=0.00\n', 'bitrate=N/A\n', 'total_size=N/A\n', 'out_time_us=N/A\n',
+                      'speed=N/A\n', 'progress=continue\n',
+                      'frame=307\n', 'fps=86.00\n', 'bitrate=2187.9kbits/s\n', 'total_size=3564544\n',
+                      'out_time_us=13030000\n', 'speed=3.67x\n', 'progress=end\n']
+            stderr = ['Input #0, matroska,webm, from \'test.mkv\':\n']
+            returncode = 0
+
+            def wait(self):
+                return 0
+
+        ffmpeg = FFmpeg('/usr/bin/ffmpeg')
+        ffmpeg.monitor_interval = 0
+        stats = list(ffmpeg.monitor_progress(FakeProc()))
+        self.assertEqual(len(stats), 2, 'Expected one update per progress block')
+        self.assertEqual(stats[0]['total_size'], 0, 'Expected N/A size to be reported as 0')
+        self.assertEqual(stats[1]['frame'], 307)
+        self.assertEqual(stats[1]['bitrate'], 2187.9)
+        self.assertEqual(stats[1]['out_time_us'], 13030000)
+        self.assertEqual(stats[1]['size'], 3564544)
+        self.assertEqual(stats[1]['time'], 13)
+        self.assertEqual(stats[1]['speed'], '3.67')
+        self.assertIsNone(ffmpeg.log_path, 'Expected transaction log removed after success')
+
+    def test_output_log_ring_buffer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = os.path.join(tmpdir, 'run.log')
+            output_log = OutputLog(log_path, max_kb=1)
+            for i in range(100):
+                output_log.write(f'line {i:03} ' + 'x' * 90 + '\n')
+            self.assertFalse(os.path.exists(log_path), 'Expected nothing written before the run ends')
+            self.assertLessEqual(output_log.size, 1024, 'Expected buffer bounded to max_kb')
+            output_log.save()
+            with open(log_path) as f:
+                lines = f.readlines()
+            self.assertTrue(lines[0].startswith('['), 'Expected note about lines not kept')
+            self.assertTrue(lines[-1].startswith('line 099'), 'Expected most recent output kept')
+
+    def test_output_log_buffer_setting(self):
+        self.assertEqual(ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg'}}).log_buffer_kb, 64)
+        config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg', 'log_buffer_kb': 8}})
+        self.assertEqual(config.log_buffer_kb, 8)
+        with mock.patch('pytranscoder.log_buffer_kb', config.log_buffer_kb):
+            ffmpeg = FFmpeg('/usr/bin/ffmpeg')
+            output_log = ffmpeg.open_log()
+            self.assertEqual(output_log.max_size, 8 * 1024, 'Expected buffer sized from the config setting')
+            ffmpeg.close_log(True)
+
+    @mock.patch('pytranscoder.full_log', True)
+    def test_vetoed_run_log(self):
+        script = 'import sys, time\n' \
+                 'for i in range(2000): sys.stderr.write(f"stderr {i}\\n")\n' \
+                 'sys.stderr.flush()\nprint("out_time_us=1000000\\nspeed=1.0x\\nprogress=continue", flush=True)\n' \
+                 'time.sleep(30)\n'
+        copy_stderr = FFmpeg.copy_stderr
+
+        def slow_copy(proc, output_log):
+            # stderr is still being copied when the run is vetoed
+            time.sleep(0.2)
+            copy_stderr(proc, output_log)
+
+        ffmpeg = FFmpeg(sys.executable)
+        ffmpeg.monitor_interval = 0
+        with mock.patch.object(FFmpeg, 'copy_stderr', side_effect=slow_copy):
+            code = ffmpeg.execute_and_monitor(['-c', script], lambda stats: True, ffmpeg.monitor_progress,
+                                              stderr=subprocess.PIPE)
+        self.assertIsNone(code, 'Expected the run vetoed')
+        with open(str(ffmpeg.log_path)) as f:
+            lines = f.readlines()
+        os.remove(str(ffmpeg.log_path))
+        self.assertEqual(len(lines), 2000, 'Expected all of stderr in the log before it was closed')
+
+    def test_status_aggregator(self):
+        aggregator = StatusAggregator()
+        reports = [{'host': 'h1', 'file': 'a.mkv', 'speed': '2.0', 'fps': 50.0, 'comp': 40, 'done': 10, 'eta': 600},
+                   {'host': 'h1', 'file': 'b.mkv', 'speed': '1.0', 'fps': 25.0, 'comp': 30, 'done': 50, 'eta': 100},
+                   {'host': 'h2', 'file': 'c.mkv', 'speed': '4.0', 'fps': 100.0, 'comp': 20, 'done': 90, 'eta': 60},
+                   {'host': 'h1', 'file': 'a.mkv', 'speed': '2.0', 'fps': 50.0, 'comp': 41, 'done': 20, 'eta': 500},
+                   {'host': 'h2', 'file': 'c.mkv', 'finished': True}]
+        for report in reports:
+            pytranscoder.status_queue.put(report)
+        aggregator.collect()
+        self.assertEqual(len(aggregator.jobs), 2, 'Expected latest report per job, finished jobs removed')
+        lines = aggregator.table()
+        self.assertTrue(lines[-2].startswith('h1') and '75.0 fps' in lines[-2], 'Expected per-host fps total')
+        self.assertTrue(lines[-1].startswith('TOTAL') and lines[-1].endswith('ETA 0:08:20'),
+                        'Expected overall ETA of the longest job')
+
+        # 2 jobs at a combined 3x realtime with 1100s of media left, plus 1900s of media queued
+        queue = Queue()
+        for runtime in [900, 1000]:
+            queue.put(mock.Mock(runtime=runtime))
+        aggregator.watch_queues({'q': queue}, lambda job: job.runtime)
+        lines = aggregator.table()
+        self.assertTrue(lines[-1].endswith('ETA 0:16:40 (2 queued)'), 'Expected queued jobs included in overall ETA')
+        queue.get()
+        queue.get()
+
+        aggregator.worker_started()
+        t = threading.Thread(target=aggregator.run)
+        t.start()
+        aggregator.worker_finished()
+        t.join(1)
+        self.assertFalse(t.is_alive(), 'Expected aggregator to stop as soon as the last worker finished')
+
+    def test_console_writer(self):
+        class SlowTerminal(io.StringIO):
+            def __init__(self):
+                super().__init__()
+                self.writing = threading.Event()
+                self.gate = threading.Event()
+
+            def isatty(self):
+                return True
+
+            def write(self, text):
+                self.writing.set()
+                self.gate.wait()
+                return super().write(text)
+
+        out = SlowTerminal()
+        console = Console(out)
+        console.print('first')
+        out.writing.wait(1)
+        # terminal is stuck, these pile up behind the first message
+        for i in range(50):
+            console.status([f'table {i}', 'TOTAL'])
+        console.print('a', 'b', sep='\n')
+        out.gate.set()
+        console.flush()
+        self.assertEqual(out.getvalue(), 'first\ntable 49\nTOTAL\na\nb\n',
+                         'Expected messages in order and only the latest table drawn')
+
+        console.status(['table 50', 'TOTAL'])
+        console.flush()
+        self.assertTrue(out.getvalue().endswith('b\ntable 50\nTOTAL\n'),
+                        'Expected no redraw over messages printed after the table')
+        console.status(['table 51', 'TOTAL'])
+        console.flush()
+        self.assertTrue(out.getvalue().endswith('TOTAL\n\x1b[2F\x1b[Jtable 51\nTOTAL\n'),
+                        'Expected in place redraw of the table')
+
+    def test_metrics_exposition(self):
+        registry = Metrics()
+        queue = Queue()
+        queue.put('movie.mkv')
+        registry.watch_queues({'q1': queue}, 'cluster1/')
+        registry.aggregator = StatusAggregator()
+        registry.aggregator.jobs[('h1', 'a.mkv')] = {'speed': '2.5', 'fps': 60.0, 'comp': 40, 'done': 10}
+        registry.job_completed('h1', 1000, 400)
+        registry.job_completed('h1', 1000, 500)
+        registry.job_vetoed('h2')
+        registry.observe_probe(0.2)
+        registry.observe_probe(20)
+
+        text = registry.exposition()
+        self.assertIn('pytranscoder_queue_depth{queue="cluster1/q1"} 1\n', text)
+        self.assertIn('pytranscoder_active_jobs{host="h1"} 1\n', text)
+        self.assertIn('pytranscoder_job_speed{host="h1",file="a.mkv"} 2.5\n', text)
+        self.assertIn('pytranscoder_jobs_completed_total{host="h1"} 2\n', text)
+        self.assertIn('pytranscoder_bytes_saved_total{host="h1"} 1100\n', text)
+        self.assertIn('pytranscoder_jobs_vetoed_total{host="h2"} 1\n', text)
+        self.assertIn('pytranscoder_probe_seconds_bucket{le="0.1"} 0\n', text)
+        self.assertIn('pytranscoder_probe_seconds_bucket{le="0.25"} 1\n', text)
+        self.assertIn('pytranscoder_probe_seconds_bucket{le="+Inf"} 2\n', text)
+
+    def test_job_timing_export(self):
+        timing = JobTiming()
+        with timing.phase('probe'):
+            pass
+        timing.queued()
+        timing.dequeued()
+        timing.add('encode', 2.5)
+        timing.add('encode', 0.5)
+        self.assertEqual(timing.phases['encode'], 3.0, 'Expected repeated phase to accumulate')
+        self.assertIn('queue_wait', timing.phases)
+        self.assertIsNone(timing.enqueued)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = TimingLog()
+            log.export_path = os.path.join(tmpdir, 'timing.jsonl')
+            log.record('/media/a.mkv', 'h1', timing)
+            log.record('/media/b.mkv', 'h2', timing, failed=True)
+            export = log.export
+            with open(log.export_path) as f:
+                records = [json.loads(line) for line in f]
+            log.close()
+            self.assertTrue(export.closed, 'Expected the export file kept open until closed')
+            self.assertEqual([r['host'] for r in records], ['h1', 'h2'])
+            self.assertEqual([r['failed'] for r in records], [False, True])
+            self.assertEqual(records[0]['encode'], 3.0)
+            self.assertEqual(log.phase_totals()['encode'], 6.0)
+
+    @unittest.skipUnless(hasattr(os, 'wait4'), 'wait4 not available')
+    def test_resource_usage(self):
+        script = 'import time\nblk = bytearray(64 * 1024 * 1024)\nt = time.process_time()\n' \
+                 'while time.process_time() - t < 0.2: pass\n'
+        # reaped by wait()
+        with AccountedPopen([sys.executable, '-c', script]) as proc:
+            proc.wait()
+        self.assertGreater(proc.usage.max_rss_kb, 60 * 1024, 'Expected peak RSS of the child')
+        self.assertGreater(proc.usage.cpu_user + proc.usage.cpu_sys, 0.15, 'Expected CPU time of the child')
+
+        # reaped by poll(), as the agent does
+        with AccountedPopen([sys.executable, '-c', 'pass']) as proc2:
+            while proc2.poll() is None:
+                time.sleep(0.05)
+        self.assertIsNotNone(proc2.usage)
+        self.assertLess(proc2.usage.max_rss_kb, proc.usage.max_rss_kb)
+
+        if os.path.exists('/proc/self/status'):
+            # the memory of this process, which the child was forked from, is not counted
+            with AccountedPopen(['sleep', '0.3']) as proc3:
+                while proc3.poll() is None:
+                    time.sleep(0.05)
+            self.assertEqual(proc3.returncode, 0)
+            self.assertLess(proc3.usage.max_rss_kb, 8 * 1024, 'Expected peak RSS of the sleep command only')
+
+        # reaped behind its back, the exit status is lost
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with AccountedPopen(['true']) as proc4:
+                os.waitpid(proc4.pid, 0)
+        self.assertEqual(proc4.returncode, LOST_STATUS, 'Expected a run with an unknown status to count as failed')
+        self.assertIsNone(proc4.usage)
+
+        # as relayed by an agent
+        relayed = ResourceUsage.from_field(proc.usage.to_field())
+        self.assertEqual(relayed.max_rss_kb, proc.usage.max_rss_kb)
+        self.assertIsNone(ResourceUsage.from_field(''))
+
+        log = TimingLog()
+        for directive, usage in [('hevc', proc.usage), ('hevc', proc2.usage), ('copy', None)]:
+            timing = JobTiming(directive)
+            timing.account(usage)
+            log.record('/media/a.mkv', 'h1', timing)
+        totals = log.usage_by_directive()
+        self.assertEqual(list(totals.keys()), ['hevc'], 'Expected unmeasured jobs to be left out')
+        self.assertEqual(totals['hevc']['jobs'], 2)
+        self.assertEqual(totals['hevc']['peak_rss_kb'], proc.usage.max_rss_kb)
+
+    def test_journal_report(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'journal.jsonl')
+            journal = Journal()
+            journal.open(path)
+            timing = JobTiming('hevc')
+            timing.add('encode', 30.0)
+            writers = [threading.Thread(target=journal.job, args=('started', f'h{i % 2}', f'/media/{i}.mkv', timing))
+                       for i in range(4)]
+            for t in writers:
+                t.start()
+            for t in writers:
+                t.join()
+            for i in range(3):
+                journal.job('completed', f'h{i % 2}', f'/media/{i}.mkv', timing,
+                            **completed_fields(timing, 100 * 1048576, 40 * 1048576))
+            journal.job('failed', 'h1', '/media/3.mkv', timing, reason='exit code 1')
+            journal.close()
+
+            events = read_journal(path)
+            self.assertEqual(len(events), 8, 'Expected all events written before close returned')
+            hosts = summarize(events, 'host')
+            self.assertEqual(hosts['h0']['completed'], 2)
+            self.assertEqual(hosts['h1']['failed'], 1)
+            self.assertEqual(hosts['h0']['encode'], 60.0)
+            self.assertEqual(hosts['h0']['saved_pct'], 60)
+            profiles = summarize(events, 'directive')
+            self.assertEqual(profiles['hevc']['completed'], 3)
+            self.assertEqual(profiles['hevc']['orig_size'], 300 * 1048576)
+
+    def test_sample_prediction(self):
+        offsets = sample_offsets(3600, 4, 10)
+        self.assertEqual(offsets, [445.0, 1345.0, 2245.0, 3145.0], 'Expected samples centered in equal slices')
+        self.assertEqual(sample_offsets(120, 4, 10), [], 'Expected short media not sampled')
+        # 40 seconds of a 1 hour, 3600 MB source would be 40 MB, the samples came to 10 MB
+        self.assertEqual(predicted_compression(3600 * 1048576, 3600, 40, 10 * 1048576), 75)
+
+        directive = Profile('hevc', {'threshold': 20, 'threshold_samples': 4, 'extension': '.mkv'})
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 3600, 24, 'yuv420p', [], [])
+        timing = JobTiming('hevc')
+        messages = []
+        with mock.patch('pytranscoder.sample.encode_samples', return_value=12):
+            self.assertTrue(predict_vetoed('/usr/bin/ffmpeg', None, '/media/a.mkv', info, directive, None, timing,
+                                           messages.append), 'Expected job predicted to miss threshold vetoed')
+        self.assertEqual(timing.predicted_comp, 12)
+        self.assertIn('sample', timing.phases)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(prediction_fields(timing, 1000, 850),
+                         {'predicted_comp': 12, 'actual_comp': 15, 'prediction_error': 3})
+        self.assertEqual(completed_fields(timing, 1000, 850)['prediction_error'], 3)
+
+        directive = Profile('hevc', {'threshold': 20, 'extension': '.mkv'})
+        with mock.patch('pytranscoder.sample.encode_samples') as mock_samples:
+            self.assertFalse(predict_vetoed('/usr/bin/ffmpeg', None, '/media/a.mkv', info, directive, None,
+                                            JobTiming('hevc'), messages.append))
+            mock_samples.assert_not_called()
+
+    def test_segment_planning(self):
+        self.assertEqual(split_times(3600, 4), [900, 1800, 2700])
+        self.assertEqual(split_times(150, 4), [75], 'Expected no segments shorter than a minute')
+        self.assertEqual(split_times(90, 4), [], 'Expected short media not split')
+        directive = Profile('x265', {'output_options': ['-c:v', 'libx265', '-f', 'matroska'], 'extension': '.mkv',
+                                     'segments': 8})
+        info = self.make_media('/media/a.mkv', 'h264', 3840, 2160, 7200, 40000, 24, 'yuv420p', [], [])
+        self.assertTrue(use_segments(directive, info))
+        self.assertFalse(use_segments(Profile('plain', {'extension': '.mkv'}), info))
+        self.assertEqual(output_format(['-c:v', 'libx265', '-f', 'matroska']), ['-f', 'matroska'])
+        self.assertEqual(concat_list(["/tmp/it's.mkv"]), "file '/tmp/it'\\''s.mkv'\n")
+
+        encoder = SegmentedEncode('/usr/bin/ffmpeg', None, '/media/a.mkv', '/media/a.mkv.tmp', info, directive, None)
+        self.assertEqual(encoder.count, 8)
+        self.assertEqual(encoder.workdir, '/media/a.mkv.tmp.segments')
+        progress = []
+        callbacks = [encoder.segment_callback(i, progress.append) for i in range(2)]
+        callbacks[0]({'time': 100, 'size': 1000, 'fps': 20.0, 'speed': '1.5'})
+        self.assertFalse(callbacks[1]({'time': 50, 'size': 500, 'fps': 10.0, 'speed': '0.5'}))
+        self.assertEqual(progress[-1], {'time': 150, 'size': 1500, 'fps': 30.0, 'speed': '2.00'},
+                         'Expected progress of the segments combined')
+
+    def test_segment_checkpoint(self):
+        directive = Profile('x265', {'output_options': ['-c:v', 'libx265', '-f', 'matroska'], 'extension': '.mkv',
+                                     'checkpoint_secs': 600})
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 8000, 24, 'yuv420p', [], [])
+        self.assertEqual(segment_count(directive, info.runtime), 6, 'Expected a segment per checkpoint interval')
+        self.assertTrue(use_segments(directive, info))
+
+        with tempfile.TemporaryDirectory() as workdir:
+            identity = {'source': '/media/a.mkv', 'size': 1000, 'times': [600, 1200]}
+            checkpoint = Checkpoint(workdir, identity)
+            checkpoint.sources = ['a.part000.mkv', 'a.part001.mkv']
+            for name in checkpoint.sources + ['encoded000.mkv']:
+                open(os.path.join(workdir, name), 'w').close()
+            checkpoint.save()
+            checkpoint.finished('encoded000.mkv')
+            checkpoint.finished('encoded001.mkv')
+
+            resumed = Checkpoint(workdir, dict(identity))
+            self.assertTrue(resumed.load())
+            self.assertTrue(resumed.is_done('encoded000.mkv'))
+            self.assertFalse(resumed.is_done('encoded001.mkv'), 'Expected a missing segment to be encoded again')
+            self.assertFalse(Checkpoint(workdir, {**identity, 'size': 2000}).load(),
+                             'Expected no resume after the source changed')
+            os.remove(os.path.join(workdir, 'a.part001.mkv'))
+            self.assertFalse(Checkpoint(workdir, identity).load(), 'Expected no resume with a segment missing')
+
+    def test_chunked_job(self):
+        directive = Profile('x265', {'output_options': ['-c:v', 'libx265', '-f', 'matroska'], 'extension': '.mkv',
+                                     'segments': 3})
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 8000, 24, 'yuv420p', [], [])
+        encoder = SegmentedEncode('/usr/bin/ffmpeg', None, '/media/a.mkv', '/media/a.mkv.tmp', info, directive, None)
+        encoder.join = mock.MagicMock(return_value=0)
+        job = EncodeJob('/media/a.mkv', info, directive, None)
+        chunked = ChunkedJob(job, encoder)
+        for i in range(3):
+            segment = EncodeJob(f'/media/a.mkv.tmp.segments/a.part00{i}.mkv', info, SegmentDirective(directive), None)
+            segment.chunk = chunked
+            segment.attempts = 1
+            chunked.segments.append(segment)
+
+        self.assertFalse(chunked.segments[0].keep_source, 'Expected segments always replaced by their result')
+        self.assertEqual(chunked.segments[0].directive.threshold(), 0)
+        chunked.segments[0].encoded = True
+        chunked.segments[2].encoded = True
+        chunked.segments[1].attempts = SEGMENT_ATTEMPTS
+        self.assertEqual(chunked.retries(), [], 'Expected no retry past the attempt limit')
+        self.assertIsNone(chunked.merge(), 'Expected no merge with a segment missing')
+        chunked.segments[1].attempts = 1
+        self.assertEqual(chunked.retries(), [chunked.segments[1]])
+
+        chunked.segments[1].encoded = True
+        chunked.others_code = 0
+        self.assertEqual(chunked.merge(), 0)
+        encoder.join.assert_called_once_with([segment.inpath for segment in chunked.segments])
+
+    @mock.patch.object(Cluster, 'merge_segments')
+    @mock.patch.object(Cluster, 'plan_agent_capacity')
+    def test_chunked_retry_rounds(self, mock_plan, mock_merge):
+        class Host(threading.Thread):
+            """Takes every job off the queue and fails it, or takes none"""
+            rounds = 0
+
+            def __init__(self, queue, takes):
+                super().__init__(daemon=True)
+                self.queue = queue
+                self.takes = takes
+                self.completed = list()
+
+            def run(self):
+                Host.rounds += 1
+                while self.takes and not self.queue.empty():
+                    self.queue.get().timing.dequeued()
+                    self.queue.task_done()
+
+        directive = Profile('x265', {'output_options': ['-c:v', 'libx265'], 'extension': '.mkv', 'segments': 2})
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 8000, 24, 'yuv420p', [], [])
+        for takes, rounds in [(False, 1), (True, SEGMENT_ATTEMPTS)]:
+            cluster = Cluster('cluster1', {}, ConfigFile(self.get_setup()), '/usr/bin/ssh')
+            queue = cluster.queues.setdefault('_default', Queue())
+            encoder = mock.MagicMock()
+            chunked = ChunkedJob(EncodeJob('/media/a.mkv', info, directive, None), encoder)
+            for i in range(2):
+                segment = EncodeJob(f'/media/a.part00{i}.mkv', info, SegmentDirective(directive), None)
+                segment.chunk = chunked
+                segment.attempts = 1
+                chunked.segments.append(segment)
+                queue.put(segment)
+            cluster.chunked.append(chunked)
+            Host.rounds = 0
+            cluster.hosts = [Host(queue, takes)]
+            with mock.patch.object(Cluster, 'create_hosts', side_effect=lambda: [Host(queue, takes)]):
+                cluster.go()
+            self.assertEqual(Host.rounds, rounds, 'Expected the retry rounds bounded')
+            self.assertEqual([segment.attempts for segment in chunked.segments], [rounds, rounds])
+
+    @mock.patch('pytranscoder.cluster.filter_threshold', return_value=False)
+    def test_chunked_merge_vetoed_timing(self, mock_threshold):
+        directive = Profile('x265', {'output_options': ['-c:v', 'libx265'], 'extension': '.mkv', 'segments': 2})
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 8000, 24, 'yuv420p', [], [])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            encoder = mock.MagicMock(outpath=os.path.join(tmpdir, 'a.mkv.tmp'), last_usage=None)
+            with open(encoder.outpath, 'w') as f:
+                f.write('encoded')
+            chunked = ChunkedJob(EncodeJob('/media/a.mkv', info, directive, None), encoder)
+            cluster = Cluster('cluster1', {}, ConfigFile(self.get_setup()), '/usr/bin/ssh')
+            log = TimingLog()
+            with mock.patch.object(ChunkedJob, 'merge', return_value=0), \
+                    mock.patch('pytranscoder.cluster.timings', log):
+                cluster.merge_segments(chunked)
+            self.assertEqual([rec['failed'] for rec in log.records], [False], 'Expected the vetoed job timed once')
+            self.assertFalse(os.path.exists(encoder.outpath), 'Expected vetoed output removed')
+
+    def test_history_prediction(self):
+        def event(event, vcodec, height, bitrate, saved, encode):
+            return {'event': event, 'directive': 'hevc', 'orig_size': 1000, 'new_size': 1000 - saved * 10,
+                    'phases': {'encode': encode}, 'usage': {'cpu_user': encode * 4, 'cpu_sys': 0.0},
+                    'media': {'vcodec': vcodec, 'res_width': height * 16 // 9, 'res_height': height,
+                              'vbitrate': bitrate, 'fps': 24.0, 'runtime': 3600}}
+
+        model = History()
+        model.add([Outcome.from_event(rec) for rec in [
+            event('completed', 'h264', 1080, 8000, 50, 3600), event('completed', 'h264', 1080, 9000, 52, 3600),
+            event('vetoed', 'h264', 1080, 2000, 10, 3000), event('vetoed', 'h264', 1080, 1800, 8, 3000),
+            event('completed', 'h264', 2160, 30000, 60, 14000), event('started', 'h264', 1080, 8000, 0, 0)]])
+        self.assertEqual(sum([len(v) for v in model.outcomes.values()]), 5, 'Expected only outcomes with sizes')
+
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 1800, 900, 24, 'yuv420p', [], [])
+        info.vbitrate = 1900
+        prediction = model.predict(info, 'hevc')
+        self.assertLess(prediction.saved_pct, 25, 'Expected low savings like the low bitrate outcomes')
+        self.assertAlmostEqual(prediction.seconds, 1800 * 3000 / 3600, delta=300)
+        self.assertIsNone(model.predict(info, 'other'), 'Expected no prediction without history')
+
+        timing = JobTiming()
+        model.apply(timing, info, 'hevc')
+        self.assertEqual(timing.media['vbitrate'], 1900)
+        directive = Profile('hevc', {'threshold': 20, 'threshold_history': True})
+        self.assertTrue(history_vetoed(directive, timing))
+        self.assertFalse(history_vetoed(Profile('hevc', {'threshold': 20}), timing))
+
+        queue = Queue()
+        jobs = [(900, JobTiming()), (900, timing), (2000, timing)]
+        for job in jobs:
+            queue.put(job)
+        order_queue(queue, lambda job: job[0], lambda job: job[1])
+        self.assertEqual([queue.get() for _ in range(3)], [jobs[2], jobs[1], jobs[0]],
+                         'Expected the most savings per CPU hour first, unpredicted jobs last')
+
+    def test_audio_copy(self):
+        with open('tests/ffmpeg4.out', 'r') as ff:
+            info = MediaInfo.parse_ffmpeg_details('/dev/null', ff.read())
+        self.assertEqual([a['bitrate'] for a in info.audio], [384, 384])
+        with open('tests/ffmpeg3.out', 'r') as ff:
+            self.assertEqual([a['bitrate'] for a in MediaInfo.parse_ffmpeg_details('/dev/null', ff.read()).audio],
+                             [5665, 640], 'Expected the mkv BPS tag for streams without a bitrate')
+
+        profile = Profile('hevc', {'audio': {'copy_codecs': ['aac', 'ac3'], 'copy_max_bitrate': 448}})
+        self.assertEqual(profile.audio_options(info.audio), ['-c:a:0', 'copy', '-c:a:1', 'copy'])
+        profile = Profile('hevc', {'audio': {'copy_codecs': ['ac3'], 'copy_max_bitrate': 448,
+                                             'exclude_languages': ['chi']}})
+        self.assertEqual(profile.audio_options(info.audio), ['-c:a:0', 'copy'],
+                         'Expected the index among the mapped audio streams')
+        profile = Profile('hevc', {'audio': {'copy_codecs': ['ac3'], 'copy_max_bitrate': 256}})
+        self.assertEqual(profile.audio_options(info.audio), [], 'Expected streams over the bitrate encoded')
+        self.assertEqual(Profile('hevc', {}).audio_options(info.audio), [])
+
+        audio = [{'stream': '1', 'lang': 'eng', 'format': 'aac', 'bitrate': 128},
+                 {'stream': '2', 'lang': 'eng', 'format': 'truehd', 'bitrate': None},
+                 {'stream': '3', 'lang': 'fre', 'format': 'aac', 'bitrate': None}]
+        media = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 1800, 900, 24, 'yuv420p', audio, [])
+        profile = Profile('hevc', {'audio': {'copy_codecs': ['aac'], 'copy_max_bitrate': 192}})
+        self.assertEqual(stream_options(profile, media, True), ['-map', '0', '-c:a:0', 'copy'],
+                         'Expected unknown bitrates encoded')
+        self.assertEqual(stream_options(profile, media, False), [], 'Expected no options for unmapped streams')
+        template = Template('t', {'cli': {}, 'audio-lang': 'fre', 'audio-copy': 'aac'})
+        self.assertEqual(template.audio_options(audio), ['-c:a:0', 'copy'])
+
+    def test_autocrop(self):
+        log = '[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:140 y2:939 w:1920 h:800 x:0 y:140 pts:1 t:0.04 crop=1920:800:0:140\n' \
+              '[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:132 y2:947 w:1920 h:816 x:0 y:132 pts:2 t:0.08 crop=1920:816:0:132\n'
+        self.assertEqual(parse_crop(log), (1920, 816, 0, 132), 'Expected the last crop of the window')
+        self.assertIsNone(parse_crop('frame=  100 fps=0.0'))
+        self.assertEqual(combine_crops([(1920, 816, 0, 132), (1920, 800, 0, 140)], 1920, 1080), '1920:816:0:132')
+        self.assertIsNone(combine_crops([(1920, 1080, 0, 0), (1920, 800, 0, 140)], 1920, 1080),
+                          'Expected no crop when a window has no bars')
+        self.assertEqual(add_crop_filter(['-c:v', 'libx265', '-vf', 'scale=1280:-2'], '1920:816:0:132'),
+                         ['-c:v', 'libx265', '-vf', 'crop=1920:816:0:132,scale=1280:-2'])
+        self.assertEqual(add_crop_filter(['-c:v', 'libx265'], '1920:816:0:132'),
+                         ['-vf', 'crop=1920:816:0:132', '-c:v', 'libx265'])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            media = os.path.join(tmpdir, 'a.mkv')
+            with open(media, 'w') as f:
+                f.write('x')
+            config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg',
+                                            'crop_cache': os.path.join(tmpdir, 'crop.json')}})
+            info = self.make_media(media, 'h264', 1920, 1080, 1800, 900, 24, 'yuv420p', [], [])
+            profile = Profile('hevc', {'output_options': ['-c:v libx265'], 'autocrop': True, 'threshold': 20,
+                                       'threshold_samples': 3})
+            with mock.patch('pytranscoder.crop.detect_crops', return_value=[(1920, 800, 0, 140)]) as detect:
+                directive = apply_crop(config, media, info, profile, JobTiming())
+                self.assertEqual(directive.output_options_list(config), ['-vf', 'crop=1920:800:0:140', '-c:v', 'libx265'])
+                self.assertEqual((directive.threshold(), directive.threshold_samples()), (20, 3),
+                                 'Expected the settings of the cropped directive kept')
+                segment = SegmentDirective(directive)
+                self.assertEqual((segment.name(), segment.threshold(), segment.threshold_samples(), segment.autocrop()),
+                                 ('hevc', 0, 0, False), 'Expected a segment without the per-job settings')
+                apply_crop(config, media, info, profile, JobTiming())
+                self.assertEqual(detect.call_count, 1, 'Expected the second lookup from the cache')
+                plain = Profile('x264', {'output_options': ['-c:v libx264']})
+                self.assertIs(apply_crop(config, media, info, plain, JobTiming()), plain,
+                              'Expected no crop for profiles not opting in')
+            cache = CropCache()
+            cache.open(config.crop_cache)
+            self.assertEqual(cache.get(media), '1920:800:0:140', 'Expected the crop written to the cache file')
+
+    def test_multi_output(self):
+        config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg'},
+                             'profiles': {'hevc': {'output_options': ['-c:v libx265', '-f matroska'],
+                                                   'extension': '.mkv', 'threshold': 20},
+                                          'mobile': {'output_options': ['-c:v libx264', '-f mp4'], 'extension': '.mp4',
+                                                     'audio': {'include_languages': ['eng']}}}})
+        self.assertTrue(config.has_directive('hevc,mobile'))
+        self.assertFalse(config.has_directive('hevc,missing'))
+        directive = config.get_directive('hevc,mobile')
+        self.assertIsInstance(directive, MultiDirective)
+        self.assertEqual(directive.name(), 'hevc,mobile')
+        self.assertEqual(directive.threshold(), 0, 'Expected thresholds to apply per output')
+
+        inpath = Path('/media/a.mkv')
+        outputs = job_outputs(directive, inpath, None)
+        self.assertEqual([str(output.path) for output in outputs], ['/media/a.mkv.tmp', '/media/a.mobile.mp4.tmp'])
+        self.assertEqual([str(output.final) for output in outputs], ['/media/a.mkv', '/media/a.mobile.mp4'])
+        self.assertTrue(outputs[0].primary and not outputs[1].primary)
+
+        info = self.make_media(str(inpath), 'h264', 1920, 1080, 1800, 900, 24, 'yuv420p',
+                               [{'stream': '1', 'lang': 'eng', 'format': 'aac'},
+                                {'stream': '2', 'lang': 'fre', 'format': 'aac'}], [])
+        cli = output_cli(config, inpath, info, outputs, None)
+        self.assertEqual(cli.count('-i'), 1, 'Expected the source read once')
+        self.assertEqual(cli[cli.index('/media/a.mkv.tmp') + 1:],
+                         ['-c:v', 'libx264', '-f', 'mp4', '-map', '0:0', '-map', '0:1', '/media/a.mobile.mp4.tmp'])
+
     def test_loadconfig(self):
         config = ConfigFile('config-samples/transcode.yml')
         self.assertIsNotNone(config.settings, 'Config object not loaded')
@@ -116,6 +712,22 @@ class TranscoderTests(unittest.TestCase):
             self.assertEqual(info.path, '/dev/null')
             self.assertEqual(info.colorspace, 'yuv420p')
 
+    def test_mediainfo_bitrate(self):
+        with open('tests/ffmpeg.out', 'r') as ff:
+            info = MediaInfo.parse_ffmpeg_details('/dev/null', ff.read())
+            self.assertEqual(info.bitrate, 917)
+            self.assertEqual(info.vbitrate, 821)
+            self.assertAlmostEqual(info.bpp, 821000 / (1280 * 528 * 23), places=4)
+        with open('tests/ffmpeg3.out', 'r') as ff:
+            info = MediaInfo.parse_ffmpeg_details('/dev/null', ff.read())
+            self.assertEqual(info.vbitrate, 57716, 'Expected the overall bitrate when the stream has none')
+
+        info = self.make_media('/media/a.mkv', 'h264', 1920, 1080, 3600, 900, 24, 'yuv420p', [], [])
+        self.assertEqual(info.bitrate, kbps(900, 3600), 'Expected the bitrate derived from size and runtime')
+        rule = Rule('efficient', {'profile': 'SKIP', 'criteria': {'bpp': '<0.05', 'vbitrate': '1000-3000'}})
+        self.assertTrue(rule.match(info))
+        self.assertFalse(Rule('dense', {'profile': 'SKIP', 'criteria': {'bpp': '>0.1'}}).match(info))
+
     def test_mediainfo2(self):
         with open('tests/ffmpeg2.out', 'r') as ff:
             info = MediaInfo.parse_ffmpeg_details('/dev/null', ff.read())
@@ -169,6 +781,33 @@ class TranscoderTests(unittest.TestCase):
         rule = config.match_rule(info)
         self.assertIsNotNone(rule, 'Expected a matched profile')
 
+    def test_remux_selection(self):
+        config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg'},
+                             'profiles': {'hevc': {'output_options': ['-c:v libx265', '-crf 20', '-f matroska'],
+                                                   'extension': '.mkv', 'threshold': 20, 'remux': True},
+                                          'h264': {'output_options': ['-c:v libx264', '-f mp4'], 'extension': '.mp4'}},
+                             'rules': {'rewrap': {'profile': 'h264', 'action': 'remux', 'criteria': {'vcodec': 'h264'}},
+                                       'default': {'profile': 'hevc'}}})
+        self.assertEqual(video_codec(['-c:v', 'hevc_nvenc', '-preset', 'slow']), 'hevc')
+        self.assertIsNone(video_codec(['-c:v', 'copy']))
+
+        hevc = config.get_directive('hevc')
+        info = self.make_media('/media/a.mp4', 'hevc', 1920, 1080, 3600, 2000, 24, 'yuv420p', [], [])
+        directive = select_directive(hevc, info, config, config.match_rule(info))
+        self.assertIsInstance(directive, RemuxDirective, 'Expected a remux of media already in the target codec')
+        self.assertEqual(directive.output_options_list(config), ['-c', 'copy', '-f', 'matroska'])
+        self.assertEqual(directive.threshold(), 0)
+        self.assertEqual(directive.extension(), '.mkv')
+
+        info = self.make_media('/media/b.avi', 'mpeg4', 1920, 1080, 3600, 2000, 24, 'yuv420p', [], [])
+        self.assertIs(select_directive(hevc, info, config, config.match_rule(info)), hevc)
+
+        info = self.make_media('/media/c.mkv', 'h264', 1920, 1080, 3600, 2000, 24, 'yuv420p', [], [])
+        rule = config.match_rule(info)
+        self.assertTrue(rule.is_remux())
+        directive = select_directive(config.get_directive(rule.profile), info, config, rule)
+        self.assertEqual(directive.output_options_list(config), ['-c', 'copy', '-f', 'mp4'])
+
     def test_loc_os(self):
         self.assertNotEqual(get_local_os_type(), 'unknown', 'Expected other than "unknown" as os type')
 
@@ -191,6 +830,325 @@ class TranscoderTests(unittest.TestCase):
         result = is_exceeded_threshold(threshold, src, dest)
         self.assertFalse(result, "Expected threshold to be false")
 
+    def test_chunked_transfer_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'source.mkv')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(CHUNK_SIZE * 2 + 1234))
+            size = os.path.getsize(src)
+            dest = os.path.join(tmpdir, 'dest.mkv.part')
+
+            # simulate an earlier transfer that was interrupted after the first chunk
+            with open(src, 'rb') as f, open(dest, 'wb') as d:
+                d.write(f.read(CHUNK_SIZE + 500))
+            first = TransferManifest(dest, size, '1')
+            first.digests = chunk_digests(src, CHUNK_SIZE)
+            first.save()
+
+            manifest = TransferManifest(dest, size, '1').load()
+            self.assertEqual(manifest.offset, CHUNK_SIZE, 'Expected to resume after the confirmed chunk')
+
+            a, b = socket.socketpair()
+            sender, receiver = Session(a, 5), Session(b, 5)
+            sender.start_reader()
+            receiver.start_reader()
+            result = {}
+            t = threading.Thread(target=lambda: result.update(
+                sent=send_file(sender.add_channel(1), src, manifest.offset)))
+            t.start()
+            received = receive_file(receiver.add_channel(1), manifest)
+            t.join()
+            sender.close()
+            receiver.close()
+            self.assertEqual(file_digest(received), file_digest(result['sent']), 'Whole-file digest mismatch')
+            with open(src, 'rb') as a, open(dest, 'rb') as b:
+                self.assertEqual(a.read(), b.read(), 'Resumed file differs from source')
+
+            stale = TransferManifest(dest, size, '2').load()
+            self.assertEqual(stale.offset, 0, 'Expected a changed source to restart the transfer')
+
+    def test_transfer_flow_control(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'source.mkv')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(CHUNK_SIZE * (WINDOW_FRAMES * 2) + 10))
+            a, b = socket.socketpair()
+            sender, receiver = Session(a, 5), Session(b, 5)
+            sender.start_reader()
+            receiver.start_reader()
+            channel = receiver.add_channel(1)
+            result = {}
+            t = threading.Thread(target=lambda: result.update(sent=send_file(sender.add_channel(1), src)))
+            t.start()
+            # the receiver is not consuming yet, so the sender stops at the window
+            time.sleep(0.5)
+            self.assertEqual(channel.inbox.qsize(), WINDOW_FRAMES, 'Expected no more than a window buffered')
+            self.assertTrue(t.is_alive())
+            manifest = TransferManifest(os.path.join(tmpdir, 'dest.mkv'), os.path.getsize(src), '1')
+            received = receive_file(channel, manifest, persist=False)
+            t.join()
+            sender.close()
+            receiver.close()
+            self.assertEqual(file_digest(received), file_digest(result['sent']))
+
+    def test_transfer_resume_at_eof(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'source.mkv')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(CHUNK_SIZE * 2 + 1234))
+            size = os.path.getsize(src)
+
+            # every chunk arrived but the final digest was lost, nothing is left to send
+            channel = mock.MagicMock()
+            sent = send_file(channel, src, size)
+            channel.send.assert_not_called()
+            self.assertEqual(len(sent), 3, 'Expected the digest of the last, partial chunk kept')
+            self.assertEqual(file_digest(sent), file_digest(chunk_digests(src, size)))
+            self.assertEqual(file_digest(send_file(channel, src, size, chunk_digests(src, size))), file_digest(sent))
+
+    def test_session_channels(self):
+        a, b = socket.socketpair()
+        manager, agent = Session(a, 1), Session(b, 1)
+        manager.start_reader()
+        agent.start_reader()
+        jobs = [manager.add_channel(i) for i in (1, 2)]
+        agent_jobs = [agent.add_channel(i) for i in (1, 2)]
+        send_msg(jobs[1], 'second')
+        send_msg(jobs[0], 'first')
+        self.assertEqual(recv_msg(agent_jobs[0], 5), 'first', 'Message routed to the wrong channel')
+        self.assertEqual(recv_msg(agent_jobs[1], 5), 'second', 'Message routed to the wrong channel')
+
+        # no heartbeats from the manager, the agent should give up on it and waiting jobs should find out
+        with self.assertRaises(ConnectionError):
+            recv_msg(agent_jobs[0], 5)
+        self.assertTrue(agent.closed.is_set(), 'Expected silent session to be closed')
+        manager.close()
+
+    def test_agent_input_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = InputCache(2)
+            entries = []
+            for i in range(3):
+                received = os.path.join(tmpdir, f'media{i}.mkv')
+                with open(received, 'wb') as f:
+                    f.write(os.urandom(CHUNK_SIZE))
+                fingerprint = sampled_fingerprint(received)
+                self.assertIsNone(cache.lookup(tmpdir, fingerprint, 'media.mkv', CHUNK_SIZE), 'Unexpected cache hit')
+                path = cache.store(tmpdir, fingerprint, 'media.mkv', received)
+                os.utime(path, (i, i))
+                cache.release(tmpdir, path)
+                entries.append((fingerprint, path))
+
+            # 3MB stored in a 2MB cache, the least recently used entry is evicted
+            self.assertFalse(os.path.exists(entries[0][1]), 'Expected oldest entry to be evicted')
+            hit = cache.lookup(tmpdir, entries[2][0], 'other-name.mkv', CHUNK_SIZE)
+            self.assertEqual(hit, entries[2][1], 'Expected a hit on content fingerprint')
+            self.assertEqual(cache.hit_rate, 25)
+            self.assertEqual(cache.bytes_saved, CHUNK_SIZE)
+
+    def test_agent_input_cache_concurrent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = InputCache(2)
+            source = os.urandom(CHUNK_SIZE)
+            received = []
+
+            def job(n):
+                with cache.fill_lock('fp'):
+                    path = cache.lookup(tmpdir, 'fp', 'media.mkv', CHUNK_SIZE)
+                    if path is None:
+                        # slow receive, the other job must not start its own
+                        time.sleep(0.2)
+                        partial = os.path.join(tmpdir, f'media.mkv.{n}')
+                        with open(partial, 'wb') as f:
+                            f.write(source)
+                        received.append(n)
+                        path = cache.store(tmpdir, 'fp', 'media.mkv', partial)
+                cache.release(tmpdir, path)
+
+            threads = [threading.Thread(target=job, args=(n,)) for n in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(received), 1, 'Expected the source to be received once')
+            self.assertEqual(cache.hits, 1, 'Expected the second job to reuse the first one\'s entry')
+            self.assertEqual(cache.filling, {})
+
+            # entries stored while others are pinned still evict the unpinned ones
+            paths = []
+            for i in range(3):
+                partial = os.path.join(tmpdir, f'pinned{i}.mkv')
+                with open(partial, 'wb') as f:
+                    f.write(os.urandom(CHUNK_SIZE))
+                paths.append(cache.store(tmpdir, f'pinned{i}', 'media.mkv', partial))
+                os.utime(paths[-1], (i + 1, i + 1))
+            self.assertFalse(os.path.exists(cache.entry_path(tmpdir, 'fp', 'media.mkv')),
+                             'Expected unpinned entry to be evicted on store')
+            self.assertTrue(all(os.path.exists(path) for path in paths), 'Expected pinned entries to be kept')
+
+    def test_agent_ffmpeg_version_probe(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake = os.path.join(tmpdir, 'ffmpeg')
+            with open(fake, 'w') as f:
+                f.write('#!/bin/sh\nsleep 1\necho "ffmpeg version 9.9 Copyright"\n')
+            os.chmod(fake, 0o755)
+            agent = Agent()
+            start = time.time()
+            self.assertIsNone(agent.report(tmpdir, fake)['ffmpeg'], 'Expected no version until probed')
+            self.assertLess(time.time() - start, 0.5, 'Expected the report not to wait on the probe')
+            for _ in range(50):
+                if agent.ffmpeg_version(fake) is not None:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(agent.report(tmpdir, fake)['ffmpeg'], '9.9')
+
+    @mock.patch.object(AgentManagedHost, 'fetch_report')
+    def test_agent_capacity_planning(self, mock_fetch_report):
+        config = self.get_setup()
+        config['config']['clusters']['cluster2'] = {
+            'a1': {'type': 'agent', 'ip': '127.0.0.1', 'os': 'linux', 'working_dir': '/tmp',
+                   'queues': {'q1': 1, 'q2': 2}, 'status': 'enabled'},
+            'a2': {'type': 'agent', 'ip': '127.0.0.2', 'os': 'linux', 'working_dir': '/tmp',
+                   'queues': {'q1': 2}, 'status': 'enabled', 'min_scratch_mb': 5000},
+        }
+        setup = ConfigFile(config)
+        cluster = Cluster('cluster2', setup.settings['clusters']['cluster2'], setup, setup.ssh_path)
+        self.assertEqual(len(cluster.hosts), 5, 'Expected one thread per configured slot')
+
+        report = {'slots': 4, 'active': 2, 'free_slots': 2, 'cpus': 8, 'load': [1.0, 1.0, 1.0],
+                  'ffmpeg': '6.0', 'scratch_mb': 4000, 'cache': {}}
+        mock_fetch_report.return_value = report
+        cluster.plan_agent_capacity()
+        hostnames = [host.hostname for host in cluster.hosts]
+        self.assertEqual(hostnames.count('a1'), 2, 'Expected threads limited to free agent slots')
+        self.assertEqual(hostnames.count('a2'), 0, 'Expected agent without enough scratch space to be skipped')
+
+    def test_agent_batch_small_files(self):
+        props = RemoteHostProperties('a1', {'type': 'agent', 'ip': '127.0.0.1', 'os': 'linux', 'working_dir': '/tmp',
+                                            'batch_max_mb': 50, 'batch_size': 3, 'status': 'enabled'})
+        queue = Queue()
+        host = AgentManagedHost('a1', props, queue, None)
+
+        def job(name, size_mb):
+            info = MediaInfo({'path': name, 'vcodec': 'h264', 'stream': '0', 'res_width': 720, 'res_height': 480,
+                              'runtime': 30, 'filesize_mb': size_mb, 'fps': 24, 'colorspace': 'yuv420p',
+                              'audio': [], 'subtitle': []})
+            return EncodeJob(name, info, None, None)
+
+        for name, size in [('a.mkv', 10), ('b.mkv', 20), ('c.mkv', 5000), ('d.mkv', 30)]:
+            queue.put(job(name, size))
+        first = queue.get()
+        self.assertTrue(host.is_small(first), 'Expected small file to be batched')
+        batch = host.collect_batch()
+        self.assertEqual([os.path.basename(j.inpath) for j in batch], ['b.mkv'],
+                         'Expected batch to stop at the first large file')
+        self.assertEqual(queue.qsize(), 2, 'Expected remaining jobs left on the queue')
+
+    def test_agent_lost_session_requeues(self):
+        props = RemoteHostProperties('a1', {'type': 'agent', 'ip': '127.0.0.1', 'os': 'linux', 'working_dir': '/tmp',
+                                            'ffmpeg': '/usr/bin/ffmpeg', 'transfer_retries': 2, 'heartbeat_interval': 0.01,
+                                            'status': 'enabled'})
+        manager = mock.MagicMock()
+        manager.verbose = False
+        manager.config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg'}})
+        manager.agent_session.return_value = None
+        queue = Queue()
+        host = AgentManagedHost('a1', props, queue, manager)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = list()
+            for name in ['a.mkv', 'b.mkv']:
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as f:
+                    f.write(b'x' * 1000)
+                info = self.make_media(path, 'h264', 720, 480, 30, 1, 24, 'yuv420p', [], [])
+                jobs.append(EncodeJob(path, info, Profile('hevc', {'output_options': ['-c:v libx265']}), None))
+            self.assertFalse(host.process(jobs[0]), 'Expected the host to stop taking work')
+            self.assertIs(queue.get_nowait(), jobs[0], 'Expected the job returned to the queue')
+            self.assertFalse(host.process_batch(jobs))
+            self.assertEqual([queue.get_nowait(), queue.get_nowait()], jobs, 'Expected the whole batch returned')
+
+    @mock.patch.object(FFmpeg, 'monitor_agent_ffmpeg')
+    def test_agent_failed_job_timing(self, mock_monitor):
+        props = RemoteHostProperties('a1', {'type': 'agent', 'ip': '127.0.0.1', 'os': 'linux', 'working_dir': '/tmp',
+                                            'ffmpeg': '/usr/bin/ffmpeg', 'status': 'enabled'})
+        manager = mock.MagicMock()
+        manager.verbose = False
+        host = AgentManagedHost('a1', props, Queue(), manager)
+        info = self.make_media('/media/a.mkv', 'h264', 720, 480, 30, 1, 24, 'yuv420p', [], [])
+        job = EncodeJob('/media/a.mkv', info, Profile('hevc', {'output_options': ['-c:v libx265']}), None)
+        log = TimingLog()
+        for result in ['ERR|1', 'BOGUS|1']:
+            mock_monitor.return_value = True, result
+            with mock.patch('pytranscoder.cluster.timings', log):
+                self.assertTrue(host.finish(job, mock.MagicMock()))
+        self.assertEqual([rec['failed'] for rec in log.records], [True, True],
+                         'Expected one failed record per failed agent job')
+        self.assertEqual(len(host.completed), 2)
+
+    @mock.patch('pytranscoder.cluster.signal.signal')
+    @mock.patch.object(Cluster, 'enqueue')
+    def test_cluster_run_summary(self, mock_enqueue, mock_signal):
+        def go(cluster):
+            timing = JobTiming('hevc_cuda')
+            timing.add('encode', 4.0)
+            timing.add('upload', 1.0)
+            timing.account(ResourceUsage(3.5, 0.5, 204800, 0, 0))
+            cluster.hosts[0].complete('/media/a.mkv', 5, timing)
+            cluster.completed.extend(cluster.hosts[0].completed)
+
+        setup = ConfigFile(self.get_setup())
+        with mock.patch.object(Cluster, 'go', autospec=True, side_effect=go):
+            completed = manage_clusters([('/media/a.mkv', 'cluster1', None, None)], setup)
+        self.assertEqual(completed, [('/media/a.mkv', 5)], 'Expected the jobs completed by the cluster')
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            dump_stats(completed)
+        self.assertIn('/media/a.mkv', out.getvalue())
+        self.assertIn('Time by phase, all jobs:', out.getvalue(), 'Expected the phase summary of a cluster run')
+        self.assertIn('ffmpeg resource usage by directive:', out.getvalue(), 'Expected the usage summary too')
+
+    def test_cluster_simulator(self):
+        config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg'},
+                             'profiles': {'hevc': {'output_options': ['-c:v', 'libx265'], 'extension': '.mkv'},
+                                          'av1': {'output_options': ['-c:v', 'libsvtav1'], 'extension': '.mkv',
+                                                  'queue': 'q9'}}})
+        hosts = {'fast': {'type': 'local', 'ip': '127.0.0.1', 'os': 'linux', 'status': 'enabled',
+                          'queues': {'_default': 2}},
+                 'slow': {'type': 'mounted', 'ip': '127.0.0.2', 'user': 'media', 'os': 'linux', 'status': 'enabled'},
+                 'off': {'type': 'local', 'ip': '127.0.0.3', 'os': 'linux', 'status': 'disabled'}}
+        cluster = Cluster('sim', hosts, config, '/usr/bin/ssh')
+        speeds = {'default': {'speed': 1.0}, 'hosts': {'fast': {'speed': 2.0}}}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'media.jsonl')
+            with open(path, 'w') as f:
+                for i in range(6):
+                    info = self.make_media(f'/media/{i}.mkv', 'h264', 1920, 1080, 60, 500, 24, 'yuv420p', [], [])
+                    f.write(json.dumps(info.to_dict()) + '\n')
+            media = simulate.load_media(path)
+        self.assertEqual(len(media), 6)
+
+        jobs, skipped = simulate.plan_jobs(cluster, media, 'hevc')
+        slots = simulate.build_slots(cluster, speeds)
+        self.assertEqual([slot.host for slot in slots], ['fast', 'fast', 'slow'], 'Expected one worker per slot')
+        unserved = simulate.simulate(jobs, slots, cluster.queues)
+        self.assertEqual(unserved, [])
+        self.assertEqual([len(slot.jobs) for slot in slots], [3, 2, 1])
+        self.assertEqual(max([slot.finished for slot in slots]), 90.0, 'Expected makespan of 90 seconds')
+        self.assertEqual(sum([slot.busy for slot in slots[0:2]]), 150.0)
+        self.assertEqual(slots[1].idle(90.0), [30.0], 'Expected idle time until the end of the run')
+        slots[1].jobs[0].start = 10.0
+        self.assertEqual(slots[1].idle(90.0), [10.0, 30.0], 'Expected idle time between jobs counted too')
+
+        jobs, _ = simulate.plan_jobs(cluster, media, 'av1')
+        unserved = simulate.simulate(jobs, simulate.build_slots(cluster, speeds), cluster.queues)
+        self.assertEqual(len(unserved), 6, 'Expected jobs of a queue no host serves to be left over')
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            jobs, skipped = simulate.plan_jobs(cluster, media, 'nosuch')
+        self.assertEqual((jobs, skipped), ([], 6), 'Expected files without a directive skipped')
+        self.assertIn('nosuch not found', out.getvalue())
+
     @staticmethod
     def get_setup():
         setup = {